@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+"""Throughput of copying an album out of the mount.
+
+Each track of an album is read from start to end with 128KB reads, as
+cp does, through the GMusicFS operations. Synthetic tracks are served by
+gmusicfs.fakeserver, which adds latency to every request and limits the
+bandwidth of each connection. This runs once with a single stream per
+file, and once with the segmented download of --segments.
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gmusicfs.gmusicfs import GMusicFS
+from gmusicfs.backend import FakeBackend
+from gmusicfs.fakeserver import StreamServer
+from gmusicfs.replay import FileInfo
+
+READ_SIZE = 128 * 1024
+
+
+def copy(fs, paths):
+    'Read every path through, returns the bytes read'
+    total = 0
+    for path in paths:
+        fi = FileInfo()
+        fs('open', path, fi)
+        offset = 0
+        while True:
+            buf = fs('read', path, READ_SIZE, offset, fi)
+            if not buf:
+                break
+            offset += len(buf)
+        fs('release', path, fi)
+        total += offset
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tracks', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=50,
+                        help='Latency of each request in ms')
+    parser.add_argument('--bandwidth', type=int, default=2048,
+                        help='Bandwidth of each connection in KB/s')
+    parser.add_argument('--size', type=int, default=8192,
+                        help='Size of each track in KB')
+    parser.add_argument('--segments', type=int, default=4)
+    args = parser.parse_args()
+    logging.getLogger('gmusicfs').setLevel(logging.WARNING)
+
+    backend = FakeBackend(args.tracks, tracks_per_album=args.tracks,
+                          mean_size=args.size * 1024)
+    server = StreamServer(backend, args.latency / 1000.0,
+                          args.bandwidth * 1024).start()
+    for segments in (0, args.segments):
+        # No cache, so that each run downloads everything
+        fs = GMusicFS('/bench', api=backend, segments=segments)
+        album = fs.library.get_albums()[0]
+        paths = [album.path + '/' + t.filename for t in album.get_tracks()]
+        requests = server.requests.get('GET', 0)
+        start = time.time()
+        total = copy(fs, paths)
+        elapsed = time.time() - start
+        print '%d segments %7.2fs %8.2f MB/s %5d requests' % (
+            segments, elapsed, total / elapsed / 1024**2,
+            server.requests.get('GET', 0) - requests)
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
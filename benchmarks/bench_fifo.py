@@ -0,0 +1,120 @@
+#!/usr/bin/env python2
+"""Throughput and CPU use of fifo.Buffer against the previous implementation.
+
+A producer thread writes CHUNK sized blocks while the consumer reads
+them. In the 'slow producer' runs the producer sleeps between writes, so
+that the consumer mostly waits for data. That shows how much CPU a
+waiting reader burns.
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gmusicfs import fifo
+
+
+class LegacyBuffer(object):
+    'fifo.Buffer before the ring buffer rewrite, for comparison'
+    def __init__(self, max_size=fifo.MAX_BUFFER):
+        self.buffers = []
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.eof = False
+        self.read_pos = 0
+        self.write_pos = 0
+        self.done_first_write = False
+        self.lock.acquire()
+
+    def write(self, data):
+        if self.done_first_write:
+            self.lock.acquire()
+        try:
+            if not self.buffers:
+                self.buffers.append(StringIO())
+                self.write_pos = 0
+            buffer = self.buffers[-1]
+            buffer.seek(self.write_pos)
+            buffer.write(data)
+            if buffer.tell() >= self.max_size:
+                buffer = StringIO()
+                self.buffers.append(buffer)
+            self.write_pos = buffer.tell()
+        finally:
+            self.lock.release()
+        self.done_first_write = True
+
+    def read(self, length=-1):
+        read_buf = StringIO()
+        remaining = length
+        while True:
+            self.lock.acquire()
+            try:
+                if self.eof and len(self.buffers) == 0:
+                    break
+                elif len(self.buffers) == 0:
+                    continue
+                buffer = self.buffers[0]
+                buffer.seek(self.read_pos)
+                read_buf.write(buffer.read(remaining))
+                self.read_pos = buffer.tell()
+                remaining = length - read_buf.tell()
+                if remaining > 0:
+                    del self.buffers[0]
+                    self.read_pos = 0
+                else:
+                    break
+            finally:
+                self.lock.release()
+        return read_buf.getvalue()
+
+
+def run(buffer, total, chunk, delay):
+    data = 'x' * chunk
+
+    def produce():
+        for i in range(total // chunk):
+            buffer.write(data)
+            if delay:
+                time.sleep(delay)
+
+    producer = threading.Thread(target=produce)
+    start, cpu = time.time(), os.times()
+    producer.start()
+    got = 0
+    while got < total:
+        got += len(buffer.read(chunk))
+    producer.join()
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - sum(cpu[:2])
+    return elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=256,
+                        help='MB to move through each buffer')
+    parser.add_argument('--chunk', type=int, default=64,
+                        help='Size of each read and write in KB')
+    args = parser.parse_args()
+    chunk = args.chunk * 1024
+
+    runs = (('fast producer', args.size * 1024**2, 0),
+            ('slow producer', 200 * chunk, 0.005))
+    for name, total, delay in runs:
+        for impl in (LegacyBuffer, fifo.Buffer):
+            elapsed, cpu = run(impl(), total, chunk, delay)
+            print '%-14s %-13s %7.2fs %9.1f MB/s  cpu %5.2fs (%3.0f%%)' % (
+                name, impl.__name__, elapsed, total / elapsed / 1024**2,
+                cpu, 100 * cpu / elapsed)
+
+
+if __name__ == '__main__':
+    main()
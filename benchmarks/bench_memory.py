@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+"""Memory taken by the tracks of a library.
+
+Compares the track dicts returned by get_all_songs(), which the library
+used to keep, with the Track records it keeps now, and measures the
+resident memory of a whole library (records, albums and path index)
+once it is loaded. Each measure runs in a fresh process.
+"""
+
+import os
+import sys
+import gc
+import argparse
+import logging
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gmusicfs.backend import FakeBackend
+from gmusicfs.tracks import Track
+
+
+def rss():
+    'Resident memory of this process, in bytes'
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(mode, num_tracks):
+    'Resident memory taken by num_tracks tracks kept as mode'
+    backend = FakeBackend(num_tracks)
+    if mode == 'records':
+        songs = backend.get_all_songs()
+    gc.collect()
+    before = rss()
+    if mode == 'dicts':
+        kept = backend.get_all_songs()
+    elif mode == 'records':
+        kept = [Track.from_dict(s) for s in songs]
+    else:
+        from gmusicfs.gmusicfs import GMusicFS
+        logging.getLogger('gmusicfs').setLevel(logging.WARNING)
+        kept = GMusicFS('/bench', api=backend)
+    gc.collect()
+    return rss() - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tracks', type=int, default=100000)
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode:
+        print measure(args.mode, args.tracks)
+        return
+
+    results = {}
+    for mode, label in (('dicts', 'track dicts'), ('records', 'Track records'),
+                        ('library', 'loaded library')):
+        results[mode] = int(subprocess.check_output(
+            [sys.executable, __file__, '--tracks', str(args.tracks),
+             '--mode', mode]))
+        print '%-16s %8.1f MB %6d bytes/track' % (
+            label, results[mode] / 1024.0**2, results[mode] / args.tracks)
+    print 'Records take %.1f%% of the memory of dicts' % (
+        100.0 * results['records'] / results['dicts'])
+
+
+if __name__ == '__main__':
+    main()
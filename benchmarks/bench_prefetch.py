@@ -0,0 +1,82 @@
+#!/usr/bin/env python2
+"""Gaps between the tracks of an album played through.
+
+A player opens each track of an album in turn and reads it at playback
+speed. The gap is the time from the open of a track to the end of its
+first read, when the player can start playing it. Stream URL lookups and
+every request to gmusicfs.fakeserver take the given latency. This runs
+without and with the prefetch of the next track.
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gmusicfs.gmusicfs import GMusicFS, PREFETCHES
+from gmusicfs.backend import FakeBackend
+from gmusicfs.fakeserver import StreamServer
+from gmusicfs.replay import FileInfo
+from harness import percentile
+
+READ_SIZE = 64 * 1024
+
+
+def play(fs, path, rate):
+    'Read a file at rate bytes per second, returns the time to the first read'
+    fi = FileInfo()
+    start = time.time()
+    fs('open', path, fi)
+    offset = 0
+    gap = None
+    while True:
+        buf = fs('read', path, READ_SIZE, offset, fi)
+        if gap is None:
+            gap = time.time() - start
+        if not buf:
+            break
+        offset += len(buf)
+        # Wait until the player would need more:
+        time.sleep(max(start + gap + offset / float(rate) - time.time(), 0))
+    fs('release', path, fi)
+    return gap
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tracks', type=int, default=6)
+    parser.add_argument('--latency', type=float, default=100,
+                        help='Latency of each request in ms')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Size of each track in KB')
+    parser.add_argument('--rate', type=int, default=1024,
+                        help='Playback speed in KB/s')
+    args = parser.parse_args()
+    logging.getLogger('gmusicfs').setLevel(logging.WARNING)
+
+    backend = FakeBackend(args.tracks, tracks_per_album=args.tracks,
+                          mean_size=args.size * 1024,
+                          url_delay=args.latency / 1000.0)
+    server = StreamServer(backend, args.latency / 1000.0).start()
+    for prefetch in (False, True):
+        # No cache, so that each run downloads everything
+        fs = GMusicFS('/bench', api=backend, prefetch=prefetch)
+        album = fs.library.get_albums()[0]
+        gaps = [play(fs, album.path + '/' + t.filename, args.rate * 1024)
+                for t in album.get_tracks()]
+        fs.cleanup()
+        # The first track is never prefetched:
+        gaps = [g * 1000 for g in gaps[1:]]
+        print '%-11s gap p50 %6.1fms max %6.1fms' % (
+            'prefetch' if prefetch else 'no prefetch',
+            percentile(gaps, 50), max(gaps))
+    print 'prefetches: %d started, %d hit, %d wasted' % (
+        PREFETCHES.get(('started',)), PREFETCHES.get(('hit',)),
+        PREFETCHES.get(('wasted',)))
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python2
+"""Time from a cold start to a mounted filesystem.
+
+Each run is a new Python process that imports gmusicfs, logs in to a
+gmusicfs.backend.FakeBackend whose login takes --login ms (standing for
+importing gmusicapi and logging in to Google) and builds the GMusicFS
+as the gmusicfs command does, without the fuse mount itself. Streams
+are served by a gmusicfs.fakeserver.StreamServer in this process. For
+each combination of login (before mounting, or in the background) and
+library snapshot (none, or saved by an earlier run), the median over
+--runs runs of these times from the start of the process is reported:
+
+ - import: gmusicfs imported
+ - mounted: the GMusicFS is ready to be mounted, and init() was called
+ - listing: /artists lists something
+ - first read: the first 64KB of a track have been read
+
+The time of gmusicfs --help is reported first.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gmusicfs.backend import FakeBackend
+from gmusicfs.fakeserver import StreamServer
+
+READ_SIZE = 64 * 1024
+TIMES = ('import', 'mounted', 'listing', 'first read')
+
+
+def child(args):
+    'Start up a GMusicFS, print the times since args.start as JSON'
+    from gmusicfs.gmusicfs import GMusicFS
+    from gmusicfs.replay import FileInfo
+    times = {'import': time.time() - args.start}
+    logging.getLogger('gmusicfs').setLevel(logging.WARNING)
+    # Making up the library is not part of the startup:
+    backend = FakeBackend(args.tracks, base_url=args.url,
+                          login_delay=args.login / 1000.0,
+                          page_delay=args.page_delay / 1000.0)
+    start = time.time()
+    fs = GMusicFS('/bench', username='bench', password='bench', api=backend,
+                  snapshot_path=args.snapshot_path, background_scan=True,
+                  background_login=args.background_login)
+    fs('init', '/')
+
+    def mark(name):
+        times[name] = times['import'] + time.time() - start
+
+    mark('mounted')
+    while len(fs('readdir', '/artists', None)) <= 2:
+        time.sleep(0.001)
+    mark('listing')
+    album = fs.library.get_albums()[0]
+    path = album.path + '/' + album.get_tracks()[0].filename
+    fi = FileInfo()
+    fs('open', path, fi)
+    fs('read', path, READ_SIZE, 0, fi)
+    fs('release', path, fi)
+    mark('first read')
+    # The snapshot is saved once the whole library is loaded:
+    while fs.library.loading or (args.snapshot_path and
+                                 not os.path.exists(args.snapshot_path)):
+        time.sleep(0.01)
+    print json.dumps(times)
+    sys.stdout.flush()
+    fs.cleanup()
+    os._exit(0)
+
+
+def run_child(args, url, background_login, snapshot_path):
+    command = [sys.executable, __file__, '--child', '--url', url,
+               '--start', repr(time.time()), '--tracks', str(args.tracks),
+               '--login', str(args.login), '--pagedelay', str(args.page_delay)]
+    if background_login:
+        command.append('--backgroundlogin')
+    if snapshot_path:
+        command += ['--snapshot', snapshot_path]
+    return json.loads(subprocess.check_output(command).splitlines()[-1])
+
+
+def time_help(runs):
+    'Median time of gmusicfs --help, in seconds'
+    package = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    command = [sys.executable, '-c', 'import sys; sys.path.insert(0, %r);'
+               ' from gmusicfs.gmusicfs import main; main()' % package,
+               '--help']
+    times = []
+    with open(os.devnull, 'w') as null:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(command, stdout=null)
+            times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tracks', type=int, default=10000)
+    parser.add_argument('--login', type=float, default=1000,
+                        help='Time to log in, in ms')
+    parser.add_argument('--pagedelay', type=float, default=200,
+                        dest='page_delay',
+                        help='Time to get each page of 1000 tracks, in ms')
+    parser.add_argument('--latency', type=float, default=50,
+                        help='Latency of each stream request in ms')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--start', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--backgroundlogin', action='store_true',
+                        dest='background_login', help=argparse.SUPPRESS)
+    parser.add_argument('--snapshot', dest='snapshot_path',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+
+    print 'gmusicfs --help: %.0f ms' % (time_help(args.runs) * 1000)
+    server = StreamServer(FakeBackend(args.tracks), args.latency / 1000.0).start()
+    tmp = tempfile.mkdtemp(prefix='gmusicfs-bench-')
+    try:
+        print '%-30s %s' % ('', ' '.join('%10s' % t for t in TIMES))
+        for snapshot in (False, True):
+            snapshot_path = None
+            if snapshot:
+                # Saved by a first run, not counted:
+                snapshot_path = os.path.join(tmp, 'library')
+                run_child(args, server.url, False, snapshot_path)
+            for background_login in (False, True):
+                runs = [run_child(args, server.url, background_login,
+                                  snapshot_path) for _ in range(args.runs)]
+                label = '%s login, %s' % (
+                    'background' if background_login else 'blocking',
+                    'snapshot' if snapshot else 'no snapshot')
+                print '%-30s %s' % (label, ' '.join(
+                    '%8.0fms' % (sorted(r[t] for r in runs)[len(runs) // 2] * 1000)
+                    for t in TIMES))
+    finally:
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
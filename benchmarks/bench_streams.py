@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+"""Threads and memory with hundreds of open streams.
+
+Opens hundreds of tracks at once through the GMusicFS operations, and
+has a few client threads read all of them a little at a time, so that
+every handle keeps an upstream stream open. Each handle is read past
+SEQUENTIAL_THRESHOLD, where its segmented download may start. Synthetic
+tracks are served by gmusicfs.fakeserver from another process, so that
+its threads and memory are not counted. Reports the threads and the
+resident memory of the mount for each number of open handles: the
+threads should stay the same, and the memory stay under the buffer
+budget of gmusicfs.httppool plus a little per handle, whatever the
+read-ahead of each handle.
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gmusicfs.backend import FakeBackend
+from gmusicfs.replay import FileInfo
+from bench_memory import rss
+
+READ_SIZE = 64 * 1024
+
+
+def serve(args):
+    'Run the stream server until stdin is closed'
+    from gmusicfs.fakeserver import StreamServer
+    backend = FakeBackend(args.tracks, mean_size=args.size * 1024)
+    server = StreamServer(backend, args.latency / 1000.0,
+                          args.bandwidth * 1024).start()
+    print server.url
+    sys.stdout.flush()
+    sys.stdin.read()
+    # Without waiting for the hundreds of handler threads:
+    os._exit(0)
+
+
+def run(fs, paths, clients, per_handle):
+    'Open all paths, then read per_handle bytes of each from clients threads'
+    handles = []
+    for path in paths:
+        fi = FileInfo()
+        fs('open', path, fi)
+        handles.append([path, fi, 0, threading.Lock()])
+    peak = {'threads': 0, 'rss': 0}
+    done = threading.Event()
+    cursor = [0]
+    cursor_lock = threading.Lock()
+
+    def client():
+        while True:
+            with cursor_lock:
+                i = cursor[0]
+                cursor[0] += 1
+            if i >= len(handles) * (per_handle // READ_SIZE):
+                return
+            h = handles[i % len(handles)]
+            with h[3]:
+                h[2] += len(fs('read', h[0], READ_SIZE, h[2], h[1]))
+
+    def sample():
+        while not done.is_set():
+            peak['threads'] = max(peak['threads'], threading.active_count())
+            peak['rss'] = max(peak['rss'], rss())
+            done.wait(0.05)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    done.set()
+    sampler.join()
+    for path, fi, offset, lock in handles:
+        fs('release', path, fi)
+    # The client threads and the sampler are not the mount's:
+    peak['threads'] -= clients + 1
+    return elapsed, sum(h[2] for h in handles), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--handles', default='50,100,200,400',
+                        help='Numbers of handles to open, comma separated')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--read', type=int, default=3072,
+                        help='KB read from each handle')
+    parser.add_argument('--latency', type=float, default=50,
+                        help='Latency of each request in ms')
+    parser.add_argument('--bandwidth', type=int, default=1024,
+                        help='Bandwidth of each connection in KB/s')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='Size of each track in KB')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    counts = [int(n) for n in args.handles.split(',')]
+    args.tracks = max(counts)
+    if args.serve:
+        serve(args)
+        return
+
+    server = subprocess.Popen(
+        [sys.executable, __file__, '--serve', '--handles', args.handles,
+         '--latency', str(args.latency), '--bandwidth', str(args.bandwidth),
+         '--size', str(args.size)], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    url = server.stdout.readline().strip()
+    try:
+        from gmusicfs.gmusicfs import GMusicFS
+        logging.getLogger('gmusicfs').setLevel(logging.WARNING)
+        backend = FakeBackend(args.tracks, mean_size=args.size * 1024,
+                              base_url=url)
+        # No rate limit, prefetch or cache, so that every handle streams
+        fs = GMusicFS('/bench', api=backend, rate_limit=0, prefetch=False,
+                      pool_size=max(counts))
+        paths = [album.path + '/' + t.filename
+                 for album in fs.library.get_albums()
+                 for t in album.get_tracks()]
+        base = rss()
+        print 'baseline: %d threads, %.1f MB' % (threading.active_count(),
+                                                  base / 1024.0**2)
+        for n in counts:
+            elapsed, total, peak = run(fs, paths[:n], args.clients,
+                                       args.read * 1024)
+            print '%4d handles %6.2fs %7.2f MB/s %3d threads %7.1f MB' % (
+                n, elapsed, total / elapsed / 1024**2, peak['threads'],
+                (peak['rss'] - base) / 1024.0**2)
+    finally:
+        server.stdin.close()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python2
+"""Concurrent throughput of the GMusicFS operations.
+
+Synthetic tracks are served by gmusicfs.fakeserver, which adds latency
+to every request and limits the bandwidth of each connection. Several
+client threads each read a whole track through the GMusicFS operations
+while another thread keeps stat'ing files. This runs twice: once with
+every operation serialized, as with a nothreads mount, and once with the
+operations running concurrently, as with --multithreaded.
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gmusicfs.gmusicfs import GMusicFS
+from gmusicfs.backend import FakeBackend
+from gmusicfs.fakeserver import StreamServer
+from gmusicfs.replay import FileInfo
+
+
+def run(fs, paths, serialize):
+    lock = threading.Lock()
+    done = threading.Event()
+    stats = {'bytes': 0, 'getattr': 0}
+
+    def call(op, *args):
+        if serialize:
+            with lock:
+                return fs(op, *args)
+        return fs(op, *args)
+
+    def reader(path):
+        fi = FileInfo()
+        call('open', path, fi)
+        offset = 0
+        while True:
+            buf = call('read', path, 65536, offset, fi)
+            if not buf:
+                break
+            offset += len(buf)
+        call('release', path, fi)
+        stats['bytes'] += offset
+
+    def stater():
+        while not done.is_set():
+            call('getattr', paths[0])
+            stats['getattr'] += 1
+
+    threads = [threading.Thread(target=reader, args=(p,)) for p in paths]
+    st = threading.Thread(target=stater)
+    start = time.time()
+    st.start()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    done.set()
+    st.join()
+    return elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=50,
+                        help='Latency of each request in ms')
+    parser.add_argument('--bandwidth', type=int, default=2048,
+                        help='Bandwidth of each connection in KB/s')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='Size of each track in KB')
+    args = parser.parse_args()
+    logging.getLogger('gmusicfs').setLevel(logging.WARNING)
+
+    backend = FakeBackend(args.clients, tracks_per_album=args.clients,
+                          mean_size=args.size * 1024)
+    server = StreamServer(backend, args.latency / 1000.0,
+                          args.bandwidth * 1024).start()
+    fs = GMusicFS('/bench', api=backend)
+    album = fs.library.get_albums()[0]
+    paths = [album.path + '/' + t.filename for t in album.get_tracks()]
+
+    for mode, serialize in (('serialized', True), ('multithreaded', False)):
+        elapsed, stats = run(fs, paths, serialize)
+        print '%-14s %6.2fs %8.2f MB/s %8.0f getattr/s' % (
+            mode, elapsed, stats['bytes'] / elapsed / 1024**2,
+            stats['getattr'] / elapsed)
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
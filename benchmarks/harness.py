@@ -0,0 +1,213 @@
+#!/usr/bin/env python2
+"""Benchmark the hot paths of GMusicFS on synthetic libraries.
+
+For each library size, a gmusicfs.backend.FakeBackend makes up the
+library and a gmusicfs.fakeserver.StreamServer serves its streams on
+localhost, with the given latency and bandwidth. The harness measures:
+
+ - scan: time to build the library index, and the memory it takes
+ - first listing: time until /artists lists something, when the library
+   is loaded in the background as a mount does
+ - readdir: directories listed per second, walking the tree from /
+ - getattr: files stat'ed per second
+ - read: throughput, time to the first byte, and p50/p99 latency of
+   64KB reads of whole tracks
+
+Results are printed and, with --output, saved as JSON labeled with the
+current git commit, so that runs on different commits can be compared.
+"""
+
+import os
+import sys
+import gc
+import stat
+import json
+import time
+import random
+import argparse
+import logging
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gmusicfs.gmusicfs import GMusicFS
+from gmusicfs.backend import FakeBackend
+from gmusicfs.fakeserver import StreamServer
+from gmusicfs.replay import FileInfo
+
+READ_SIZE = 64 * 1024
+
+
+def rss():
+    'Resident memory of this process, in bytes'
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def git_label():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def walk(fs):
+    'List every directory, return the number listed and the file paths'
+    dirs, files, pending = 0, [], ['/']
+    while pending:
+        path = pending.pop()
+        dirs += 1
+        for name in fs('readdir', path, None):
+            if name in ('.', '..'):
+                continue
+            child = path.rstrip('/') + '/' + name
+            if stat.S_ISDIR(fs('getattr', child)['st_mode']):
+                pending.append(child)
+            elif child.endswith('.mp3'):
+                files.append(child)
+    return dirs, files
+
+
+def bench_metadata(fs, min_time):
+    result = {}
+    start, walks = time.time(), 0
+    while True:
+        dirs, files = walk(fs)
+        walks += 1
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+    result['readdir_per_sec'] = dirs * walks / elapsed
+
+    start, ops = time.time(), 0
+    while time.time() - start < min_time:
+        for path in files:
+            fs('getattr', path)
+        ops += len(files)
+    result['getattr_per_sec'] = ops / (time.time() - start)
+    return result, files
+
+
+def bench_reads(fs, files, count, seed):
+    first_bytes, latencies, total = [], [], 0
+    start = time.time()
+    for path in random.Random(seed).sample(files, min(count, len(files))):
+        opened = time.time()
+        fi = FileInfo()
+        fs('open', path, fi)
+        offset = 0
+        while True:
+            t = time.time()
+            buf = fs('read', path, READ_SIZE, offset, fi)
+            now = time.time()
+            if offset == 0:
+                first_bytes.append(now - opened)
+            latencies.append(now - t)
+            if not buf:
+                break
+            offset += len(buf)
+        fs('release', path, fi)
+        total += offset
+    elapsed = time.time() - start
+    ms = lambda s: round(s * 1000, 3)
+    return {'read_mb_per_sec': total / elapsed / 1024**2,
+            'first_byte_ms_p50': ms(percentile(first_bytes, 50)),
+            'first_byte_ms_p99': ms(percentile(first_bytes, 99)),
+            'read_ms_p50': ms(percentile(latencies, 50)),
+            'read_ms_p99': ms(percentile(latencies, 99))}
+
+
+def bench_first_listing(backend):
+    start = time.time()
+    fs = GMusicFS('/bench', api=backend, background_scan=True)
+    fs('init', '/')
+    while len(fs('readdir', '/artists', None)) <= 2:
+        time.sleep(0.001)
+    first = time.time() - start
+    while fs.library.loading:
+        time.sleep(0.01)
+    fs.cleanup()
+    return {'first_listing_sec': first}
+
+
+def run(num_tracks, args):
+    backend = FakeBackend(num_tracks, seed=args.seed,
+                          page_delay=args.page_delay / 1000.0)
+    server = StreamServer(backend, args.latency / 1000.0,
+                          args.bandwidth * 1024).start()
+    gc.collect()
+    before = rss()
+    start = time.time()
+    # Without the rate limit meant for Google, which the reads of whole
+    # tracks from the local server would run into:
+    fs = GMusicFS('/bench', api=backend, rate_limit=0)
+    result = {'tracks': num_tracks,
+              'scan_sec': time.time() - start}
+    gc.collect()
+    result['scan_rss_mb'] = (rss() - before) / 1024.0**2
+    metadata, files = bench_metadata(fs, args.min_time)
+    result.update(metadata)
+    result.update(bench_reads(fs, files, args.reads, args.seed))
+    fs.cleanup()
+    del fs, files
+    result.update(bench_first_listing(backend))
+    server.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tracks', default='1000,10000,100000',
+                        help='Comma separated library sizes (default: '
+                        '%(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Latency of each request in ms')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='Bandwidth of each connection in KB/s '
+                        '(default: no limit)')
+    parser.add_argument('--page-delay', type=float, default=0,
+                        help='Time to get each page of 1000 tracks of the '
+                        'library, in ms')
+    parser.add_argument('--reads', type=int, default=10,
+                        help='Number of tracks read')
+    parser.add_argument('--min-time', type=float, default=1,
+                        help='Minimum duration of the metadata benchmarks, '
+                        'in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default=None,
+                        help='Label of the results (default: git commit)')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    args = parser.parse_args()
+    logging.getLogger('gmusicfs').setLevel(logging.WARNING)
+
+    results = []
+    for num_tracks in [int(n) for n in args.tracks.split(',')]:
+        result = run(num_tracks, args)
+        results.append(result)
+        print ('%(tracks)7d tracks: scan %(scan_sec).2fs %(scan_rss_mb).1fMB, '
+               'first listing %(first_listing_sec).2fs, '
+               '%(readdir_per_sec).0f readdir/s, %(getattr_per_sec).0f '
+               'getattr/s, read %(read_mb_per_sec).1fMB/s first byte '
+               '%(first_byte_ms_p50).1fms read p50 %(read_ms_p50).2fms '
+               'p99 %(read_ms_p99).2fms' % result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'label': args.label or git_label(),
+                       'time': time.time(),
+                       'latency_ms': args.latency,
+                       'page_delay_ms': args.page_delay,
+                       'bandwidth_kb': args.bandwidth,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
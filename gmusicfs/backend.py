@@ -0,0 +1,202 @@
+# Music service backends for gmusicfs.
+#
+# MusicLibrary talks to the music service through a Backend. The real one
+# wraps gmusicapi's Mobileclient; FakeBackend makes up a library of any
+# size, with streams served by fakeserver.StreamServer, for benchmarks.
+
+import re
+import time
+import random
+import urllib2
+import hashlib
+
+# HTTP status in the message of a gmusicapi CallFailure, as worded by
+# requests:
+STATUS_RE = re.compile(r'\b([45]\d\d) (?:Client|Server) Error')
+
+
+def http_error(e):
+    """Get an urllib2.HTTPError for the HTTP status a gmusicapi error
+    carries, which the scheduler knows to try again, or None.
+
+    >>> http_error(Exception('429 Client Error: Too Many Requests')).code
+    429
+    >>> http_error(Exception('Could not parse the response')) is None
+    True
+    """
+    match = STATUS_RE.search(str(e))
+    if match is None:
+        return None
+    return urllib2.HTTPError(None, int(match.group(1)), str(e), {}, None)
+
+
+class Backend(object):
+    'The calls MusicLibrary makes to the music service'
+    def login(self, username, password):
+        raise NotImplementedError
+
+    def get_all_songs(self, incremental=False):
+        """Get a list of track dicts, in the format of gmusicapi. With
+        incremental, get an iterator over pages of them instead, each page
+        fetched as it is needed"""
+        raise NotImplementedError
+
+    def get_stream_url(self, track_id, device_id=None):
+        raise NotImplementedError
+
+
+class GoogleMusicBackend(Backend):
+    'Google Music, through gmusicapi'
+    def __init__(self, debug_logging=False):
+        self.debug_logging = debug_logging
+        self.api = None
+
+    def login(self, username, password):
+        # gmusicapi takes a while to import, so it is only imported here,
+        # which may be on the background login thread:
+        from gmusicapi import Mobileclient
+        self.api = Mobileclient(debug_logging=self.debug_logging)
+        return self.api.login(username, password)
+
+    def get_all_songs(self, incremental=False):
+        if not incremental:
+            return self.__call(self.api.get_all_songs)
+        return self.__pages(self.__call(self.api.get_all_songs,
+                                        incremental=True))
+
+    def get_stream_url(self, track_id, device_id=None):
+        return self.__call(self.api.get_stream_url, track_id, device_id)
+
+    def __pages(self, pages):
+        while True:
+            page = self.__call(next, pages, None)
+            if page is None:
+                return
+            yield page
+
+    def __call(self, fn, *args, **kwargs):
+        # gmusicapi raises CallFailure for every failed call, rate limits
+        # and server errors are raised as HTTPError instead:
+        from gmusicapi.exceptions import CallFailure
+        try:
+            return fn(*args, **kwargs)
+        except CallFailure as e:
+            error = http_error(e)
+            if error is None:
+                raise
+            raise error
+
+
+GENRES = ('Rock', 'Pop', 'Jazz', 'Classical', 'Electronic', 'Folk', 'Hip Hop')
+COVER_SIZE = 50000
+# Tracks per page of get_all_songs(incremental=True), as with gmusicapi:
+PAGE_SIZE = 1000
+
+
+class FakeBackend(Backend):
+    """A made up library of num_tracks tracks, the same for a given seed.
+
+    Stream and cover URLs point to base_url, which should be the URL of a
+    fakeserver.StreamServer serving this backend. It can be set after the
+    backend is created. login() takes login_delay seconds, each page of
+    get_all_songs() page_delay seconds and each get_stream_url() url_delay
+    seconds, as if they came from a remote server."""
+    def __init__(self, num_tracks=1000, seed=0, base_url='http://127.0.0.1',
+                 tracks_per_album=12, albums_per_artist=4,
+                 mean_size=4 * 1024**2, login_delay=0, page_delay=0,
+                 url_delay=0):
+        self.base_url = base_url
+        self.login_delay = login_delay
+        self.page_delay = page_delay
+        self.url_delay = url_delay
+        self.stream_url_calls = 0
+        self.__tracks = []
+        self.__sizes = {} # track id -> stream size
+        self.__album_ids = [] # album id of each track
+        rand = random.Random(seed)
+        album_num = artist_num = 0
+        while len(self.__tracks) < num_tracks:
+            artist = u'Artist %d' % artist_num
+            album = u'Album %d' % album_num
+            album_id = 'album%d' % album_num
+            year = rand.randint(1960, 2015)
+            genre = rand.choice(GENRES)
+            for n in range(min(tracks_per_album, num_tracks - len(self.__tracks))):
+                track_id = hashlib.md5('%d-%d' % (seed, len(self.__tracks))).hexdigest()
+                size = int(rand.uniform(0.5, 1.5) * mean_size)
+                created = rand.randint(1300000000, 1400000000) * 1000000
+                self.__sizes[track_id] = size
+                self.__tracks.append({
+                    'id': track_id, 'title': u'Track %d of %s' % (n + 1, album),
+                    'artist': artist, 'albumArtist': artist, 'album': album,
+                    'trackNumber': n + 1, 'year': year, 'genre': genre,
+                    'comment': u'', 'estimatedSize': str(size),
+                    'creationTimestamp': str(created),
+                    'recentTimestamp': str(created),
+                    'lastModifiedTimestamp': str(created),
+                    # Fields the filesystem does not use, but which real
+                    # libraries have and which take memory:
+                    'kind': u'sj#track', 'deleted': False,
+                    'clientId': track_id[:22], 'composer': u'',
+                    'durationMillis': str(size // 16), 'discNumber': 1,
+                    'totalDiscCount': 1, 'totalTrackCount': tracks_per_album,
+                    'playCount': rand.randint(0, 50), 'rating': '0',
+                    'beatsPerMinute': 0, 'albumId': u'B' + album_id,
+                    'artistId': [u'A%d' % artist_num], 'nid': u'T' + track_id,
+                    'storeId': u'T' + track_id, 'trackType': '8',
+                    'artistArtRef': [{'url': u'%s/artist/%d.jpg' % (
+                        base_url, artist_num), 'kind': u'sj#imageRef'}]})
+                self.__album_ids.append(album_id)
+            album_num += 1
+            if album_num % albums_per_artist == 0:
+                artist_num += 1
+
+    def login(self, username, password):
+        if self.login_delay:
+            time.sleep(self.login_delay)
+        return True
+
+    def get_all_songs(self, incremental=False):
+        if incremental:
+            return self.__get_pages()
+        tracks = []
+        for page in self.__get_pages():
+            tracks.extend(page)
+        return tracks
+
+    def __get_pages(self):
+        for start in xrange(0, len(self.__tracks), PAGE_SIZE):
+            if self.page_delay:
+                time.sleep(self.page_delay)
+            # Fresh dicts, like the real API returns on each call:
+            page = []
+            for i in xrange(start, min(start + PAGE_SIZE, len(self.__tracks))):
+                track = dict(self.__tracks[i])
+                track['albumArtRef'] = [{'url': '%s/cover/%s.jpg' % (
+                    self.base_url, self.__album_ids[i]), 'kind': u'sj#imageRef'}]
+                page.append(track)
+            yield page
+
+    def change_track(self, track_id, size):
+        'Modify a track: it gets a new lastModifiedTimestamp and stream size'
+        for track in self.__tracks:
+            if track['id'] == track_id:
+                track['lastModifiedTimestamp'] = str(
+                    int(track['lastModifiedTimestamp']) + 1)
+                track['estimatedSize'] = str(size)
+                self.__sizes[track_id] = size
+
+    def get_stream_url(self, track_id, device_id=None):
+        self.stream_url_calls += 1
+        if self.url_delay:
+            time.sleep(self.url_delay)
+        return '%s/stream/%s.mp3' % (self.base_url, track_id)
+
+    def get_size(self, path):
+        """Get the size of the file at a URL path served for this backend,
+        or None if there is no such file"""
+        if path.startswith('/cover/'):
+            return COVER_SIZE
+        if path.startswith('/stream/'):
+            return self.__sizes.get(path[len('/stream/'):-len('.mp3')])
+        return None
@@ -0,0 +1,317 @@
+# Persistent block cache for gmusicfs.
+#
+# Track and cover data is stored in fixed size blocks, one file per block,
+# under a cache directory. An index of the blocks (in least recently used
+# order) and of the known stream lengths is kept next to them so that a
+# remount starts with a warm cache. Blocks of pinned keys are kept aside,
+# they are never evicted and do not count towards the size limit.
+
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+log = logging.getLogger('gmusicfs.cache')
+
+BLOCK_SIZE = 128 * 1024
+INDEX_VERSION = 2
+# Write the index to disk after this many changes, even without a sync():
+SYNC_EVERY = 64
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'gmusicfs')
+
+
+def atomic_write(path, data):
+    'Write data to path so that readers only ever see a complete file'
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class BlockCache(object):
+    """Size bounded on-disk cache of stream blocks.
+
+    Blocks are addressed by a key (a track id or a cover URL) and a block
+    number. When the total size goes over max_bytes, the least recently
+    used blocks are evicted, except those of pinned keys.
+
+    >>> import shutil
+    >>> d = tempfile.mkdtemp()
+    >>> c = BlockCache(d, max_bytes=8, block_size=4)
+    >>> c.put('t', 0, 'abcd')
+    >>> c.put('t', 1, 'efgh')
+    >>> c.get('t', 0, 1, 2)
+    'bc'
+    >>> c.put('t', 2, 'ij')
+    >>> c.get('t', 1) is None
+    True
+    >>> c.set_length('t', 10)
+    >>> c.close()
+    >>> c = BlockCache(d, max_bytes=8, block_size=4)
+    >>> c.get('t', 0), c.get('t', 2), c.get_length('t')
+    ('abcd', 'ij', 10)
+    >>> c.pin('t')
+    >>> c.put('t', 1, 'efgh')
+    >>> c.put('u', 0, 'klmn')
+    >>> c.put('u', 1, 'opqr')
+    >>> c.get('t', 0), c.get('t', 1), c.cached_bytes('t')
+    ('abcd', 'efgh', 10)
+    >>> c.forget('t')
+    >>> c.get('t', 0), c.get_length('t'), c.is_pinned('t')
+    (None, None, True)
+    >>> shutil.rmtree(os.path.join(d, 'blocks'))
+    >>> open(os.path.join(d, 'blocks'), 'w').close()
+    >>> c.put('v', 0, 'stuv') # Not cached, but no error either
+    >>> c.has('v', 0)
+    False
+    >>> shutil.rmtree(d)
+    """
+    def __init__(self, path, max_bytes, block_size=BLOCK_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.__blocks = OrderedDict() # block name -> size, oldest first
+        self.__lengths = {} # key -> stream length
+        self.__pinned = {} # block name -> size, for the blocks of pinned keys
+        self.__pinned_keys = {} # key hash -> key
+        self.__size = 0
+        self.__changes = 0
+        self.__index_path = os.path.join(path, 'index')
+        self.__blocks_path = os.path.join(path, 'blocks')
+        if not os.path.isdir(self.__blocks_path):
+            os.makedirs(self.__blocks_path)
+        self.__load_index()
+
+    def __load_index(self):
+        try:
+            with open(self.__index_path, 'rb') as f:
+                index = pickle.load(f)
+            version, block_size, blocks, lengths = index[:4]
+            pinned, pinned_keys = index[4:] or ({}, {})
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            version = block_size = None
+        if version not in (1, INDEX_VERSION) or block_size != self.block_size:
+            if version is not None:
+                log.info('Discarding incompatible block cache in %s' % self.path)
+            # Blocks without an index are unreachable, start from scratch:
+            self.__clear_blocks()
+            return
+        self.__blocks = blocks
+        self.__lengths = lengths
+        self.__pinned = pinned
+        self.__pinned_keys = pinned_keys
+        self.__size = sum(blocks.itervalues())
+        self.__evict()
+        log.info('Block cache: %d blocks, %d bytes, %d pinned blocks' % (
+            len(self.__blocks), self.__size, len(self.__pinned)))
+
+    def __clear_blocks(self):
+        for d in os.listdir(self.__blocks_path):
+            d = os.path.join(self.__blocks_path, d)
+            for name in os.listdir(d):
+                os.unlink(os.path.join(d, name))
+
+    def __hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def __name(self, key, block):
+        return '%s.%d' % (self.__hash(key), block)
+
+    def __file(self, name):
+        return os.path.join(self.__blocks_path, name[:2], name)
+
+    def get(self, key, block, start=0, length=None):
+        """Get (part of) a cached block, or None if it is not cached.
+        start and length select a byte range inside the block."""
+        name = self.__name(key, block)
+        with self.lock:
+            size = self.__pinned.get(name)
+            if size is None:
+                size = self.__blocks.pop(name, None)
+                if size is None:
+                    return None
+                # Move it to the most recently used end:
+                self.__blocks[name] = size
+        if length is None:
+            length = size - start
+        try:
+            fd = os.open(self.__file(name), os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            with self.lock:
+                if self.__blocks.pop(name, None) is not None:
+                    self.__size -= size
+                self.__pinned.pop(name, None)
+            return None
+        try:
+            os.lseek(fd, start, os.SEEK_SET)
+            return os.read(fd, length)
+        finally:
+            os.close(fd)
+
+    def has(self, key, block):
+        name = self.__name(key, block)
+        with self.lock:
+            return name in self.__blocks or name in self.__pinned
+
+    def put(self, key, block, data):
+        'Store a block'
+        pinned = self.is_pinned(key)
+        if len(data) > self.max_bytes and not pinned:
+            return
+        name = self.__name(key, block)
+        path = self.__file(name)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.mkdir(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            atomic_write(path, data)
+        except (IOError, OSError) as e:
+            # A full or broken cache disk only costs the caching:
+            log.warning('Could not cache block %d of %s: %s' % (block, key, e))
+            return
+        with self.lock:
+            old = self.__blocks.pop(name, None)
+            if old is not None:
+                self.__size -= old
+            if name.split('.')[0] in self.__pinned_keys:
+                self.__pinned[name] = len(data)
+            else:
+                self.__blocks[name] = len(data)
+                self.__size += len(data)
+                self.__evict()
+            self.__changed()
+
+    def pin(self, key):
+        'Keep the blocks of key, present and future, out of eviction'
+        h = self.__hash(key)
+        with self.lock:
+            if h in self.__pinned_keys:
+                return
+            self.__pinned_keys[h] = key
+            for name in [n for n in self.__blocks if n.split('.')[0] == h]:
+                size = self.__pinned[name] = self.__blocks.pop(name)
+                self.__size -= size
+            self.__changed()
+
+    def unpin(self, key):
+        'Make the blocks of key evictable again'
+        h = self.__hash(key)
+        with self.lock:
+            if self.__pinned_keys.pop(h, None) is None:
+                return
+            for name in [n for n in self.__pinned if n.split('.')[0] == h]:
+                size = self.__blocks[name] = self.__pinned.pop(name)
+                self.__size += size
+            self.__evict()
+            self.__changed()
+
+    def forget(self, key):
+        """Drop the blocks and the length of key, when its content has
+        changed. A pinned key stays pinned."""
+        h = self.__hash(key)
+        with self.lock:
+            names = [n for n in self.__blocks if n.split('.')[0] == h]
+            for name in names:
+                self.__size -= self.__blocks.pop(name)
+            pinned = [n for n in self.__pinned if n.split('.')[0] == h]
+            for name in pinned:
+                del self.__pinned[name]
+            self.__lengths.pop(key, None)
+            self.__changed()
+        for name in names + pinned:
+            try:
+                os.unlink(self.__file(name))
+            except OSError:
+                pass
+
+    def is_pinned(self, key):
+        return self.__hash(key) in self.__pinned_keys
+
+    def pinned_keys(self):
+        with self.lock:
+            return self.__pinned_keys.values()
+
+    def cached_bytes(self, key):
+        'Get how many bytes of the stream for key are cached'
+        length = self.__lengths.get(key)
+        if length is None:
+            return 0
+        h = self.__hash(key)
+        with self.lock:
+            total = 0
+            for block in range((length + self.block_size - 1) // self.block_size):
+                name = '%s.%d' % (h, block)
+                total += self.__pinned.get(name) or self.__blocks.get(name, 0)
+            return total
+
+    def get_length(self, key):
+        'Get the length of the stream for key, if known'
+        return self.__lengths.get(key)
+
+    def set_length(self, key, length):
+        with self.lock:
+            if self.__lengths.get(key) != length:
+                self.__lengths[key] = length
+                self.__changed()
+
+    def __evict(self):
+        # Called with the lock held
+        while self.__size > self.max_bytes and self.__blocks:
+            name, size = self.__blocks.popitem(last=False)
+            self.__size -= size
+            try:
+                os.unlink(self.__file(name))
+            except OSError:
+                pass
+
+    def __changed(self):
+        # Called with the lock held
+        self.__changes += 1
+        if self.__changes >= SYNC_EVERY:
+            try:
+                self.__write_index()
+            except (IOError, OSError) as e:
+                log.warning('Could not write the cache index: %s' % e)
+
+    def __write_index(self):
+        # Called with the lock held
+        atomic_write(self.__index_path, pickle.dumps(
+            (INDEX_VERSION, self.block_size, self.__blocks, self.__lengths,
+             self.__pinned, self.__pinned_keys), pickle.HIGHEST_PROTOCOL))
+        self.__changes = 0
+
+    def sync(self):
+        'Write the index to disk if it has changed'
+        with self.lock:
+            if self.__changes:
+                self.__write_index()
+
+    def close(self):
+        self.sync()
+
+    def __len__(self):
+        return self.__size
@@ -0,0 +1,195 @@
+# Local HTTP server for gmusicfs benchmarks.
+#
+# Serves the streams and covers of a backend.FakeBackend library, with
+# support for HEAD, Range requests and keep-alive, and with a configurable
+# latency per request and bandwidth per connection. For the doctests of
+# httppool, the redirect, chunked and close query parameters have a file
+# redirected, sent with chunked encoding or sent up to the end of the
+# connection, and hangup has a kept alive connection closed instead of
+# answered, as when the keep-alive timeout of a server runs out. drop=N
+# has the connection closed in the middle of a response once it gets to
+# byte N of the file, as when a connection is reset while streaming.
+
+import sys
+import time
+import random
+import socket
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+# MP3 frame of 128kbps, 44.1kHz stereo audio: a 4 byte header and 413
+# bytes of (made up) audio data. Streams repeat a pattern of these frames.
+FRAME_HEADER = '\xff\xfb\x90\x64'
+FRAME_SIZE = 417
+PATTERN_FRAMES = 157
+WRITE_CHUNK = 16 * 1024
+
+
+def make_pattern(seed=0):
+    rand = random.Random(seed)
+    return ''.join(FRAME_HEADER + ''.join(
+        chr(rand.getrandbits(8)) for i in range(FRAME_SIZE - 4))
+        for f in range(PATTERN_FRAMES))
+
+PATTERN = make_pattern()
+
+
+def stream_bytes(start, end):
+    """Get the bytes start to end (excluded) of a stream. Every stream has
+    the same content, only their sizes differ.
+
+    >>> stream_bytes(0, 4) == FRAME_HEADER
+    True
+    >>> stream_bytes(FRAME_SIZE, FRAME_SIZE + 4) == FRAME_HEADER
+    True
+    >>> len(stream_bytes(100, 200000))
+    199900
+    """
+    out = []
+    while start < end:
+        offset = start % len(PATTERN)
+        chunk = PATTERN[offset:offset + end - start]
+        out.append(chunk)
+        start += len(chunk)
+    return ''.join(out)
+
+
+class StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    served = False # A request was answered on this connection
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        server = self.server
+        server.count_request(self.command)
+        if server.latency:
+            time.sleep(server.latency)
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        query = urlparse.parse_qs(query, keep_blank_values=True)
+        size = server.backend.get_size(path)
+        if size is None:
+            self.send_error(404)
+            return
+        if 'hangup' in query and self.served:
+            self.close_connection = 1
+            return
+        self.served = True
+        if 'redirect' in query:
+            self.send_response(302)
+            self.send_header('Location', path)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, size
+        range_header = self.headers.get('Range')
+        if range_header:
+            first, last = range_header.split('=', 1)[1].split('-')
+            start = int(first)
+            if last:
+                end = min(int(last) + 1, size)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end - 1, size))
+        else:
+            self.send_response(200)
+        content_type = 'image/jpeg' if path.startswith('/cover/') else 'audio/mpeg'
+        self.send_header('Content-Type', content_type)
+        chunked = 'chunked' in query
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        elif 'close' in query:
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if not body:
+            return
+        if 'drop' in query and start < int(query['drop'][0]) < end:
+            end = int(query['drop'][0])
+            self.close_connection = 1
+        delay = 0
+        if server.bandwidth:
+            delay = WRITE_CHUNK / float(server.bandwidth)
+        try:
+            while start < end:
+                chunk = stream_bytes(start, min(end, start + WRITE_CHUNK))
+                if chunked:
+                    self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+                else:
+                    self.wfile.write(chunk)
+                start += len(chunk)
+                server.count_bytes(len(chunk))
+                if delay:
+                    time.sleep(delay)
+            if chunked:
+                self.wfile.write('0\r\n\r\n')
+        except IOError:
+            # The client went away before the end
+            self.close_connection = 1
+
+
+class StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serve the files of a FakeBackend on localhost, from a background
+    thread. latency is in seconds, bandwidth in bytes per second per
+    connection (0 for no limit). Sets the backend's base_url to its own
+    URL."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, backend, latency=0, bandwidth=0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           StreamHandler)
+        self.backend = backend
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.requests = {} # method -> count
+        self.bytes_sent = 0
+        self.connections = 0
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        backend.base_url = self.url
+        self.__thread = None
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        # Clients going away before the end of a response are expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def count_request(self, method):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def count_bytes(self, n):
+        with self.lock:
+            self.bytes_sent += n
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever,
+                                         name='stream-server')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,13 +1,16 @@
-# 'Efficient FIFO Buffer' from http://ben.timby.com/?p=139
-# Modified to be a blocking buffer, for use in gmusicfs
+# Blocking FIFO buffer for gmusicfs.
+#
+# A bounded ring buffer between a producer thread writing data from the
+# network and a consumer reading it. Readers block until there is data,
+# and writers block while the buffer is full, so the memory used by a
+# buffer never grows past its size. The ring starts small, grows as data
+# is written and shrinks back once read empty, so that a buffer only
+# takes as much memory as the data it holds.
 
 import threading
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
 
 MAX_BUFFER = 1024**2*4
+INITIAL_SIZE = 16 * 1024
 
 class Buffer(object):
     """
@@ -24,87 +27,144 @@ class Buffer(object):
     >>> b.write('four')
     >>> b.read() == 'four'
     True
+    >>> b.close()
     >>> b.read() == ''
     True
+
+    Writes larger than the buffer block until a reader makes room:
+
+    >>> b = Buffer(max_size=4)
+    >>> t = threading.Thread(target=b.write, args=('abcdefghij',))
+    >>> t.start()
+    >>> out = bytearray(10)
+    >>> b.readinto(out)
+    10
+    >>> t.join()
+    >>> str(out)
+    'abcdefghij'
     """
     def __init__(self, max_size=MAX_BUFFER):
-        self.buffers = []
         self.max_size = max_size
+        self.__buf = bytearray(min(max_size, INITIAL_SIZE))
+        self.__view = memoryview(self.__buf)
+        self.__start = 0 # read position in the ring
+        self.__len = 0 # bytes in the ring
         self.lock = threading.Lock()
+        self.__readable = threading.Condition(self.lock)
+        self.__writable = threading.Condition(self.lock)
         self.eof = False
-        self.read_pos = 0
-        self.write_pos = 0
-        self.done_first_write = False
-        # Acquire the lock immediately, so that the first write occurs
-        # before the first read:
-        self.lock.acquire()
 
     def write(self, data):
-        # Don't acquire the lock for the first write:
-        if self.done_first_write:
-            self.lock.acquire()
-        try:
-            if not self.buffers:
-                self.buffers.append(StringIO())
-                self.write_pos = 0
-            buffer = self.buffers[-1]
-            buffer.seek(self.write_pos)
-            buffer.write(data)
-            if buffer.tell() >= self.max_size:
-                buffer = StringIO()
-                self.buffers.append(buffer)
-            self.write_pos = buffer.tell()
-        finally:
-            self.lock.release()
-        self.done_first_write = True
+        """Write all of data, blocking while the buffer is full. Data
+        written after close() is dropped."""
+        data = memoryview(data)
+        pos = 0
+        with self.lock:
+            while pos < len(data):
+                while self.__len == self.max_size and not self.eof:
+                    self.__writable.wait()
+                if self.eof:
+                    return
+                size = len(self.__buf)
+                if len(data) - pos > size - self.__len and size < self.max_size:
+                    size = self.__grow(self.__len + len(data) - pos)
+                end = (self.__start + self.__len) % size
+                n = min(len(data) - pos, size - self.__len, size - end)
+                self.__view[end:end + n] = data[pos:pos + n]
+                self.__len += n
+                pos += n
+                self.__readable.notify_all()
 
-    def read(self, length=-1):
-        read_buf = StringIO()
-        remaining = length
-        while True:
-            self.lock.acquire()
-            try:
-                # Read will block forever until we close the file:
-                if self.eof and len(self.buffers) == 0:
+    def __grow(self, wanted):
+        # Called with the lock held: make the ring big enough for wanted
+        # bytes, up to max_size, with its data moved to the start of it.
+        size = max(wanted, len(self.__buf) * 5 // 4)
+        size = min(-(-size // INITIAL_SIZE) * INITIAL_SIZE, self.max_size)
+        buf = bytearray(size)
+        length = self.__len
+        first = min(length, len(self.__buf) - self.__start)
+        buf[:first] = self.__view[self.__start:self.__start + first]
+        buf[first:length] = self.__view[:length - first]
+        self.__buf, self.__view = buf, memoryview(buf)
+        self.__start = 0
+        return size
+
+    def __copy_out(self, out, length):
+        # Called with the lock held: move up to length bytes into the
+        # memoryview out, returns the number of bytes moved.
+        done = 0
+        while done < length and self.__len:
+            n = min(length - done, self.__len, len(self.__buf) - self.__start)
+            out[done:done + n] = self.__view[self.__start:self.__start + n]
+            self.__start = (self.__start + n) % len(self.__buf)
+            self.__len -= n
+            done += n
+        if not self.__len and len(self.__buf) > INITIAL_SIZE:
+            # Give back the memory of a buffer that was read empty
+            self.__buf = bytearray(INITIAL_SIZE)
+            self.__view = memoryview(self.__buf)
+            self.__start = 0
+        if done:
+            self.__writable.notify_all()
+        return done
+
+    def readinto(self, b):
+        """Read into the writable buffer b, blocking until it is full or
+        the buffer is closed. Returns the number of bytes read."""
+        out = memoryview(b)
+        done = 0
+        with self.lock:
+            while done < len(out):
+                while not self.__len and not self.eof:
+                    self.__readable.wait()
+                if not self.__len:
                     break
-                elif len(self.buffers) == 0:
-                    continue
-                buffer = self.buffers[0]
-                buffer.seek(self.read_pos)
-                read_buf.write(buffer.read(remaining))
-                self.read_pos = buffer.tell()
-                if length == -1:
-                    # we did not limit the read, we exhausted the buffer, so delete it.
-                    # keep reading from remaining buffers.
-                    del self.buffers[0]
-                    self.read_pos = 0
-                else:
-                    #we limited the read so either we exhausted the buffer or not:
-                    remaining = length - read_buf.tell()
-                    if remaining > 0:
-                        # exhausted, remove buffer, read more.
-                        # keep reading from remaining buffers.
-                        del self.buffers[0]
-                        self.read_pos = 0
-                    else:
-                        break
-            finally:
-                self.lock.release()
-        return read_buf.getvalue()
+                done += self.__copy_out(out[done:], len(out) - done)
+        return done
+
+    def read(self, length=-1):
+        """Read length bytes, blocking until they are there or the buffer
+        is closed. With no length, read what is there (blocking until there
+        is something)."""
+        if length < 0:
+            with self.lock:
+                while not self.__len and not self.eof:
+                    self.__readable.wait()
+                out = bytearray(self.__len)
+                self.__copy_out(memoryview(out), len(out))
+            return str(out)
+        out = bytearray(length)
+        n = self.readinto(out)
+        if n < length:
+            del out[n:]
+        return str(out)
+
+    def read_some(self, length):
+        'Read up to length bytes, blocking until there is something'
+        with self.lock:
+            while not self.__len and not self.eof:
+                self.__readable.wait()
+            out = bytearray(min(length, self.__len))
+            self.__copy_out(memoryview(out), len(out))
+        return str(out)
+
+    def skip(self, length):
+        """Drop up to length bytes that are already in the buffer, without
+        blocking. Returns the number of bytes dropped."""
+        with self.lock:
+            n = min(length, self.__len)
+            self.__start = (self.__start + n) % len(self.__buf)
+            self.__len -= n
+            if n:
+                self.__writable.notify_all()
+            return n
 
     def __len__(self):
-        len = 0
-        self.lock.acquire()
-        try:
-            for buffer in self.buffers:
-                buffer.seek(0, 2)
-                if buffer == self.buffers[0]:
-                    len += buffer.tell() - self.read_pos
-                else:
-                    len += buffer.tell()
-            return len
-        finally:
-            self.lock.release()
+        return self.__len
 
     def close(self):
-        self.eof = True
+        'Signal the end of the data, waking up blocked readers and writers'
+        with self.lock:
+            self.eof = True
+            self.__readable.notify_all()
+            self.__writable.notify_all()
@@ -1,103 +1,189 @@
 #!/usr/bin/env python2
 
 import os
-import re
 import sys
-import struct
+import socket
+import httplib
 import urllib2
 import ConfigParser
-from errno import ENOENT
+from errno import ENOENT, ENODATA, ENOTSUP, EROFS
 from stat import S_IFDIR, S_IFREG
 import time
+import struct
+import hashlib
 import argparse
 import operator
+import itertools
 import shutil
 import tempfile
+import errno
 import threading
 import logging
+import collections
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
-from gmusicapi import Mobileclient as GoogleMusicAPI
-from gmusicapi import Webclient as GoogleMusicWebAPI
 
-import fifo
+import snapshot
+import httppool
+import metrics
+import scheduler
+from backend import GoogleMusicBackend
+from tracks import Track, formatNames
+from sizes import SizeProber
+from urls import StreamUrlCache
+import urls
+from cache import BlockCache, BLOCK_SIZE, default_cache_dir
+from id3 import Tagger, ID3V1_TRAILER_SIZE, id3v1
+import pins
+from pins import Pinner, PIN_XATTR, PROGRESS_XATTR
+from traces import TraceWriter
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger('gmusicfs')
 deviceId=None
 
-# Size of the ID3v1 trailer appended to the mp3 file (at read time)
-# Add the size to the reported size of the mp3 file so read function receive correct params.
-# The read function will read size bytes - 128 since we have to generate this 128 bytes.
-ID3V1_TRAILER_SIZE = 128
+# An ID3v1 trailer is appended to the mp3 file (at read time), and with
+# --id3v2 an ID3v2 header is prepended to it. Their size is added to the
+# reported size of the mp3 file so read function receive correct params.
+# Both are served from memory by StreamFile around the stream.
+
+# Extended attribute with the exact size of a file
+SIZE_XATTR = 'user.gmusicfs.size'
+# Extended attribute of the directories while the library is loading
+LOADING_XATTR = 'user.gmusicfs.loading'
+
+# Forward seeks of up to this many bytes are read through on the open
+# connection, longer ones (and all backward seeks) use a new Range request.
+READ_SKIP_LIMIT = 256 * 1024
+
+# Default size of the read-ahead window of each open file:
+READAHEAD_SIZE = 1024 * 1024
 
-def formatNames(string_from):
-    return re.sub('/', '-', string_from)
+# Once a file has been read sequentially from its start up to this offset,
+# with no more than SEQUENTIAL_GAP seconds between the end of a read and
+# the next one, the rest of it is downloaded as concurrent Range requests
+# of SEGMENT_BLOCKS blocks each, with SEGMENTS connections (--segments).
+# The requests are opened by SEGMENTS threads shared by all the files:
+SEQUENTIAL_THRESHOLD = 1024 * 1024
+SEQUENTIAL_GAP = 0.5
+SEGMENT_BLOCKS = 8
+SEGMENTS = 4
+# Largest read the kernel is asked to send:
+MAX_READ = 1024 * 1024
 
+# Once this fraction of a track has been read (--prefetchat), the stream
+# of the next track of its album is opened and its first PREFETCH_SIZE
+# bytes buffered. Prefetched streams not opened within PREFETCH_TTL
+# seconds, or beyond the MAX_PREFETCHES latest ones, are dropped.
+PREFETCH_AT = 0.75
+PREFETCH_SIZE = 512 * 1024
+PREFETCH_TTL = 600
+MAX_PREFETCHES = 2
+
+# Default time the kernel may cache attributes and names for, in seconds.
+# The library only changes on a refresh; files changed by one get new inode
+# numbers and directories a new mtime, which the kernel sees once these
+# run out.
+ATTR_TIMEOUT = 60
+ENTRY_TIMEOUT = 60
+
+# With --backgroundlogin, requests to the music service made before the
+# login is done wait for it for up to this many seconds:
+LOGIN_TIMEOUT = 30
+
+# Virtual files with information about the filesystem itself, rendered
+# when they are opened:
+STATS_DIR = u'/.gmusicfs'
+STATS_PATH = STATS_DIR + u'/stats'
+STATUS_PATH = STATS_DIR + u'/status'
+
+OP_SECONDS = metrics.registry.histogram(
+    'gmusicfs_operation_seconds', 'Time spent in filesystem operations', ('op',))
+OP_ERRORS = metrics.registry.counter(
+    'gmusicfs_operation_errors_total',
+    'Filesystem operations that failed, by error', ('op', 'error'))
+READ_BYTES = metrics.registry.counter(
+    'gmusicfs_read_bytes_total', 'Bytes returned by read operations')
+API_SECONDS = metrics.registry.histogram(
+    'gmusicfs_api_seconds', 'Time spent in music service API calls', ('call',))
+STREAM_OPENS = metrics.registry.counter(
+    'gmusicfs_stream_opens_total', 'Upstream streams opened')
+CACHE_BLOCKS = metrics.registry.counter(
+    'gmusicfs_cache_blocks_total',
+    'Blocks found in (hit) or missing from (miss) the block cache', ('result',))
+PREFETCHES = metrics.registry.counter(
+    'gmusicfs_prefetch_total', 'Next track streams prefetched (started),'
+    ' then opened by a reader (hit) or dropped unused (wasted)', ('result',))
 
 class NoCredentialException(Exception):
     pass
 
+class LoginException(Exception):
+    pass
+
 class Album(object):
     'Keep record of Album information'
-    def __init__(self, library, normtitle):
+    def __init__(self, library, normtitle, artist=None, key=None):
         self.library = library
         self.normtitle = formatNames(normtitle)
+        self.artist = artist
+        self.key = key
+        self.path = None # Set once the album is in the path index
         self.__tracks = []
         self.__sorted = True
-        self.__filename_re = re.compile("^[0-9]{3} - (.*)\.mp3$")
+        self.__lock = threading.Lock()
 
     def add_track(self, track):
         'Add a track to the Album'
-        self.__tracks.append(track)
-        self.__sorted = False
+        with self.__lock:
+            self.__tracks.append(track)
+            self.__sorted = False
+
+    def remove_track(self, track_id):
+        'Remove a track from the Album'
+        with self.__lock:
+            self.__tracks = [t for t in self.__tracks if t.id != track_id]
 
     def get_tracks(self, get_size=False):
-        # Re-sort by track number:
-        if not self.__sorted:
-            self.__tracks.sort(key=lambda t: t.get('track'))
-        # Retrieve and remember the filesize of each track:
+        with self.__lock:
+            # Re-sort by track number:
+            if not self.__sorted:
+                self.__tracks.sort(key=lambda t: t.track_number)
+                self.__sorted = True
+            tracks = list(self.__tracks)
+        # Retrieve and remember the filesize of each track, in the
+        # background. Until then the estimated size is reported.
         if get_size and self.library.true_file_size:
-            for t in self.__tracks:
-                if not t.has_key('bytes'):
-                    r = urllib2.Request(self.get_track_stream(t)[0])
-                    r.get_method = lambda: 'HEAD'
-                    u = urllib2.urlopen(r)
-                    t['bytes'] = int(u.headers['Content-Length']) + ID3V1_TRAILER_SIZE
-        return self.__tracks
-
-    def get_track(self, filename):
-        """Get the track name corresponding to a filename
-        (eg. '001 - brilliant track name.mp3')"""
-        m = self.__filename_re.match(filename)
-        if m:
-            title = m.groups()[0]
-            for track in self.get_tracks():
-                if formatNames(track['title'].lower()) == title:
-                    return track
-        return None
+            for t in tracks:
+                if t.size is None:
+                    self.library.sizes.probe(
+                        t.id, lambda refresh=False, t=t: self.get_track_stream(t, refresh),
+                        lambda size, t=t: self.library.set_track_size(t, size))
+        return tracks
 
-    def get_track_stream(self, track):
-        "Get the track stream URL"
-        return self.library.api.get_stream_url(track['id'], deviceId)
+    def get_track_stream(self, track, refresh=False):
+        """Get the track stream URL. It is cached until shortly before it
+        expires, refresh=True gets a new one right away"""
+        return self.library.stream_urls.get(track.id, refresh)
 
     def get_cover_url(self):
         'Get the album cover image URL'
         try:
             #Assume the first track has the right cover URL:
-            url = "%s" % self.__tracks[0]['albumArtRef'][0]['url']
-        except:
-            url = None
-        return url
+            return self.__tracks[0].cover_url
+        except IndexError:
+            return None
         
     def get_cover_size(self):
-        'Get the album cover size'	
-	if self.library.true_file_size:
-	    r = urllib2.Request(self.get_cover_url())
-	    r.get_method = lambda: 'HEAD'
-	    u = urllib2.urlopen(r)
-	    return int(u.headers['Content-Length'])
-	return None
+        """Get the album cover size, if it is known. With true file sizes,
+        it is looked up in the background the first time."""
+        url = self.get_cover_url()
+        size = self.library.sizes.get(url)
+        if size is None and self.library.true_file_size:
+            self.library.sizes.probe(
+                url, lambda refresh=False: url,
+                lambda size: self.library.set_cover_size(self, size))
+        return size
 	    
     def get_year(self):
         """Get the year of the album.
@@ -105,7 +191,7 @@ class Album(object):
         among them"""
         years = {} # year -> count
         for track in self.get_tracks():
-            y = track.get('year', None)
+            y = track.year
             if y:
                 count = years.get(y, 0)
                 years[y] = count + 1
@@ -120,29 +206,376 @@ class Album(object):
     def __repr__(self):
         return u'<Album \'{title}\'>'.format(title=self.normtitle)
 
+def album_dirname(album):
+    return u'{year:04d} - {name}'.format(year=album.get_year(), name=album.normtitle)
+
+def inode(kind, *keys):
+    """Get a stable inode number for a file, from its kind and what
+    identifies it. Inode 1 is the root directory.
+
+    >>> inode('track', u'id', '1') == inode('track', u'id', '1')
+    True
+    >>> inode('track', u'id', '1') == inode('track', u'id', '2')
+    False
+    """
+    digest = hashlib.md5(u'\0'.join((kind,) + keys).encode('utf-8')).digest()
+    return (struct.unpack('<Q', digest[:8])[0] >> 2) + 2
+
+def track_inode(track):
+    # A track changed on the server gets a new inode, so the kernel does
+    # not serve it from the pages cached for the old one:
+    return inode('track', track.id, str(track.modified))
+
+def cover_inode(album):
+    # Likewise for a new cover image of the album:
+    return inode('cover', album.key, album.get_cover_url())
+
+def dir_stat(ino, mtime=0):
+    # By default, make the date really old, so that cp -u works correctly.
+    # Directories get the time of the last library refresh that changed them.
+    return {
+        'st_ino' : ino,
+        'st_mode' : (S_IFDIR | 0755),
+        'st_nlink' : 2,
+        'st_ctime' : mtime, 'st_mtime' : mtime, 'st_atime' : mtime }
+
+def track_stat(track, header_size=0):
+    return {
+        'st_ino' : track_inode(track),
+        'st_mode' : (S_IFREG | 0444),
+        'st_size' : header_size + (track.estimated_size if track.size is None
+                                   else track.size + ID3V1_TRAILER_SIZE),
+        'st_ctime' : track.created,
+        'st_mtime' : track.created,
+        'st_atime' : track.recent}
+
+def cover_stat(album, size):
+    if size is None:
+        size = 10000000
+    return {
+        'st_ino' : cover_inode(album),
+        'st_mode' : (S_IFREG | 0444),
+        'st_size' : size }
+
+class Node(object):
+    """An entry in the path index: a directory (with its listing),
+    a track or an album cover. The stat of files is None until it is
+    first needed."""
+    __slots__ = ('st', 'entries', 'album', 'track')
+
+    def __init__(self, st, entries=None, album=None, track=None):
+        self.st = st
+        self.entries = entries
+        self.album = album
+        self.track = track
+
+    def is_dir(self):
+        return self.entries is not None
+
 class MusicLibrary(object):
     'Read information about your Google Music library'
 
     def __init__(self, username=None, password=None,
-                 true_file_size=False, scan=True, verbose=0):
+                 true_file_size=False, scan=True, verbose=0, api=None,
+                 snapshot_path=None, sizes_path=None, tagger=None,
+                 background_scan=False, background_login=False, cache=None):
         self.verbose = False
         if verbose > 1:
             self.verbose = True
 
-        self.__login_and_setup(username, password)
+        self.username = None
+        self.login_error = None
+        self.__logged_in = threading.Event()
+        self.__credentials = None # Waiting for the background login
+        if api is None:
+            username, password = self.__get_credentials(username, password)
+            api = GoogleMusicBackend(debug_logging=self.verbose)
+        elif not username:
+            # An already logged in backend.Backend (used by the benchmarks)
+            self.__logged_in.set()
+        self.api = api
+        if not self.__logged_in.is_set():
+            self.username = username
+            if background_login:
+                # Logged in by the pending scan, so that the filesystem
+                # can be mounted first:
+                self.__credentials = (username, password)
+                background_scan = True
+            else:
+                self.__login(username, password)
 
-        self.__artists = {} # 'artist name' -> {'album name' : Album(), ...}
-        self.__albums = [] # [Album(), ...]
-        if scan:
-            self.rescan()
         self.true_file_size = true_file_size
+        self.snapshot_path = snapshot_path
+        self.tagger = tagger
+        self.cache = cache
+        self.sizes = SizeProber(sizes_path)
+        self.stream_urls = StreamUrlCache(self.__get_stream_url)
+        self.__lock = threading.Lock() # Serializes changes to the model
+        self.__refresh_stop = threading.Event()
+        self.__scan = None # Background scan waiting for start_scan()
+        self.loading = False # A scan is filling the library
+        self.scan_error = None
+        self.__scan_start = self.__scan_end = None
+        self.__load([])
+
+        tracks = None
+        if snapshot_path:
+            start = time.time()
+            tracks = snapshot.load(snapshot_path, self.username)
+        if tracks is not None:
+            # Serve the last known library right away, and catch up with
+            # the server in the background:
+            with snapshot.gc_paused():
+                self.__load(tracks)
+            log.info('Library snapshot loaded in %.2fs.' % (time.time() - start))
+            if scan:
+                self.__scan = self.__background_refresh
+        elif scan and background_scan:
+            # Serve the library while it is being filled:
+            self.loading = True
+            self.__scan = self.__background_rescan
+        elif scan:
+            self.rescan()
+        if self.__credentials is not None:
+            scan = self.__scan
+            self.__scan = lambda: self.__background_login(scan)
+        if not background_scan:
+            self.start_scan()
+
+    def start_scan(self):
+        """Start the pending scan of the library in the background, if
+        any. With background_scan, it is left to the caller to start it,
+        once the process will not fork anymore."""
+        scan, self.__scan = self.__scan, None
+        if scan is not None:
+            t = threading.Thread(target=scan, name='scan')
+            t.daemon = True
+            t.start()
 
     def rescan(self):
-        self.__artists = {} # 'artist name' -> {'album name' : Album(), ...}
-        self.__albums = [] # [Album(), ...]
-        self.__aggregate_albums()
+        """Get all the tracks in the library and rebuild the model. The
+        tracks are added page by page, as they arrive, so the library can
+        be served from other threads while this runs."""
+        log.info('Gathering track information...')
+        self.loading = True
+        self.__scan_start = time.time()
+        tracks = []
+        try:
+            self.__load([])
+            for page in self.__get_track_pages():
+                self.__add_tracks(page)
+                tracks.extend(page)
+        finally:
+            self.loading = False
+            self.__scan_end = time.time()
+        log.info('%d tracks loaded in %.2fs.' % (
+            len(tracks), self.__scan_end - self.__scan_start))
+        self.__save_snapshot(tracks)
+
+    def __add_tracks(self, tracks):
+        'Add new tracks to the model and index their albums'
+        with self.__lock:
+            dirty = set()
+            for track in tracks:
+                if track.id in self.__tracks:
+                    continue
+                self.__tracks[track.id] = track
+                dirty.add(self.__add_track(track, self.__artists, self.__album_keys))
+            self.__reindex_albums(dirty)
+
+    def status(self):
+        'Get the state of the library, as (name, value) pairs'
+        state = 'loading' if self.loading else 'ready'
+        if not self.__logged_in.is_set():
+            state = 'login'
+        error = self.login_error or self.scan_error
+        if error is not None:
+            state = 'error'
+        status = [('state', state), ('tracks', len(self.__tracks)),
+                  ('artists', len(self.__artists)),
+                  ('albums', len(self.__album_keys))]
+        if self.__scan_start is not None:
+            end = self.__scan_end or time.time()
+            status.append(('scan_seconds', '%.1f' % (end - self.__scan_start)))
+        if error is not None:
+            status.append(('error', error))
+        return status
+
+    def refresh(self):
+        """Get all the tracks in the library and apply the differences
+        with the current model in place. Returns True if anything changed.
+
+        Tracks are compared by id and lastModifiedTimestamp. Only the
+        albums that gained, lost or changed tracks are indexed again, and
+        only the directories whose listing changed get a new mtime. What
+        was cached about the content of removed and changed tracks is
+        dropped, so that the new content is read.
 
-    def __login_and_setup(self, username=None, password=None):
+        >>> import shutil
+        >>> from backend import FakeBackend
+        >>> d = tempfile.mkdtemp()
+        >>> cache = BlockCache(d, 1024**2)
+        >>> backend = FakeBackend(2)
+        >>> library = MusicLibrary(api=backend, cache=cache)
+        >>> track = library.get_albums()[0].get_tracks()[0]
+        >>> cache.put(track.id, 0, 'old')
+        >>> cache.set_length(track.id, 3)
+        >>> library.sizes.set(track.id, 3)
+        >>> library.refresh()
+        False
+        >>> backend.change_track(track.id, 500000)
+        >>> library.refresh()
+        True
+        >>> cache.get(track.id, 0), cache.get_length(track.id)
+        (None, None)
+        >>> library.sizes.get(track.id) is None
+        True
+        >>> url = library.stream_urls.get(track.id)
+        >>> backend.change_track(track.id, 400000)
+        >>> library.refresh()
+        True
+        >>> url = library.stream_urls.get(track.id)
+        >>> library.stream_urls.hits, library.stream_urls.misses
+        (0, 2)
+        >>> shutil.rmtree(d)
+        """
+        log.info('Refreshing track information...')
+        tracks = self.__get_tracks()
+        with self.__lock:
+            old = self.__tracks
+            new = dict((t.id, t) for t in tracks)
+            changed = set(i for i in old if i in new and
+                          old[i].modified != new[i].modified)
+            removed = [old[i] for i in old if i not in new or i in changed]
+            added = [new[i] for i in new if i not in old or i in changed]
+            if not removed and not added:
+                log.info('Library is up to date.')
+                return False
+            dirty = set()
+            for track in removed:
+                album = self.__album_keys[track.album_key]
+                album.remove_track(track.id)
+                dirty.add(album)
+                self.__forget(track)
+            for track in added:
+                dirty.add(self.__add_track(track, self.__artists, self.__album_keys))
+            self.__tracks = new
+            self.__reindex_albums(dirty)
+        log.info('Library refreshed: %d added, %d removed, %d changed tracks.' % (
+            len(added) - len(changed), len(removed) - len(changed), len(changed)))
+        self.__save_snapshot(tracks)
+        return True
+
+    def __forget(self, track):
+        'Drop what is cached about the content of a track'
+        self.sizes.forget(track.id)
+        self.stream_urls.invalidate(track.id)
+        if self.cache is not None:
+            self.cache.forget(track.id)
+        if self.tagger is not None:
+            self.tagger.forget(track.id)
+
+    def __get_tracks(self):
+        'Get all the tracks of the library, as Track records'
+        tracks = []
+        for page in self.__get_track_pages():
+            tracks.extend(page)
+        return tracks
+
+    def __get_track_pages(self):
+        'Get the tracks of the library as lists of Track records, page by page'
+        self.__wait_login()
+        pages = self.api.get_all_songs(incremental=True)
+        while True:
+            start = time.time()
+            try:
+                # Not tried again on errors, the pages would be out of step:
+                with scheduler.scheduler.slot():
+                    page = next(pages, None)
+            finally:
+                API_SECONDS.observe(time.time() - start, ('get_all_songs',))
+            if page is None:
+                return
+            # Replaced one by one, so that the memory of each dict can be
+            # used again for the records that follow:
+            for i, t in enumerate(page):
+                page[i] = Track.from_dict(t)
+            yield page
+
+    def __get_stream_url(self, track_id):
+        self.__wait_login()
+        start = time.time()
+        try:
+            return scheduler.scheduler.call(self.api.get_stream_url,
+                                            track_id, deviceId)
+        finally:
+            API_SECONDS.observe(time.time() - start, ('get_stream_url',))
+
+    def __background_refresh(self):
+        scheduler.set_priority(scheduler.BACKGROUND)
+        try:
+            self.refresh()
+        except Exception:
+            log.exception('Could not refresh the library, '
+                          'still serving the snapshot')
+
+    def __background_login(self, scan):
+        'Log in, then run the scan that was waiting for it, if any'
+        try:
+            self.__login(*self.__credentials)
+        except Exception as e:
+            self.login_error = str(e)
+            log.exception('Could not log in')
+            return
+        finally:
+            self.__logged_in.set()
+        if scan is not None:
+            scan()
+
+    def __wait_login(self):
+        'Wait for the background login, if it is still running'
+        if not self.__logged_in.is_set():
+            log.info('Waiting for the login...')
+            if not self.__logged_in.wait(LOGIN_TIMEOUT):
+                raise LoginException('Not logged in after %ds' % LOGIN_TIMEOUT)
+        if self.login_error is not None:
+            raise LoginException('Could not log in: %s' % self.login_error)
+
+    def __background_rescan(self):
+        try:
+            self.rescan()
+        except Exception as e:
+            self.scan_error = str(e)
+            log.exception('Could not load the library')
+
+    def start_refresh(self, interval):
+        'Refresh the library every interval seconds, in the background'
+        def loop():
+            scheduler.set_priority(scheduler.BACKGROUND)
+            while not self.__refresh_stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    log.exception('Could not refresh the library')
+        t = threading.Thread(target=loop, name='refresh-timer')
+        t.daemon = True
+        t.start()
+
+    def __save_snapshot(self, tracks):
+        if self.snapshot_path:
+            snapshot.save(self.snapshot_path, self.username, tracks)
+
+    def __load(self, tracks):
+        # Build the new model on the side and swap it in, so that readers
+        # in other threads always see a complete library:
+        artists, album_keys = self.__aggregate_albums(tracks)
+        index, track_nodes = self.__build_index(artists)
+        with self.__lock:
+            self.__index, self.__track_nodes = index, track_nodes
+            self.__artists, self.__album_keys = artists, album_keys
+            self.__tracks = dict((t.id, t) for t in tracks)
+
+    def __get_credentials(self, username=None, password=None):
         # If credentials are not specified, get them from $HOME/.gmusicfs
         if not username or not password:
             cred_path = os.path.join(os.path.expanduser('~'), '.gmusicfs')
@@ -170,213 +603,1160 @@ class MusicLibrary(object):
                 raise NoCredentialException(
                     'No deviceId could be read from config file'
                     ': %s' % cred_path)
+        return username, password
 
-        self.api = GoogleMusicAPI(debug_logging=self.verbose)
+    def __login(self, username, password):
         log.info('Logging in...')
-        self.api.login(username, password)
+        if not self.api.login(username, password):
+            raise LoginException('Login failed for %s' % username)
+        self.__logged_in.set()
         log.info('Login successful.')
 
-    def __aggregate_albums(self):
-        'Get all the tracks in the library, parse into artist and album dicts'
-        all_artist_albums = {} # 'Artist|||Album' -> Album()
-        log.info('Gathering track information...')
-        tracks = self.api.get_all_songs()
+    def __aggregate_albums(self, tracks):
+        'Parse the tracks of the library into artist and album dicts'
+        artists = {} # 'artist name' -> {'album name' : Album(), ...}
+        album_keys = {} # 'Artist|||Album' -> Album()
         for track in tracks:
-            # Prefer the album artist over the track artist if there is one:
-            artist = formatNames(track['albumArtist'].lower())
-            if artist.strip() == '':
-                artist = formatNames(track['artist'].lower())
-            # Get the Album object if it already exists:
-            key = '%s|||%s' % (formatNames(artist), formatNames(track['album'].lower()))
-            album = all_artist_albums.get(key, None)
-            if not album:
-                # New Album
-                if artist == '':
-                    artist = 'unknown'
-                album = all_artist_albums[key] = Album(
-                    self, formatNames(track['album'].lower()))
-                self.__albums.append(album)
-                artist_albums = self.__artists.get(artist, None)
-                if artist_albums:
-                    artist_albums[formatNames(album.normtitle)] = album
-                else:
-                    self.__artists[artist] = {album.normtitle: album}
-                    artist_albums = self.__artists[artist]
-            album.add_track(track)
+            self.__add_track(track, artists, album_keys)
         log.debug('%d tracks loaded.' % len(tracks))
-        log.debug('%d artists loaded.' % len(self.__artists))
-        log.debug('%d albums loaded.' % len(self.__albums))
+        log.debug('%d artists loaded.' % len(artists))
+        log.debug('%d albums loaded.' % len(album_keys))
+        return artists, album_keys
+
+    def __add_track(self, track, artists, album_keys):
+        'Add a track to the artist and album dicts, returns its Album'
+        key = track.album_key
+        album = album_keys.get(key, None)
+        if not album:
+            # New Album
+            artist = key.split('|||')[0]
+            if artist == '':
+                artist = 'unknown'
+            album = album_keys[key] = Album(
+                self, formatNames(track.album.lower()), artist, key)
+            artist_albums = artists.get(artist, None)
+            if artist_albums:
+                artist_albums[formatNames(album.normtitle)] = album
+            else:
+                artists[artist] = {album.normtitle: album}
+        if self.true_file_size and track.size is None:
+            track.size = self.sizes.get(track.id)
+        album.add_track(track)
+        return album
+
+    def __build_index(self, artists):
+        """Build the path -> Node index of the whole filesystem, and the
+        track id -> Node map used to update track sizes"""
+        index = {}
+        track_nodes = {}
+        artist_names = sorted(artists.keys())
+        index[u'/'] = Node(dir_stat(1), ['.', '..', 'artists'])
+        index[u'/artists'] = Node(dir_stat(inode('dir', u'/artists')),
+                                  ['.', '..'] + artist_names)
+        for artist in artist_names:
+            artist_path = u'/artists/' + artist
+            artist_node = index[artist_path] = Node(
+                dir_stat(inode('artist', artist)), ['.', '..'])
+            for album in artists[artist].itervalues():
+                artist_node.entries.append(
+                    self.__index_album(index, track_nodes, album))
+        return index, track_nodes
+
+    def __index_album(self, index, track_nodes, album, mtime=0):
+        'Add an album directory and its files to the index, returns its name'
+        dirname = album_dirname(album)
+        album.path = u'/artists/%s/%s' % (album.artist, dirname)
+        album_node = index[album.path] = Node(
+            dir_stat(inode('album', album.key), mtime), ['.', '..'], album=album)
+        for track in album.get_tracks():
+            filename = track.filename
+            path = album.path + u'/' + filename
+            if path in index:
+                continue
+            album_node.entries.append(filename)
+            # The stat is made the first time it is needed:
+            node = index[path] = Node(None, album=album, track=track)
+            track_nodes[track.id] = node
+        if album.get_cover_url():
+            album_node.entries.append('cover.jpg')
+            # The size is filled in the first time it is needed:
+            index[album.path + u'/cover.jpg'] = Node(None, album=album)
+        return dirname
+
+    def __reindex_albums(self, albums):
+        """Index the given albums again after their tracks have changed.
+        Called with the model lock held.
+
+        The new entries are built aside and then swapped into the live
+        index, directory listings are replaced rather than modified, so
+        readers never need to take the lock."""
+        now = int(time.time())
+        index, track_nodes = self.__index, self.__track_nodes
+        artists = set()
+        for album in albums:
+            old_path = album.path
+            stale = set()
+            if old_path is not None:
+                stale.add(old_path)
+                stale.update(old_path + u'/' + f
+                             for f in index[old_path].entries[2:])
+            new_index, new_track_nodes = {}, {}
+            if album.get_tracks():
+                self.__index_album(new_index, new_track_nodes, album, now)
+            else:
+                # The album is gone:
+                del self.__album_keys[album.key]
+                del self.__artists[album.artist][album.normtitle]
+                album.path = None
+            index.update(new_index)
+            track_nodes.update(new_track_nodes)
+            for path in stale.difference(new_index):
+                node = index.pop(path, None)
+                if node is not None and node.track is not None and \
+                   track_nodes.get(node.track.id) is node:
+                    del track_nodes[node.track.id]
+            if album.path != old_path:
+                artists.add(album.artist)
+        artists_changed = False
+        for artist in artists:
+            artist_path = u'/artists/' + artist
+            if self.__artists.get(artist):
+                if artist_path not in index:
+                    artists_changed = True
+                index[artist_path] = Node(dir_stat(inode('artist', artist), now), ['.', '..'] + [
+                    a.path.rsplit(u'/', 1)[1]
+                    for a in self.__artists[artist].itervalues()])
+            else:
+                self.__artists.pop(artist, None)
+                index.pop(artist_path, None)
+                artists_changed = True
+        if artists_changed:
+            index[u'/artists'] = Node(dir_stat(inode('dir', u'/artists'), now), ['.', '..'] +
+                                      sorted(self.__artists.keys()))
+
+    def lookup(self, path):
+        'Get the Node for a path, or None if there is no such file'
+        return self.__index.get(path)
+
+    def set_track_size(self, track, size):
+        'Update the size of a track once its true size is known'
+        track.size = size
+        node = self.__track_nodes.get(track.id)
+        if node is not None:
+            node.st = self.track_stat(track, node.album)
+
+    def track_stat(self, track, album):
+        'Get the stat dict of a track, counting the ID3v2 header if any'
+        header_size = 0
+        if self.tagger is not None:
+            header_size = self.tagger.size(track, album.get_cover_url())
+        return track_stat(track, header_size)
+
+    def set_cover_size(self, album, size):
+        'Update the size of an album cover once its true size is known'
+        node = self.__index.get(album.path + u'/cover.jpg')
+        if node is not None:
+            node.st = cover_stat(album, size)
 
     def get_artists(self):
         return self.__artists
 
     def get_albums(self):
-        return self.__albums
+        return self.__album_keys.values()
 
     def get_artist_albums(self, artist):
         log.debug(artist)
         return self.__artists[artist]
 
     def cleanup(self):
+        self.__refresh_stop.set()
+        self.sizes.save()
+
+class SegmentWorkers(object):
+    """Threads shared by every SegmentedDownload, which open the Range
+    requests of the segments ahead of their readers, in the order they
+    were asked for. At most limit segments opened by them wait for their
+    reader at once, over all the downloads. Segment data is read by the
+    httppool loop into the response buffers, so it counts against the
+    BUFFER_BUDGET of the pool like any other stream.
+
+    The threads start with the first segment, and again in a child
+    process after a fork."""
+    def __init__(self, workers=SEGMENTS, limit=None):
+        self.workers = workers
+        self.limit = limit or 2 * workers
+        self.cond = threading.Condition()
+        self.opened = 0 # Segments opened and not taken by their reader yet
+        self.__queue = collections.deque() # (download, segment)
+        self.__pid = None
+        self.__closed = False
+
+    def submit(self, download, segment):
+        with self.cond:
+            if self.__pid != os.getpid():
+                self.__pid = os.getpid()
+                self.__queue.clear()
+                self.opened = 0
+                for i in range(self.workers):
+                    t = threading.Thread(target=self.__work, name='segment-%d' % i)
+                    t.daemon = True
+                    t.start()
+            self.__queue.append((download, segment))
+            self.cond.notify()
+
+    def cancel(self, download, segment):
+        'Take a segment off the queue, returns whether it was still in it'
+        with self.cond:
+            try:
+                self.__queue.remove((download, segment))
+            except ValueError:
+                return False
+            return True
+
+    def release(self):
+        'A segment opened by a worker was taken by its reader, or dropped'
+        with self.cond:
+            self.opened -= 1
+            self.cond.notify()
+
+    def __work(self):
+        while True:
+            with self.cond:
+                while not self.__closed and (
+                      not self.__queue or self.opened >= self.limit):
+                    self.cond.wait()
+                if self.__closed:
+                    return
+                download, segment = self.__queue.popleft()
+                self.opened += 1
+            download.open_segment(segment)
+
+    def close(self):
+        with self.cond:
+            self.__closed = True
+            self.__queue.clear()
+            self.cond.notify_all()
+
+
+class SegmentedDownload(object):
+    """Download a stream from block first_block to its end as Range
+    requests of segment_blocks blocks each, with up to workers.workers of
+    them open at once: the segment being read and the ones after it.
+
+    The requests of the segments ahead are opened by the shared
+    SegmentWorkers, and the one being read by the reader itself if no
+    worker got to it yet. Blocks are read from each response in order;
+    blocks skipped by a read that came out of order are kept until the
+    reader gets past their segment.
+
+    >>> from backend import FakeBackend
+    >>> from fakeserver import StreamServer, stream_bytes
+    >>> server = StreamServer(FakeBackend(1)).start()
+    >>> url = server.url + '/cover/a.jpg' # 50000 bytes
+    >>> workers = SegmentWorkers(2, limit=1)
+    >>> d = SegmentedDownload(lambda refresh=False: url, 1, 50000, 1000,
+    ...                       workers, segment_blocks=4)
+    >>> order = [2, 1, 3, 4, 6, 5, 7, 8, 9, 10, 12, 11]
+    >>> all(d.get_block(b) == stream_bytes(b * 1000, (b + 1) * 1000)
+    ...     for b in order)
+    True
+    >>> d.get_block(3) is None, d.get_block(40) is None
+    (True, True)
+    >>> d.close(); time.sleep(0.1); workers.opened
+    0
+    >>> server.requests['GET'] <= 4
+    True
+    >>> workers.close(); server.stop()
+    """
+    def __init__(self, get_url, first_block, length, block_size, workers,
+                 segment_blocks=SEGMENT_BLOCKS):
+        self.get_url = get_url
+        self.first_block = first_block
+        self.length = length
+        self.block_size = block_size
+        self.segment_blocks = segment_blocks
+        self.segment_size = segment_blocks * block_size
+        self.workers = workers
+        self.window = workers.workers
+        self.__cond = threading.Condition()
+        # Segment number -> None while opening, then (response, error),
+        # for the segments asked for and not read yet:
+        self.__segments = {}
+        self.__queued = set() # Segments waiting for a worker
+        self.__reading = 0 # Segment being read
+        self.__response = None # Response of the segment being read
+        self.__pos = 0 # Next block of the segment being read
+        self.__skipped = {} # block number -> data
+        self.__closed = False
+        start = first_block * block_size
+        self.__count = (length - start + self.segment_size - 1) // self.segment_size
+        self.__ask(0)
+
+    def __ask(self, segment):
+        # Have the segments from segment to the end of the window opened,
+        # called with the lock held
+        for s in range(segment, min(segment + self.window, self.__count)):
+            if s not in self.__segments:
+                self.__segments[s] = None
+                self.__queued.add(s)
+                self.workers.submit(self, s)
+
+    def __open(self, segment):
+        start = self.first_block * self.block_size + segment * self.segment_size
+        end = min(start + self.segment_size, self.length)
+        STREAM_OPENS.inc()
+        u = urls.urlopen(self.get_url,
+                         {'Range': 'bytes=%d-%d' % (start, end - 1)},
+                         buffer_size=end - start)
+        if u.getcode() != 206:
+            u.close()
+            raise IOError('Range request ignored by the server')
+        return u
+
+    def open_segment(self, segment):
+        'Open a segment ahead of the reader, from a worker thread'
+        with self.__cond:
+            self.__queued.discard(segment)
+            wanted = not self.__closed and segment in self.__segments
+        u = error = None
+        if wanted:
+            try:
+                u = self.__open(segment)
+            except Exception as e:
+                error = e
+        with self.__cond:
+            if self.__closed or segment not in self.__segments:
+                wanted = False
+            else:
+                self.__segments[segment] = (u, error)
+                self.__cond.notify_all()
+        if not wanted:
+            if u is not None:
+                u.close()
+            self.workers.release()
+
+    def __take(self, segment):
+        # Get the response of a segment to read it, called with the lock held
+        if segment in self.__queued and self.workers.cancel(self, segment):
+            # No worker got to it, open it from here:
+            self.__queued.discard(segment)
+            del self.__segments[segment]
+            self.__cond.release()
+            try:
+                return self.__open(segment)
+            finally:
+                self.__cond.acquire()
+        while self.__segments[segment] is None:
+            self.__cond.wait()
+        u, error = self.__segments.pop(segment)
+        self.workers.release()
+        if error is not None:
+            raise error
+        return u
+
+    def get_block(self, block):
+        """Get a block, waiting for its segment if needed. Returns None if
+        the block is not in the part of the stream being downloaded."""
+        segment, index = divmod(block - self.first_block, self.segment_blocks)
+        with self.__cond:
+            if block in self.__skipped:
+                return self.__skipped.pop(block)
+            if block < self.first_block or segment < self.__reading or \
+               (segment == self.__reading and index < self.__pos) or \
+               segment >= self.__reading + self.window or \
+               segment >= self.__count:
+                return None
+            while self.__reading < segment or self.__response is None:
+                if self.__response is not None:
+                    self.__next_segment(segment)
+                self.__ask(self.__reading)
+                self.__response = self.__take(self.__reading)
+            while self.__pos < index:
+                self.__skip()
+            return self.__read_block()
+
+    def __block(self, index):
+        # Block number of a block of the segment being read
+        return self.first_block + self.__reading * self.segment_blocks + index
+
+    def __next_segment(self, segment):
+        # Go on to the next segment on the way to segment
+        first = self.__block(0)
+        self.__skipped = dict((b, data) for b, data in self.__skipped.iteritems()
+                              if b >= first)
+        if segment == self.__reading + 1:
+            # Keep the end of this segment, for reads that come after the
+            # one that got ahead:
+            while self.__pos < self.segment_blocks:
+                self.__skip()
+        self.__response.close()
+        self.__response = None
+        self.__reading += 1
+        self.__pos = 0
+
+    def __skip(self):
+        block = self.__block(self.__pos)
+        self.__skipped[block] = self.__read_block()
+
+    def __read_block(self):
+        self.__pos += 1
+        data = []
+        size = self.block_size
+        while size > 0:
+            chunk = self.__response.read(size)
+            if not chunk:
+                break
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def close(self):
+        with self.__cond:
+            self.__closed = True
+            for segment in list(self.__queued):
+                if self.workers.cancel(self, segment):
+                    self.__segments.pop(segment)
+            self.__queued.clear()
+            opened = [s for s in self.__segments.values() if s is not None]
+            self.__segments.clear()
+            self.__skipped.clear()
+            if self.__response is not None:
+                self.__response.close()
+                self.__response = None
+        for u, error in opened:
+            if u is not None:
+                u.close()
+            self.workers.release()
+
+
+class Prefetch(object):
+    'A stream opened ahead of time, ready once its connection is made'
+    def __init__(self, key):
+        self.key = key
+        self.time = time.time()
+        self.ready = threading.Event()
+        self.upstream = None # The response
+        self.dropped = False
+
+
+class Prefetcher(object):
+    """Open the streams of the tracks that follow the ones being played.
+
+    prefetch(album, track) resolves the stream URL of the next track of
+    the album, opens its stream and buffers its start, from a background
+    thread. A StreamFile opening that track from its start then takes the
+    open stream with take() instead of opening one. Tracks whose start is
+    in the cache are left alone, their URL is only resolved if they are
+    read past it."""
+    def __init__(self, cache=None, size=PREFETCH_SIZE):
+        self.cache = cache
+        self.size = size
+        self.lock = threading.Lock()
+        self.__prefetches = collections.OrderedDict() # track id -> Prefetch
+
+    def prefetch(self, album, track):
+        'Prefetch the track after track in album, if any'
+        tracks = album.get_tracks()
+        ids = [t.id for t in tracks]
+        if track.id not in ids or ids.index(track.id) + 1 >= len(tracks):
+            return
+        following = tracks[ids.index(track.id) + 1]
+        with self.lock:
+            if following.id in self.__prefetches:
+                return
+            p = self.__prefetches[following.id] = Prefetch(following.id)
+            drop = self.__expire()
+        for old in drop:
+            self.__drop(old)
+        t = threading.Thread(target=self.__run, name='prefetch', args=(
+            p, lambda refresh=False: album.get_track_stream(following, refresh)))
+        t.daemon = True
+        t.start()
+
+    def __expire(self):
+        # Remove the stale and extra prefetches and return them, called
+        # with the lock held:
+        now = time.time()
+        expired = [p for p in self.__prefetches.itervalues()
+                   if now - p.time > PREFETCH_TTL]
+        expired += self.__prefetches.values()[:len(self.__prefetches) -
+                                              MAX_PREFETCHES]
+        for p in expired:
+            self.__prefetches.pop(p.key, None)
+        return expired
+
+    def __run(self, p, get_url):
+        scheduler.set_priority(scheduler.BACKGROUND)
+        try:
+            if self.cache is not None and self.cache.has(p.key, 0):
+                return
+            STREAM_OPENS.inc()
+            u = urls.urlopen(get_url, buffer_size=self.size)
+            with self.lock:
+                p.upstream = u
+                dropped = p.dropped
+            PREFETCHES.inc(('started',))
+            if dropped:
+                self.__drop(p)
+        except Exception as e:
+            log.debug('Could not prefetch %s: %s' % (p.key, e))
+        finally:
+            p.ready.set()
+
+    def take(self, key):
+        """Get the prefetched response of key, waiting for its connection
+        if it is being made, or None"""
+        with self.lock:
+            p = self.__prefetches.pop(key, None)
+        if p is None:
+            return None
+        p.ready.wait(httppool.TIMEOUT)
+        if p.upstream is None:
+            return None
+        if p.upstream.error is not None:
+            self.__drop(p)
+            return None
+        PREFETCHES.inc(('hit',))
+        return p.upstream
+
+    def __drop(self, p):
+        with self.lock:
+            p.dropped = True
+            upstream, p.upstream = p.upstream, None
+        if upstream is not None:
+            upstream.close()
+            PREFETCHES.inc(('wasted',))
+
+    def close(self):
+        with self.lock:
+            prefetches = self.__prefetches.values()
+            self.__prefetches.clear()
+        for p in prefetches:
+            self.__drop(p)
+
+
+class StreamFile(object):
+    """An open file backed by an upstream HTTP stream.
+
+    Reads are served from the block cache where possible. The upstream
+    stream is only opened on the first cache miss, at the offset being
+    read, using a Range request, and every block read from it is stored
+    in the cache on the way through. An optional trailer (the ID3v1 tag
+    for tracks) is appended after the stream.
+
+    A file read sequentially from its start, without pauses between the
+    reads as by cp, is downloaded with several connections at once once
+    it gets past SEQUENTIAL_THRESHOLD, if given the SegmentWorkers shared
+    by the files as segments.
+
+    The stream is taken from prefetcher when it was opened ahead of time.
+    prefetch_next() is called once a run of contiguous reads of the
+    stream, of at least SEQUENTIAL_THRESHOLD (or half of a shorter
+    stream), gets past prefetch_at of it, to prefetch what comes next.
+    Reads of the header or the trailer, and seeks towards the end, do
+    not count.
+
+    Each StreamFile has its own lock, so reads on different handles run
+    in parallel.
+
+    A stream dropped in the middle of a read is reopened once where it
+    stopped:
+
+    >>> from backend import FakeBackend
+    >>> from fakeserver import StreamServer, stream_bytes
+    >>> server = StreamServer(FakeBackend(1)).start()
+    >>> url = server.url + '/cover/a.jpg?drop=20000' # 50000 bytes
+    >>> f = StreamFile('a', lambda refresh=False: url)
+    >>> f.read(50000, 0) == stream_bytes(0, 50000)
+    True
+    >>> server.requests['GET']
+    2
+    >>> f.close(); server.stop()
+    """
+    def __init__(self, key, get_url, cache=None, header='', trailer='',
+                 readahead=0, length=None, segments=None, prefetcher=None,
+                 prefetch_next=None, prefetch_at=PREFETCH_AT):
+        self.lock = threading.Lock()
+        self.key = key
+        self.get_url = get_url
+        self.cache = cache
+        self.header = header
+        self.trailer = trailer
+        self.readahead = readahead
+        self.block_size = cache.block_size if cache is not None else BLOCK_SIZE
+        self.__upstream = None
+        self.__upstream_pos = 0
+        self.__length = cache.get_length(key) if cache is not None else None
+        if self.__length is None:
+            self.__length = length
+        self.__last_block = (None, None) # (block number, data)
+        self.segments = segments
+        self.__download = None # SegmentedDownload
+        self.__sequential = True # All reads so far followed each other
+        self.__next_offset = 0
+        self.__read_end = None # When the last read returned
+        self.__run = None # (start, end) of the contiguous reads of the stream
+        self.prefetcher = prefetcher
+        self.prefetch_next = prefetch_next
+        self.prefetch_at = prefetch_at
+
+    def __open_upstream(self, offset=0):
+        self.__close_upstream()
+        u = None
+        if offset == 0 and self.prefetcher is not None:
+            u = self.prefetcher.take(self.key)
+        if u is None:
+            headers = {}
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+            STREAM_OPENS.inc()
+            try:
+                u = urls.urlopen(self.get_url, headers,
+                                 buffer_size=self.readahead or httppool.BUFFER_SIZE)
+            except urllib2.HTTPError as e:
+                if e.code != 416:
+                    raise
+                # Seeking past the end of the stream, only the length is needed:
+                self.__set_length(e.headers.get('Content-Range'), 0)
+                return
+        self.__upstream_pos = 0
+        if u.getcode() == 206:
+            self.__upstream_pos = offset
+        self.__set_length(u.headers.get('Content-Range'), self.__upstream_pos +
+                          int(u.headers['Content-Length']))
+        self.__upstream = u
+        if self.__upstream_pos < offset:
+            # The server ignored the Range header:
+            self.__skip_upstream(offset)
+
+    def __set_length(self, content_range, default):
+        # Content-Range is 'bytes 100-199/1000' or 'bytes */1000':
+        length = default
+        if content_range and not content_range.endswith('/*'):
+            length = int(content_range.rsplit('/', 1)[1])
+        self.__length = length
+        if self.cache is not None:
+            self.cache.set_length(self.key, length)
+
+    def get_length(self, offset=0):
+        """Get the length of the upstream stream (without the trailer).
+        If it is not known yet, the stream is opened at offset to find out."""
+        if self.__length is None:
+            self.__open_upstream(offset - offset % self.block_size)
+        return self.__length
+
+    def __skip_upstream(self, offset):
+        'Read forward on the open connection up to offset'
+        while self.__upstream_pos < offset:
+            pos = self.__upstream_pos
+            if pos % self.block_size:
+                chunk = self.__read_upstream(self.block_size - pos % self.block_size)
+            else:
+                chunk = self.__read_upstream(min(self.block_size, offset - pos))
+                self.__cache_put(pos // self.block_size, chunk)
+            if not chunk:
+                break
+
+    def __read_upstream(self, size):
+        data = []
+        retried = False
+        while size > 0:
+            try:
+                chunk = self.__upstream.read(size)
+            except (httplib.IncompleteRead, socket.error) as e:
+                # The connection dropped in the middle of the body, go on
+                # from where it stopped with a new one, once:
+                if retried:
+                    raise
+                retried = True
+                log.warning('Stream of %s dropped at %d, reconnecting: %r' % (
+                    self.key, self.__upstream_pos, e))
+                self.__open_upstream(self.__upstream_pos)
+                if self.__upstream is None:
+                    break
+                continue
+            if not chunk:
+                break
+            data.append(chunk)
+            size -= len(chunk)
+            self.__upstream_pos += len(chunk)
+        return ''.join(data)
+
+    def __get_block(self, block):
+        if self.__last_block[0] == block:
+            return self.__last_block[1]
+        data = None
+        if self.cache is not None:
+            data = self.cache.get(self.key, block)
+            CACHE_BLOCKS.inc(('miss' if data is None else 'hit',))
+        if data is None and self.segments is not None:
+            data = self.__get_segmented_block(block)
+            if data is not None:
+                self.__cache_put(block, data)
+        if data is None:
+            offset = block * self.block_size
+            if (self.__upstream is None or self.__upstream_pos > offset or
+                offset - self.__upstream_pos > READ_SKIP_LIMIT):
+                self.__open_upstream(offset)
+            else:
+                self.__skip_upstream(offset)
+            data = ''
+            if self.__upstream is not None:
+                data = self.__read_upstream(self.block_size)
+            self.__cache_put(block, data)
+        self.__last_block = (block, data)
+        return data
+
+    def __get_segmented_block(self, block):
+        offset = block * self.block_size
+        if self.__download is None:
+            if not self.__sequential or offset < SEQUENTIAL_THRESHOLD or \
+               self.__length - offset <= SEGMENT_BLOCKS * self.block_size:
+                return None
+            log.debug('Sequential read of %s, downloading it in segments' % self.key)
+            self.__close_upstream()
+            self.__download = SegmentedDownload(
+                self.get_url, block, self.__length, self.block_size, self.segments)
+        try:
+            data = self.__download.get_block(block)
+        except Exception as e:
+            log.warning('Segmented download of %s failed: %s' % (self.key, e))
+            data = None
+            self.segments = None
+        if data is None:
+            # Not a sequential read anymore
+            self.__download.close()
+            self.__download = None
+        return data
+
+    def __cache_put(self, block, data):
+        # Only whole blocks, or the last block of the stream, are cached:
+        if self.cache is not None and data and (
+            len(data) == self.block_size or
+            block * self.block_size + len(data) == self.__length):
+            self.cache.put(self.key, block, data)
+
+    def __read_stream(self, size, offset):
+        buf = []
+        while size > 0:
+            block, start = divmod(offset, self.block_size)
+            chunk = self.__get_block(block)[start:start + size]
+            if not chunk:
+                break
+            buf.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return ''.join(buf)
+
+    def read(self, size, offset):
+        with self.lock:
+            # Reads may come out of order from a multithreaded mount:
+            if abs(offset - self.__next_offset) > MAX_READ:
+                self.__sequential = False
+            # A player reads at the pace of the playback, a copy asks for
+            # the next read as soon as it got the last one:
+            if self.__read_end is not None and \
+               time.time() - self.__read_end > SEQUENTIAL_GAP:
+                self.__sequential = False
+            self.__next_offset = max(self.__next_offset, offset + size)
+            try:
+                return self.__read(size, offset)
+            finally:
+                self.__read_end = time.time()
+
+    def __read(self, size, offset):
+        buf = ''
+        if offset < len(self.header):
+            buf = self.header[offset:offset + size]
+            size -= len(buf)
+            offset += len(buf)
+            if not size:
+                return buf
+        # From here on, offsets are in the stream:
+        offset -= len(self.header)
+        length = self.get_length(offset)
+        end = offset + size
+        if offset < length:
+            buf += self.__read_stream(min(end, length) - offset, offset)
+            self.__played(offset, min(end, length), length)
+        if end > length and self.trailer:
+            buf += self.trailer[max(offset - length, 0):end - length]
+        return buf
+
+    def __played(self, start, end, length):
+        # Extend the run of contiguous reads, reads may come a little out
+        # of order from a multithreaded mount:
+        run = self.__run
+        if run is None or start < run[0] or start > run[1] + MAX_READ:
+            run = (start, end)
+        else:
+            run = (run[0], max(run[1], end))
+        self.__run = run
+        if self.prefetch_next is not None and \
+           run[1] >= self.prefetch_at * length and \
+           run[1] - run[0] >= min(SEQUENTIAL_THRESHOLD, length // 2):
+            prefetch_next, self.prefetch_next = self.prefetch_next, None
+            prefetch_next()
+
+    def close(self):
+        with self.lock:
+            self.__close_upstream()
+            if self.__download is not None:
+                self.__download.close()
+                self.__download = None
+
+    def __close_upstream(self):
+        if self.__upstream is not None:
+            self.__upstream.close()
+            self.__upstream = None
+
+
+class MemoryFile(object):
+    'An open file with its content in memory'
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size, offset):
+        return self.data[offset:offset + size]
+
+    def close(self):
         pass
 
+
 class GMusicFS(LoggingMixIn, Operations):
     'Google Music Filesystem'
     def __init__(self, path, username=None, password=None,
-                 true_file_size=False, verbose=0, scan_library=True):
+                 true_file_size=False, verbose=0, scan_library=True,
+                 cache_dir=None, cache_size=0, api=None, snapshot_path=None,
+                 refresh_interval=0, sizes_path=None, readahead=READAHEAD_SIZE,
+                 pool_size=httppool.POOL_SIZE, id3v2=False, id3v2_cover=False,
+                 metrics_path=None, metrics_interval=metrics.TEXTFILE_INTERVAL,
+                 pins_path=None, pin_bandwidth=pins.BANDWIDTH, segments=SEGMENTS,
+                 background_scan=False, rate_limit=scheduler.RATE,
+                 max_requests=scheduler.CONCURRENCY, prefetch=True,
+                 prefetch_at=PREFETCH_AT, trace_path=None,
+                 background_login=False):
         Operations.__init__(self)
-        self.artist_dir = re.compile('^/artists/(?P<artist>[^/]+)$')
-        self.artist_album_dir = re.compile(
-            '^/artists/(?P<artist>[^/]+)/(?P<year>[0-9]{4}) - (?P<album>[^/]+)$')
-        self.artist_album_track = re.compile(
-            '^/artists/(?P<artist>[^/]+)/(?P<year>[0-9]{4}) - (?P<album>[^/]+)/(?P<track>[^/]+\.mp3)$')
-        self.artist_album_image = re.compile(
-            '^/artists/(?P<artist>[^/]+)/(?P<year>[0-9]{4}) - (?P<album>[^/]+)/(?P<image>[^/]+\.jpg)$')
+        self.__open_files = {} # fh -> StreamFile or MemoryFile
+        self.__open_files_lock = threading.Lock()
+        self.__fh = itertools.count(1)
+        # Virtual file path -> function returning its content:
+        self.__virtual_files = {STATS_PATH: metrics.registry.render,
+                                STATUS_PATH: self.__render_status}
+        # Content of the virtual files as of their last getattr:
+        self.__virtual_data = {}
 
-        self.__open_files = {} # path -> urllib2_obj
+        self.readahead = readahead
+        self.segments = SegmentWorkers(segments) if segments > 1 else None
+        httppool.pool.maxsize = pool_size
+        scheduler.scheduler.configure(rate=rate_limit, concurrency=max_requests)
+        self.cache = None
+        if cache_size > 0:
+            self.cache = BlockCache(cache_dir or default_cache_dir(), cache_size)
+        self.tagger = None
+        if id3v2:
+            self.tagger = Tagger(self.cache, with_cover=id3v2_cover)
 
         # login to google music and parse the tracks:
         self.library = MusicLibrary(username, password,
-                                    true_file_size=true_file_size, verbose=verbose, scan=scan_library)
+                                    true_file_size=true_file_size, verbose=verbose, scan=scan_library,
+                                    api=api, snapshot_path=snapshot_path,
+                                    sizes_path=sizes_path, tagger=self.tagger,
+                                    background_scan=background_scan,
+                                    background_login=background_login,
+                                    cache=self.cache)
+        self.refresh_interval = refresh_interval
+        # Pinned files are kept in the block cache:
+        self.pinner = None
+        if self.cache is not None:
+            self.pinner = Pinner(self.library, self.cache,
+                                 lambda key, get_url: StreamFile(key, get_url, self.cache),
+                                 pins_path, pin_bandwidth)
+        # The next track of an album is opened while the current one plays:
+        self.prefetcher = Prefetcher(self.cache) if prefetch else None
+        self.prefetch_at = prefetch_at
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.__metrics_stop = None
+        # Every operation is recorded, for gmusicfs-replay:
+        self.trace = None
+        if trace_path:
+            self.trace = TraceWriter(open(trace_path, 'wb'))
         log.info("Filesystem ready : %s" % path)
 
+    def __call__(self, op, *args):
+        start = time.time()
+        code = 0 # Result for the trace: bytes read, or -errno
+        try:
+            result = super(GMusicFS, self).__call__(op, *args)
+            if op == 'read':
+                code = len(result)
+            return result
+        except OSError as e:
+            code = -(e.errno or errno.EIO)
+            OP_ERRORS.inc((op, errno.errorcode.get(e.errno, str(e.errno))))
+            raise
+        except Exception as e:
+            code = -errno.EIO
+            OP_ERRORS.inc((op, type(e).__name__))
+            raise
+        finally:
+            latency = time.time() - start
+            OP_SECONDS.observe(latency, (op,))
+            if self.trace is not None and op not in ('init', 'destroy'):
+                self.__trace(op, args, start, latency, code)
+
+    def __trace(self, op, args, start, latency, code):
+        path = args[0] if args else None
+        name = None
+        offset = size = fh = 0
+        if op == 'read':
+            size, offset, fh = args[1], args[2], args[3].fh
+        elif op in ('open', 'release'):
+            fh = args[1].fh
+        elif op in ('getxattr', 'setxattr', 'removexattr'):
+            name = args[1]
+        self.trace.write(op, path, start, latency, name=name, offset=offset,
+                         size=size, fh=fh, result=code)
+
+    def init(self, path):
+        # Called once mounted, after fuse has forked into the background,
+        # so the background threads are started here:
+        self.library.start_scan()
+        if self.refresh_interval:
+            self.library.start_refresh(self.refresh_interval)
+        if self.pinner is not None:
+            self.pinner.start()
+        if self.metrics_path:
+            self.__metrics_stop = metrics.registry.start_textfile(
+                self.metrics_path, self.metrics_interval)
+
     def cleanup(self):
+        if self.pinner is not None:
+            self.pinner.stop()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.segments is not None:
+            self.segments.close()
         self.library.cleanup()
+        if self.__metrics_stop is not None:
+            self.__metrics_stop.set()
+        if self.metrics_path:
+            metrics.registry.write_textfile(self.metrics_path)
+        if self.cache is not None:
+            self.cache.close()
+        if self.trace is not None:
+            self.trace.close()
+        log.info('HTTP connection pool: %(hits)d hits, %(misses)d misses' %
+                 httppool.pool.stats())
+        httppool.pool.close()
+
+    def __render_status(self):
+        status = self.library.status() + sorted(
+            ('queued_' + name, n)
+            for name, n in scheduler.scheduler.queued().items())
+        return ''.join('%s: %s\n' % item for item in status)
+
+    def __virtual_stat(self, path):
+        if path == STATS_DIR:
+            return dir_stat(inode('dir', path))
+        # Reads stop at the size given here, so the content read after an
+        # open is the one rendered now:
+        data = self.__virtual_data[path] = self.__virtual_files[path]()
+        now = int(time.time())
+        return {'st_ino': inode('virtual', path),
+                'st_mode': (S_IFREG | 0444), 'st_size': len(data),
+                'st_ctime': now, 'st_mtime': now, 'st_atime': now}
 
     def getattr(self, path, fh=None):
         'Get info about a file/dir'
-        artist_dir_m = self.artist_dir.match(path)
-        artist_album_dir_m = self.artist_album_dir.match(path)
-        artist_album_track_m = self.artist_album_track.match(path)
-        artist_album_image_m = self.artist_album_image.match(path)
-
-        # Default to a directory
-        st = {
-            'st_mode' : (S_IFDIR | 0755),
-            'st_nlink' : 2 }
-        date = 0 # Make the date really old, so that cp -u works correctly.
-        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = date
-
-        if path == '/':
-            pass
-        elif path == '/artists':
-            pass
-        elif artist_dir_m:
-            pass
-        elif artist_album_dir_m:
-            pass
-        elif artist_album_track_m:
-            parts = artist_album_track_m.groupdict()
-            album = self.library.get_artists()[
-                parts['artist']][parts['album']]
-            track = album.get_track(parts['track'])
-            st = {
-                'st_mode' : (S_IFREG | 0444),
-                'st_size' : int(track['estimatedSize']),
-                'st_ctime' : int(track['creationTimestamp']) / 1000000,
-                'st_mtime' : int(track['creationTimestamp']) / 1000000,
-                'st_atime' : int(track['recentTimestamp']) / 1000000}
-        elif artist_album_image_m:
-            parts = artist_album_image_m.groupdict()
-            album = self.library.get_artists()[
-                parts['artist']][parts['album']]
-            cover_size = album.get_cover_size()
-            if cover_size is None:
-            	cover_size = 10000000
-            st = {
-                'st_mode' : (S_IFREG | 0444),
-                'st_size' : cover_size }
-        else:
+        node = self.library.lookup(path)
+        if node is None:
+            if path == STATS_DIR or path in self.__virtual_files:
+                return self.__virtual_stat(path)
             raise FuseOSError(ENOENT)
+        if node.st is None and node.track is not None:
+            node.st = self.library.track_stat(node.track, node.album)
+        elif node.st is None:
+            # Album cover, the size is only known once we ask for it:
+            node.st = cover_stat(node.album, node.album.get_cover_size())
+        return node.st
 
-        return st
-
-    def open(self, path, fh):
-        artist_album_track_m = self.artist_album_track.match(path)
-        artist_album_image_m = self.artist_album_image.match(path)
-
-        if artist_album_track_m:
-            parts = artist_album_track_m.groupdict()
-            album = self.library.get_artists()[
-                parts['artist']][parts['album']]
-            track = album.get_track(parts['track'])
-            url = album.get_track_stream(track)
-        elif artist_album_image_m:
-            parts = artist_album_image_m.groupdict()
-            album = self.library.get_artists()[
-                parts['artist']][parts['album']]
+    def getxattr(self, path, name, position=0):
+        node = self.library.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        if name == SIZE_XATTR and not node.is_dir():
+            # The exact size, waiting for it to be looked up if needed:
+            sizes = self.library.sizes
+            if node.track is not None:
+                track, album = node.track, node.album
+                size = sizes.wait(track.id, lambda refresh=False:
+                                  album.get_track_stream(track, refresh))
+                if size is not None:
+                    self.library.set_track_size(track, size)
+                    if self.tagger is not None:
+                        size += self.tagger.size(track, album.get_cover_url())
+                    return str(size + ID3V1_TRAILER_SIZE)
+            else:
+                url = node.album.get_cover_url()
+                size = sizes.wait(url, lambda refresh=False: url)
+                if size is not None:
+                    return str(size)
+        if name == LOADING_XATTR and node.is_dir() and self.library.loading:
+            return '%(tracks)s tracks loaded' % dict(self.library.status())
+        if name in (PIN_XATTR, PROGRESS_XATTR):
+            files = self.__pinned_files(path, node)
+            if files is not None:
+                if name == PIN_XATTR:
+                    return '1'
+                return '%d/%d bytes, %d/%d files' % self.pinner.progress(files)
+        raise FuseOSError(ENODATA)
+
+    def listxattr(self, path):
+        node = self.library.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        attrs = [] if node.is_dir() else [SIZE_XATTR]
+        if node.is_dir() and self.library.loading:
+            attrs.append(LOADING_XATTR)
+        if self.__pinned_files(path, node) is not None:
+            attrs += [PIN_XATTR, PROGRESS_XATTR]
+        return attrs
+
+    def setxattr(self, path, name, value, options, position=0):
+        'Setting user.gmusicfs.pinned on an artist or album directory pins it'
+        node = self.library.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        pin = self.__pin_target(path, node)
+        if name != PIN_XATTR or pin is None or self.pinner is None:
+            raise FuseOSError(ENOTSUP)
+        self.pinner.pin(pin)
+        return 0
+
+    def removexattr(self, path, name):
+        node = self.library.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        pin = self.__pin_target(path, node)
+        if name != PIN_XATTR or pin is None or self.pinner is None or \
+           not self.pinner.unpin(pin):
+            raise FuseOSError(ENODATA)
+        return 0
+
+    def __pin_target(self, path, node):
+        'Get the pin of an artist or album directory, or None'
+        if node.album is not None:
+            return ('album', node.album.key) if node.is_dir() else None
+        parts = path.split(u'/')
+        if len(parts) == 3 and parts[1] == u'artists':
+            return ('artist', parts[2])
+        return None
+
+    def __pinned_files(self, path, node):
+        """Get the pinned files at or under path, as Pinner.files() tuples,
+        or None if path is not pinned"""
+        if self.pinner is None:
+            return None
+        if node.album is not None:
+            if not self.pinner.is_pinned(node.album):
+                return None
+            files = self.pinner.files([node.album])
+            if not node.is_dir():
+                key = node.track.id if node.track is not None \
+                    else node.album.get_cover_url()
+                files = [f for f in files if f[0] == key]
+            return files
+        pin = self.__pin_target(path, node)
+        if pin is None or not self.pinner.has_pin(pin):
+            return None
+        return self.pinner.files(self.library.get_artists().get(pin[1], {}).values())
+
+    def open(self, path, fi):
+        # The filesystem is mounted with raw_fi, so that the kernel can be
+        # told how to cache each file.
+        if fi.flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(EROFS)
+        node = self.library.lookup(path)
+        if node is None and path in self.__virtual_files:
+            data = self.__virtual_data.pop(path, None)
+            if data is None:
+                data = self.__virtual_files[path]()
+            # The content changes all the time, never cache it:
+            fi.direct_io = 1
+            fi.fh = self.__add_open_file(MemoryFile(data))
+            return 0
+        if node is None or node.is_dir():
+            raise FuseOSError(ENOENT)
+
+        album, track = node.album, node.track
+        if track is not None:
+            header = ''
+            if self.tagger is not None:
+                header = self.tagger.header(track, album.get_cover_url())
+            prefetch_next = None
+            if self.prefetcher is not None:
+                prefetch_next = lambda: self.prefetcher.prefetch(album, track)
+                if self.prefetch_at <= 0:
+                    prefetch_next()
+                    prefetch_next = None
+            f = StreamFile(track.id, lambda refresh=False:
+                           album.get_track_stream(track, refresh),
+                           self.cache, header=header, trailer=id3v1(track),
+                           readahead=self.readahead,
+                           length=self.library.sizes.get(track.id),
+                           segments=self.segments, prefetcher=self.prefetcher,
+                           prefetch_next=prefetch_next,
+                           prefetch_at=self.prefetch_at)
+        else:
             url = album.get_cover_url()
+            f = StreamFile(url, lambda refresh=False: url, self.cache,
+                           readahead=self.readahead, segments=self.segments)
+        if track is not None and self.tagger is not None:
+            # Without the page cache, the kernel does not read ahead of a
+            # tag scan into the stream, reads are the size asked for:
+            fi.direct_io = 1
         else:
-            RuntimeError('unexpected opening of path: %r' % path)
-
-        u = self.__open_files[fh] = urllib2.urlopen(url)
-        u.bytes_read = 0
+            # The content of an inode never changes, keep the pages the
+            # kernel cached from earlier opens:
+            fi.keep_cache = 1
+        fi.fh = self.__add_open_file(f)
+        return 0
 
+    def __add_open_file(self, f):
+        with self.__open_files_lock:
+            fh = next(self.__fh)
+            self.__open_files[fh] = f
         return fh
 
+    def release(self, path, fi):
+        with self.__open_files_lock:
+            f = self.__open_files.pop(fi.fh, None)
+        if f:
+            f.close()
 
-    def release(self, path, fh):
-        u = self.__open_files.get(fh, None)
-        if u:
-            u.close()
-            del self.__open_files[fh]
-
-    def read(self, path, size, offset, fh):
-        u = self.__open_files.get(fh, None)
-        if u is None:
+    def read(self, path, size, offset, fi):
+        f = self.__open_files.get(fi.fh, None)
+        if f is None:
             raise RuntimeError('unexpected path: %r' % path)
-        artist_album_track_m = self.artist_album_track.match(path)
-        if artist_album_track_m and (int(u.headers['Content-Length']) < (offset + size)):
-            parts = artist_album_track_m.groupdict()
-            album = self.library.get_artists()[
-                parts['artist']][parts['album']]
-            track = album.get_track(parts['track'])
-            # Genre tag is always set to Other as Google MP3 genre tags are not id3v1 id.
-            id3v1 = struct.pack("!3s30s30s30s4s30sb", 'TAG', str(track['title']), str(track['artist']),
-        	                str(track.get('album','')), str(0), str(track.get('comment','')), 12)
-            buf = u.read(size - ID3V1_TRAILER_SIZE) + id3v1
-        else:
-            buf = u.read(size)
-            
-        try:
-            u.bytes_read += size
-        except AttributeError:
-            # Only urllib2 files need this attribute, harmless to
-            # ignore it.
-            pass
+        buf = f.read(size, offset)
+        READ_BYTES.inc(n=len(buf))
         return buf
 
     def readdir(self, path, fh):
-        artist_dir_m = self.artist_dir.match(path)
-        artist_album_dir_m = self.artist_album_dir.match(path)
-        artist_album_track_m = self.artist_album_track.match(path)
-        artist_album_image_m = self.artist_album_image.match(path)
-
-        if path == '/':
-            return ['.', '..', 'artists']
-        elif path == '/artists':
-            return  ['.','..'] + self.library.get_artists().keys()
-        elif artist_dir_m:
-            # Artist directory, lists albums.
-            albums = self.library.get_artist_albums(
-                artist_dir_m.groupdict()['artist'])
-            # Sort albums by year:
-            album_dirs = [u'{year:04d} - {name}'.format(
-                year=a.get_year(), name=formatNames(a.normtitle)) for a in albums.values()]
-            return ['.','..'] + album_dirs
-        elif artist_album_dir_m:
-            # Album directory, lists tracks.
-            parts = artist_album_dir_m.groupdict()
-            album = self.library.get_artists()[
-                parts['artist']][parts['album']]
-            files = ['.','..']
-            for track in album.get_tracks(get_size=True):
-                files.append('%03d - %s.mp3' % (track['trackNumber'], formatNames(track['title'].lower())))
-            # Include cover image:
-            cover = album.get_cover_url()
-            if cover:
-                files.append('cover.jpg')
-            return files
+        if path == STATS_DIR:
+            return ['.', '..'] + [p.rsplit(u'/', 1)[1]
+                                  for p in self.__virtual_files]
+        node = self.library.lookup(path)
+        if node is None or not node.is_dir():
+            raise FuseOSError(ENOENT)
+        if node.album is not None:
+            # Album directory, fill in the true size of the tracks:
+            node.album.get_tracks(get_size=True)
+        if path == u'/':
+            return node.entries + [STATS_DIR[1:]]
+        return node.entries
 
 
 def getDeviceId(verbose=False):
@@ -400,6 +1780,8 @@ def getDeviceId(verbose=False):
             'No username/password could be read from config file'
             ': %s' % cred_path)
 
+    # Imported here, so that the other commands don't wait for gmusicapi:
+    from gmusicapi import Webclient as GoogleMusicWebAPI
     api = GoogleMusicWebAPI(debug_logging=verbose)
     log.info('Logging in...')
     api.login(username, password)
@@ -445,6 +1827,74 @@ def main():
                         action='store_true', dest='nolibrary')
     parser.add_argument('--deviceid', help='Get the device ids bounded to your account',
                         action='store_true', dest='deviceId')
+    parser.add_argument('-m', '--multithreaded', help='Serve filesystem requests'
+                        ' from multiple threads',
+                        action='store_true', dest='multithreaded')
+    parser.add_argument('--cachedir', help='Where to cache track and cover data'
+                        ' (default: %s)' % default_cache_dir(),
+                        dest='cache_dir', default=None)
+    parser.add_argument('--cachesize', help='Size of the cache in MB, 0 disables'
+                        ' it (default: 1024)', type=int,
+                        dest='cache_size', default=1024)
+    parser.add_argument('--readahead', help='Read tracks this many KB ahead of'
+                        ' the player, 0 disables it (default: %d)' % (READAHEAD_SIZE / 1024),
+                        type=int, dest='readahead', default=READAHEAD_SIZE / 1024)
+    parser.add_argument('--segments', help='Download files that are read from'
+                        ' start to end, as by cp, over this many connections,'
+                        ' 0 for one (default: %d)' % SEGMENTS,
+                        type=int, dest='segments', default=SEGMENTS)
+    parser.add_argument('--prefetchat', help='Open the next track of the album'
+                        ' once this fraction of a track has been read, 0 for'
+                        ' as soon as it is opened (default: %s)' % PREFETCH_AT,
+                        type=float, dest='prefetch_at', default=PREFETCH_AT)
+    parser.add_argument('--noprefetch', help='Don\'t open the next track of the'
+                        ' album ahead of time', action='store_true',
+                        dest='noprefetch')
+    parser.add_argument('--poolsize', help='Idle HTTP connections to keep open'
+                        ' per host (default: %d)' % httppool.POOL_SIZE,
+                        type=int, dest='pool_size', default=httppool.POOL_SIZE)
+    parser.add_argument('--ratelimit', help='Send at most this many requests'
+                        ' to Google per second, 0 for no limit (default: %d)' % scheduler.RATE,
+                        type=float, dest='rate_limit', default=scheduler.RATE)
+    parser.add_argument('--maxrequests', help='Requests to Google waiting for'
+                        ' their response at the same time (default: %d)' % scheduler.CONCURRENCY,
+                        type=int, dest='max_requests', default=scheduler.CONCURRENCY)
+    parser.add_argument('--id3v2', help='Prepend an ID3v2 tag made from the'
+                        ' library to each track, so that tags are read without'
+                        ' downloading anything',
+                        action='store_true', dest='id3v2')
+    parser.add_argument('--id3v2cover', help='Include the album cover in the'
+                        ' ID3v2 tags, when it is cached (implies --id3v2)',
+                        action='store_true', dest='id3v2_cover')
+    parser.add_argument('--refresh', help='Look for changes in the library every'
+                        ' REFRESH minutes (default: never)', type=int,
+                        dest='refresh', default=0)
+    parser.add_argument('--attrtimeout', help='Seconds the kernel may cache file'
+                        ' attributes (default: %d)' % ATTR_TIMEOUT, type=float,
+                        dest='attr_timeout', default=ATTR_TIMEOUT)
+    parser.add_argument('--entrytimeout', help='Seconds the kernel may cache file'
+                        ' names (default: %d)' % ENTRY_TIMEOUT, type=float,
+                        dest='entry_timeout', default=ENTRY_TIMEOUT)
+    parser.add_argument('--pinbandwidth', help='Download pinned directories at'
+                        ' most this many KB/s, 0 for no limit (default: %d)' % (pins.BANDWIDTH / 1024),
+                        type=int, dest='pin_bandwidth', default=pins.BANDWIDTH / 1024)
+    parser.add_argument('--metricsfile', help='Also write the metrics of'
+                        ' /.gmusicfs/stats to this file, for the node_exporter'
+                        ' textfile collector', dest='metrics_path', default=None)
+    parser.add_argument('--metricsinterval', help='Write the metrics file every'
+                        ' METRICS_INTERVAL seconds (default: %d)' % metrics.TEXTFILE_INTERVAL,
+                        type=int, dest='metrics_interval',
+                        default=metrics.TEXTFILE_INTERVAL)
+    parser.add_argument('--nosnapshot', help='Don\'t save the library to the cache'
+                        ' directory, or load it from there at launch',
+                        action='store_true', dest='nosnapshot')
+    parser.add_argument('--trace', help='Record the filesystem operations to'
+                        ' this file, to be run again with gmusicfs-replay',
+                        dest='trace_path', default=None)
+    parser.add_argument('--backgroundlogin', help='Mount right away and log in'
+                        ' to Google in the background, reads that need Google'
+                        ' wait for the login', action='store_true',
+                        dest='background_login')
 
     args = parser.parse_args()
 
@@ -473,10 +1923,38 @@ def main():
 
 
 
-    fs = GMusicFS(mountpoint, true_file_size=args.true_file_size, verbose=verbosity, scan_library= not args.nolibrary)
+    # The paths must not depend on the working directory, which is / once
+    # daemonized:
+    cache_dir = os.path.abspath(args.cache_dir or default_cache_dir())
+    snapshot_path = None
+    if not args.nosnapshot:
+        snapshot_path = os.path.join(cache_dir, 'library')
+    sizes_path = os.path.join(cache_dir, 'sizes')
+    pins_path = os.path.join(cache_dir, 'pins')
+    metrics_path = None
+    if args.metrics_path:
+        metrics_path = os.path.abspath(args.metrics_path)
+
+    fs = GMusicFS(mountpoint, true_file_size=args.true_file_size, verbose=verbosity, scan_library= not args.nolibrary,
+                  cache_dir=cache_dir, cache_size=args.cache_size * 1024**2,
+                  snapshot_path=snapshot_path, refresh_interval=args.refresh * 60,
+                  sizes_path=sizes_path, readahead=args.readahead * 1024,
+                  pool_size=args.pool_size, id3v2=args.id3v2 or args.id3v2_cover,
+                  id3v2_cover=args.id3v2_cover, metrics_path=metrics_path,
+                  metrics_interval=args.metrics_interval, pins_path=pins_path,
+                  pin_bandwidth=args.pin_bandwidth * 1024, segments=args.segments,
+                  background_scan=True, rate_limit=args.rate_limit,
+                  max_requests=args.max_requests, prefetch=not args.noprefetch,
+                  prefetch_at=args.prefetch_at, trace_path=args.trace_path,
+                  background_login=args.background_login)
     try:
+        # Not mounted read-only, so that directories can be pinned with
+        # setxattr. Every operation that would write fails with EROFS.
         fuse = FUSE(fs, mountpoint, foreground=args.foreground,
-                    ro=True, nothreads=True, allow_other=args.allusers)
+                    nothreads=not args.multithreaded, allow_other=args.allusers,
+                    raw_fi=True, use_ino=True, attr_timeout=args.attr_timeout,
+                    entry_timeout=args.entry_timeout, big_writes=True,
+                    max_read=MAX_READ, max_readahead=MAX_READ)
     finally:
         fs.cleanup()
 
@@ -0,0 +1,820 @@
+# Upstream HTTP client for gmusicfs.
+#
+# Stream, cover and HEAD requests all go to a handful of hosts. One event
+# loop thread owns every upstream socket: callers hand it a request and
+# wait for the response headers, and the loop then reads the body into a
+# bounded buffer that the caller reads from. An open stream costs a
+# socket and a buffer, not a thread. Finished connections are kept open
+# per host and used again by the next request, instead of paying for a
+# new TCP (and TLS) connection each time.
+
+import os
+import ssl
+import time
+import errno
+import fcntl
+import select
+import socket
+import urllib2
+import httplib
+import logging
+import urlparse
+import threading
+import collections
+from cStringIO import StringIO
+
+import fifo
+from metrics import registry
+
+log = logging.getLogger('gmusicfs.httppool')
+
+# Idle connections kept per host:
+POOL_SIZE = 8
+TIMEOUT = 30
+MAX_REDIRECTS = 5
+# When a response is closed before its end, read what is left of it if
+# it is at most this many bytes, so that the connection can be used again:
+DRAIN_LIMIT = 64 * 1024
+# Response bodies are read ahead into a buffer of this size by default:
+BUFFER_SIZE = 64 * 1024
+# Once the buffers of all responses hold this many bytes together, each
+# response is only read ahead up to MIN_BUFFER bytes:
+BUFFER_BUDGET = 32 * 1024**2
+MIN_BUFFER = 16 * 1024
+RECV_SIZE = 64 * 1024
+MAX_HEADERS = 64 * 1024
+# Host name lookups are kept this long, in seconds:
+DNS_TTL = 60
+
+REDIRECT_CODES = (301, 302, 303, 307)
+
+REQUEST_SECONDS = registry.histogram(
+    'gmusicfs_upstream_request_seconds',
+    'Time to the response headers of upstream HTTP requests', ('method',))
+REQUEST_ERRORS = registry.counter(
+    'gmusicfs_upstream_errors_total',
+    'Upstream HTTP requests that failed, by status code', ('method', 'code'))
+BYTES_READ = registry.counter(
+    'gmusicfs_upstream_bytes_total', 'Bytes read from upstream responses')
+CONNECTIONS = registry.counter(
+    'gmusicfs_pool_connections_total',
+    'Requests sent on a pooled (hit) or a new (miss) connection', ('result',))
+
+# States of a Connection:
+CONNECTING, HANDSHAKE, SENDING, HEADERS, BODY, DRAINING, IDLE = range(7)
+
+
+class Redirect(object):
+    'Result of a request answered with a redirect, followed by the caller'
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+
+
+class Future(object):
+    'The result of a request, set by the loop thread'
+    def __init__(self):
+        self.__done = threading.Event()
+        self.result = self.error = None
+
+    def done(self):
+        return self.__done.is_set()
+
+    def set(self, result=None, error=None):
+        self.result, self.error = result, error
+        self.__done.set()
+
+    def wait(self):
+        self.__done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Request(object):
+    def __init__(self, method, url, headers, buffer_size):
+        self.method = method
+        self.url = url
+        parts = urlparse.urlsplit(url)
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.key = (parts.scheme, parts.hostname, self.port)
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.headers = headers or {}
+        self.buffer_size = buffer_size
+        self.addr = None # (family, address), looked up by the caller
+        self.start = time.time()
+        self.future = Future()
+
+    def encode(self):
+        scheme, host, port = self.key
+        if port != (443 if scheme == 'https' else 80):
+            host = '%s:%d' % (host, port)
+        lines = ['%s %s HTTP/1.1' % (self.method, self.path), 'Host: ' + host,
+                 'Accept-Encoding: identity']
+        lines += ['%s: %s' % h for h in self.headers.iteritems()]
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+class PooledResponse(object):
+    """A response read by the loop thread. Its body is read ahead into a
+    fifo.Buffer of up to buffer_size bytes, which read() takes from. The
+    connection goes back to the pool once the body has been read to its
+    end, or when the response is closed."""
+    def __init__(self, pool, conn, url, status, reason, headers, buffer_size):
+        self.pool = pool
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.buffer = fifo.Buffer(buffer_size)
+        self.error = None
+        self.paused = False # Set by the loop while the buffer is full
+        self.__conn = conn
+
+    def getcode(self):
+        return self.status
+
+    def read(self, size=None):
+        data = []
+        left = size
+        while left is None or left > 0:
+            chunk = self.buffer.read_some(RECV_SIZE if left is None else left)
+            if self.paused:
+                # There is room again, have the loop read on
+                self.pool.call(self.__conn.resume, self)
+            if not chunk:
+                break
+            data.append(chunk)
+            if left is not None:
+                left -= len(chunk)
+        data = ''.join(data)
+        # What came before an error is returned first, the error is
+        # raised by the next read:
+        if self.error is not None and (size is None or not data):
+            raise self.error
+        return data
+
+    def close(self):
+        if not self.buffer.eof:
+            self.buffer.close()
+            self.pool.call(self.__conn.abandon, self)
+
+
+class Connection(object):
+    """A socket to an upstream host and the request it is serving. Only
+    used from the loop thread."""
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.sock = None
+        self.fd = None
+        self.state = None
+        self.events = 0
+        self.deadline = None
+        self.request = None
+        self.response = None
+        self.pooled = False # Used before, the server may have closed it
+        self.reusable = False
+        self.__out = ''
+        self.__in = bytearray()
+        self.__remaining = None # Body bytes left, None to read to the end
+        self.__chunk = None # Bytes left in the current chunk, when chunked
+        self.__trailer = False
+
+    def connect(self, request):
+        family, address = request.addr
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.fd = self.sock.fileno()
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+        self.state = CONNECTING
+        self.events = select.POLLOUT
+        self.send(request)
+
+    def send(self, request):
+        self.request = request
+        self.response = None
+        self.__out = request.encode()
+        self.__in = bytearray()
+        self.deadline = time.time() + self.pool.timeout
+        if self.state == IDLE:
+            self.state = SENDING
+            self.events = select.POLLOUT
+
+    def handle(self, events):
+        'Make progress after poll() reported events on the socket'
+        if self.state == CONNECTING:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            if self.key[0] == 'https':
+                self.sock = self.pool.ssl_context.wrap_socket(
+                    self.sock, server_hostname=self.key[1],
+                    do_handshake_on_connect=False)
+                self.state = HANDSHAKE
+            else:
+                self.state = SENDING
+        if self.state == HANDSHAKE:
+            done, _ = self.__try(self.sock.do_handshake)
+            if not done:
+                return
+            self.state = SENDING
+        if self.state == SENDING:
+            # SSLSocket.send() returns 0 when it has to wait, write() raises
+            # SSLWantReadError or SSLWantWriteError instead:
+            send = self.sock.write if isinstance(self.sock, ssl.SSLSocket) \
+                else self.sock.send
+            while self.__out:
+                done, n = self.__try(send, self.__out)
+                if not done:
+                    return
+                self.__out = self.__out[n:]
+            self.state = HEADERS
+            self.events = select.POLLIN
+            self.deadline = time.time() + self.pool.timeout
+            return
+        if self.state == IDLE:
+            # Data or the end of the connection from an idle server
+            self.pool.discard(self)
+            return
+        self.receive()
+
+    def __try(self, fn, *args):
+        # Call a socket method, returns (False, None) if it has to wait
+        # for the socket, after asking poll() for what it waits for.
+        try:
+            return True, fn(*args)
+        except ssl.SSLWantReadError:
+            self.events = select.POLLIN
+        except ssl.SSLWantWriteError:
+            self.events = select.POLLOUT
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return False, None
+
+    def room(self):
+        'Bytes the response buffer can take now'
+        if self.state != BODY:
+            return RECV_SIZE
+        buf = self.response.buffer
+        if self.pool.buffered >= self.pool.budget and len(buf) >= MIN_BUFFER:
+            return 0
+        return min(RECV_SIZE, buf.max_size - len(buf))
+
+    def receive(self):
+        room = self.room()
+        if not room:
+            self.pause()
+            return
+        self.events = select.POLLIN
+        try:
+            data = self.sock.recv(room)
+        except ssl.SSLWantReadError:
+            return
+        except ssl.SSLWantWriteError:
+            # Renegotiation
+            self.events = select.POLLOUT
+            return
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            self.__end_of_connection()
+            return
+        if isinstance(self.sock, ssl.SSLSocket) and self.sock.pending():
+            # Decrypted data poll() does not know about
+            self.pool.ready.add(self)
+        self.deadline = time.time() + self.pool.timeout
+        if self.state == HEADERS:
+            self.__in += data
+            self.__parse_headers()
+        else:
+            self.__feed(data)
+
+    def __end_of_connection(self):
+        if self.state in (BODY, DRAINING) and self.__remaining is None and \
+           self.__chunk is None:
+            self.reusable = False
+            self.finish()
+        elif self.state == HEADERS and not self.__in and self.pooled:
+            raise StaleConnection()
+        else:
+            raise httplib.IncompleteRead('')
+
+    def __parse_headers(self):
+        while True:
+            end = self.__in.find('\r\n\r\n')
+            if end < 0:
+                if len(self.__in) > MAX_HEADERS:
+                    raise httplib.LineTooLong('headers')
+                return
+            head = str(self.__in[:end + 2])
+            del self.__in[:end + 4]
+            line, _, head = head.partition('\r\n')
+            try:
+                version, status, reason = (line.split(None, 2) + [''])[:3]
+                status = int(status)
+            except ValueError:
+                raise httplib.BadStatusLine(line)
+            if status >= 200:
+                break
+            # 1xx informational responses come before the real one
+        request = self.request
+        headers = httplib.HTTPMessage(StringIO(head))
+        connection = (headers.get('Connection') or '').lower()
+        if version == 'HTTP/1.1':
+            self.reusable = 'close' not in connection
+        else:
+            self.reusable = 'keep-alive' in connection
+        self.__chunk = self.__remaining = None
+        self.__trailer = False
+        if request.method == 'HEAD' or status in (204, 304):
+            self.__remaining = 0
+        elif 'chunked' in (headers.get('Transfer-Encoding') or '').lower():
+            self.__chunk = 0
+        elif headers.get('Content-Length'):
+            self.__remaining = int(headers['Content-Length'])
+        else:
+            self.reusable = False
+        REQUEST_SECONDS.observe(time.time() - request.start, (request.method,))
+        rest, self.__in = self.__in, bytearray()
+        if status in REDIRECT_CODES and headers.get('Location'):
+            method = 'GET' if status == 303 else request.method
+            request.future.set(Redirect(
+                method, urlparse.urljoin(request.url, headers['Location'])))
+            self.state = DRAINING
+        elif status >= 400:
+            REQUEST_ERRORS.inc((request.method, str(status)))
+            request.future.set(error=urllib2.HTTPError(
+                request.url, status, reason.strip(), headers, StringIO()))
+            self.state = DRAINING
+        else:
+            self.response = PooledResponse(
+                self.pool, self, request.url, status, reason.strip(), headers,
+                request.buffer_size)
+            request.future.set(self.response)
+            self.state = BODY
+        if self.state == DRAINING:
+            self.__drain_or_close()
+        elif self.__remaining == 0:
+            self.finish()
+        if rest and self.state in (BODY, DRAINING):
+            self.__feed(str(rest))
+
+    def __drain_or_close(self):
+        # Read what is left of the body and throw it away if it is short
+        if self.__remaining is not None and self.__remaining <= DRAIN_LIMIT:
+            self.state = DRAINING
+            if self.__remaining == 0:
+                self.finish()
+        else:
+            self.reusable = False
+            self.finish()
+
+    def __feed(self, data):
+        # Take body data, framed by Content-Length or chunked encoding
+        if self.__chunk is None:
+            if self.__remaining is not None:
+                data = data[:self.__remaining]
+                self.__remaining -= len(data)
+            self.__deliver(data)
+            if self.__remaining == 0:
+                self.finish()
+            return
+        self.__in += data
+        while True:
+            if self.__chunk:
+                n = min(self.__chunk, len(self.__in))
+                if not n:
+                    return
+                self.__deliver(str(self.__in[:n]))
+                del self.__in[:n]
+                self.__chunk -= n
+                if self.__chunk:
+                    return
+                self.__chunk = -2 # The line end after the chunk
+            if self.__chunk == -2:
+                if len(self.__in) < 2:
+                    return
+                del self.__in[:2]
+                self.__chunk = 0
+            end = self.__in.find('\r\n')
+            if end < 0:
+                if len(self.__in) > MAX_HEADERS:
+                    raise httplib.LineTooLong('chunk size')
+                return
+            line = str(self.__in[:end])
+            del self.__in[:end + 2]
+            if self.__trailer:
+                if not line:
+                    self.finish()
+                    return
+                continue
+            try:
+                self.__chunk = int(line.split(';', 1)[0], 16)
+            except ValueError:
+                raise httplib.IncompleteRead(line)
+            if not self.__chunk:
+                self.__trailer = True
+
+    def __deliver(self, data):
+        if self.state == BODY and not self.response.buffer.eof:
+            BYTES_READ.inc(n=len(data))
+            self.pool.buffered += len(data)
+            # Never blocks, there is room for what was received:
+            self.response.buffer.write(data)
+
+    def pause(self):
+        # Stop reading until the reader makes room in the buffer. The
+        # reader checks the flag after reading, so check again once it
+        # is set.
+        self.response.paused = True
+        if self.room():
+            self.response.paused = False
+            return
+        self.events = 0
+        self.deadline = None
+        self.pool.update(self)
+
+    def resume(self, response):
+        if self.response is response and self.state == BODY and \
+           response.paused:
+            self.response.paused = False
+            self.events = select.POLLIN
+            self.deadline = time.time() + self.pool.timeout
+            self.pool.update(self)
+            self.pool.ready.add(self)
+
+    def abandon(self, response):
+        'The response was closed before its end'
+        if self.response is response and self.state == BODY:
+            self.response.paused = False
+            self.events = select.POLLIN
+            self.pool.update(self)
+            self.__drain_or_close()
+
+    def finish(self):
+        'The response is over, pool the connection or close it'
+        if self.response is not None:
+            self.response.buffer.close()
+        self.request = self.response = None
+        self.state = IDLE
+        self.events = select.POLLIN
+        self.deadline = None
+        self.pool.release(self)
+
+    def fail(self, error):
+        if self.request is not None and not self.request.future.done():
+            self.request.future.set(error=error)
+        elif self.response is not None:
+            self.response.error = error
+            self.response.buffer.close()
+        self.request = None
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class StaleConnection(Exception):
+    'A pooled connection was closed by the server before it was used'
+
+
+class ConnectionPool(object):
+    """Event loop running all upstream HTTP(S) requests, with at most
+    maxsize idle keep-alive connections per (scheme, host, port).
+
+    request() blocks until the response headers have arrived, and raises
+    urllib2.HTTPError for error statuses, like urllib2.urlopen() does.
+    The loop thread starts with the first request, and again in a child
+    process after a fork.
+
+    >>> from backend import FakeBackend, COVER_SIZE
+    >>> from fakeserver import StreamServer, stream_bytes
+    >>> backend = FakeBackend(1)
+    >>> server = StreamServer(backend).start()
+    >>> cover = server.url + '/cover/a.jpg'
+    >>> pool = ConnectionPool()
+    >>> def get(url, **kwargs):
+    ...     r = pool.request('GET', url, **kwargs)
+    ...     try:
+    ...         return r.read() == stream_bytes(0, COVER_SIZE)
+    ...     finally:
+    ...         r.close()
+    >>> get(cover), get(cover)
+    (True, True)
+    >>> pool.hits, pool.misses, server.connections
+    (1, 1, 1)
+
+    Redirects are followed, and bodies can be chunked, all on the same
+    connection:
+
+    >>> pool.request('HEAD', cover).headers['Content-Length']
+    '50000'
+    >>> get(cover + '?redirect'), get(cover + '?chunked')
+    (True, True)
+    >>> pool.hits, pool.misses, server.connections
+    (5, 1, 1)
+
+    A body read up to the end of the connection, or an error, leave no
+    connection to use again:
+
+    >>> get(cover + '?close'), get(cover)
+    (True, True)
+    >>> pool.request('GET', server.url + '/missing')
+    Traceback (most recent call last):
+    ...
+    HTTPError: HTTP Error 404: Not Found
+    >>> get(cover)
+    True
+    >>> pool.hits, pool.misses, server.connections
+    (7, 3, 3)
+
+    The rest of a response closed early is read and thrown away if it is
+    short, else the connection is closed:
+
+    >>> r = pool.request('GET', cover)
+    >>> len(r.read(1000))
+    1000
+    >>> r.close()
+    >>> while not pool.stats()['idle']:
+    ...     time.sleep(0.01)
+    >>> track_id = backend.get_all_songs()[0]['id']
+    >>> r = pool.request('GET', backend.get_stream_url(track_id))
+    >>> len(r.read(1000))
+    1000
+    >>> r.close()
+    >>> get(cover)
+    True
+    >>> pool.hits, pool.misses, server.connections
+    (9, 4, 4)
+
+    A request on a kept alive connection that the server closes is sent
+    again on a new connection:
+
+    >>> get(cover + '?hangup')
+    True
+    >>> pool.hits, pool.misses, server.connections
+    (10, 5, 5)
+
+    The response buffers are kept within the budget of the pool until
+    they are read:
+
+    >>> small = ConnectionPool(budget=64 * 1024)
+    >>> url = backend.get_stream_url(track_id)
+    >>> size = backend.get_size(urlparse.urlsplit(url).path)
+    >>> responses = [small.request('GET', url, buffer_size=1024**2)
+    ...              for i in range(2)]
+    >>> time.sleep(0.2)
+    >>> sum(len(r.buffer) for r in responses) < 256 * 1024
+    True
+    >>> [r.read() == stream_bytes(0, size) for r in responses]
+    [True, True]
+    >>> small.close(); pool.close(); server.stop()
+    """
+    def __init__(self, maxsize=POOL_SIZE, timeout=TIMEOUT,
+                 budget=BUFFER_BUDGET):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.hits = 0 # Requests sent on a pooled connection
+        self.misses = 0 # Requests that needed a new connection
+        self.buffered = 0 # Bytes in the response buffers, for the loop
+        self.ready = set() # Connections to handle without waiting for poll()
+        self.ssl_context = None
+        self.__pid = None
+        self.__addrs = {} # (host, port) -> (time, family, address)
+
+    def __start(self):
+        # Called with the lock held
+        self.__idle = {} # key -> [Connection, ...]
+        self.__conns = {} # file descriptor -> Connection
+        self.__calls = collections.deque()
+        self.__poll = select.poll()
+        self.__wake_r, self.__wake_w = os.pipe()
+        for fd in (self.__wake_r, self.__wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.__poll.register(self.__wake_r, select.POLLIN)
+        self.__pid = os.getpid()
+        t = threading.Thread(target=self.__run, name='httppool')
+        t.daemon = True
+        t.start()
+
+    def call(self, fn, *args):
+        'Run fn(*args) on the loop thread'
+        with self.lock:
+            if self.__pid != os.getpid():
+                self.__start()
+            self.__calls.append((fn, args))
+            try:
+                os.write(self.__wake_w, 'x')
+            except OSError:
+                pass # Full, the loop is already woken up
+
+    def resolve(self, host, port):
+        'Look up the address of a host, from the calling thread'
+        now = time.time()
+        found = self.__addrs.get((host, port))
+        if found is None or now - found[0] > DNS_TTL:
+            family, _, _, _, address = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM)[0]
+            found = self.__addrs[(host, port)] = (now, family, address)
+        return found[1:]
+
+    def stats(self):
+        with self.lock:
+            if self.__pid != os.getpid():
+                idle = 0
+            else:
+                idle = sum(len(i) for i in self.__idle.itervalues())
+            return {'hits': self.hits, 'misses': self.misses, 'idle': idle}
+
+    def close(self):
+        'Close the idle connections'
+        with self.lock:
+            if self.__pid != os.getpid():
+                return
+        self.call(self.__close_idle)
+
+    def request(self, method, url, headers=None, redirects=MAX_REDIRECTS,
+                buffer_size=BUFFER_SIZE):
+        'Send a request and return a PooledResponse, following redirects'
+        while True:
+            r = Request(method, url, headers, buffer_size)
+            if r.key[0] == 'https' and self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            try:
+                r.addr = self.resolve(r.key[1], r.port)
+            except socket.error:
+                REQUEST_ERRORS.inc((method, 'connection'))
+                raise
+            self.call(self.__send, r)
+            result = r.future.wait()
+            if not isinstance(result, Redirect) or redirects <= 0:
+                break
+            method, url = result.method, result.url
+            redirects -= 1
+        if isinstance(result, Redirect):
+            raise urllib2.HTTPError(url, 310, 'Too many redirects', None, None)
+        return result
+
+    # The rest runs on the loop thread
+
+    def __send(self, request, fresh=False):
+        idle = self.__idle.get(request.key)
+        if idle and not fresh:
+            self.hits += 1
+            CONNECTIONS.inc(('hit',))
+            conn = idle.pop()
+            conn.send(request)
+            self.update(conn)
+            return
+        self.misses += 1
+        CONNECTIONS.inc(('miss',))
+        conn = Connection(self, request.key)
+        try:
+            conn.connect(request)
+        except socket.error as e:
+            conn.close()
+            REQUEST_ERRORS.inc((request.method, 'connection'))
+            request.future.set(error=e)
+            return
+        self.__conns[conn.fd] = conn
+        self.__poll.register(conn.fd, conn.events)
+
+    def __is_open(self, conn):
+        return self.__conns.get(conn.fd) is conn
+
+    def update(self, conn):
+        'Poll for the events the connection waits for'
+        if not self.__is_open(conn):
+            return
+        if conn.events:
+            self.__poll.register(conn.fd, conn.events)
+        else:
+            # Paused, nothing to wait for, not even the end of the connection
+            try:
+                self.__poll.unregister(conn.fd)
+            except KeyError:
+                pass
+
+    def release(self, conn):
+        idle = self.__idle.setdefault(conn.key, [])
+        if conn.reusable and len(idle) < self.maxsize:
+            conn.pooled = True
+            idle.append(conn)
+            self.update(conn)
+        else:
+            self.discard(conn)
+
+    def discard(self, conn):
+        if self.__is_open(conn):
+            del self.__conns[conn.fd]
+            try:
+                self.__poll.unregister(conn.fd)
+            except KeyError:
+                pass
+        idle = self.__idle.get(conn.key, [])
+        if conn in idle:
+            idle.remove(conn)
+        self.ready.discard(conn)
+        conn.close()
+
+    def __close_idle(self):
+        for conns in self.__idle.values():
+            for conn in list(conns):
+                self.discard(conn)
+
+    def __handle(self, conn, events):
+        if not self.__is_open(conn):
+            return
+        request = conn.request
+        try:
+            if events & (select.POLLERR | select.POLLNVAL) and \
+               conn.state != IDLE:
+                err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                raise socket.error(err, os.strerror(err or errno.EPIPE))
+            conn.handle(events)
+            self.update(conn)
+        except Exception as e:
+            self.discard(conn)
+            if isinstance(e, StaleConnection) or (
+               conn.pooled and conn.state in (SENDING, HEADERS) and
+               isinstance(e, socket.error)):
+                # The server closed the idle connection, use a new one:
+                self.__send(request, fresh=True)
+                return
+            if isinstance(e, StaleConnection):
+                e = httplib.BadStatusLine('')
+            if request is not None and conn.state != DRAINING:
+                REQUEST_ERRORS.inc((request.method, 'connection'))
+                log.debug('Request to %s failed: %r' % (request.url, e))
+            conn.fail(e)
+
+    def __run(self):
+        while True:
+            try:
+                self.__step()
+            except Exception:
+                log.exception('Error in the upstream event loop')
+
+    def __step(self):
+        now = time.time()
+        self.buffered = sum(
+            len(c.response.buffer) for c in self.__conns.itervalues()
+            if c.state == BODY)
+        deadlines = [c.deadline for c in self.__conns.itervalues()
+                     if c.deadline is not None]
+        timeout = max(min(deadlines) - now, 0) if deadlines else None
+        if self.ready or self.__calls:
+            timeout = 0
+        try:
+            events = self.__poll.poll(
+                None if timeout is None else int(timeout * 1000) + 1)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, ev in events:
+            if fd == self.__wake_r:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            conn = self.__conns.get(fd)
+            if conn is not None:
+                self.ready.discard(conn)
+                self.__handle(conn, ev)
+        ready, self.ready = self.ready, set()
+        for conn in ready:
+            self.__handle(conn, select.POLLIN)
+        while self.__calls:
+            fn, args = self.__calls.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                log.exception('Error in the upstream event loop')
+        now = time.time()
+        for conn in self.__conns.values():
+            if conn.deadline is not None and conn.deadline < now:
+                self.discard(conn)
+                if conn.request is not None:
+                    REQUEST_ERRORS.inc((conn.request.method, 'timeout'))
+                conn.fail(socket.timeout('timed out'))
+
+
+# The pool used for all upstream requests
+pool = ConnectionPool()
@@ -0,0 +1,140 @@
+# ID3 tags for gmusicfs.
+#
+# Tags are built from the library metadata: the ID3v1 trailer appended to
+# every track, and optionally an ID3v2 header prepended to it, so that
+# reading tags never needs the audio stream.
+
+import struct
+import threading
+
+from tracks import Track
+
+# Size of the ID3v1 trailer appended to the mp3 file (at read time)
+ID3V1_TRAILER_SIZE = 128
+# ID3v2 headers are padded to a multiple of this, so that the audio starts
+# on a page boundary of the file. Tagged tracks are opened with direct I/O,
+# a tag scan gets the header bytes it reads and no kernel readahead:
+HEADER_ALIGN = 4096
+
+
+def latin1(s, length):
+    return s.encode('latin-1', 'replace')[:length] if isinstance(s, unicode) \
+        else str(s)[:length]
+
+
+def id3v1(track):
+    'Build the ID3v1 trailer of a track'
+    # Genre tag is always set to Other as Google MP3 genre tags are not id3v1 id.
+    return struct.pack("!3s30s30s30s4s30sb", 'TAG', latin1(track.title, 30),
+                       latin1(track.artist, 30), latin1(track.album, 30),
+                       str(0), latin1(track.comment, 30), 12)
+
+
+def syncsafe(n):
+    """Encode a tag size as an ID3v2 syncsafe integer
+
+    >>> syncsafe(257)
+    '\\x00\\x00\\x02\\x01'
+    """
+    return struct.pack('!4B', (n >> 21) & 0x7f, (n >> 14) & 0x7f,
+                       (n >> 7) & 0x7f, n & 0x7f)
+
+
+def frame(frame_id, data):
+    'Build an ID3v2.3 frame'
+    return struct.pack('!4sIH', frame_id, len(data), 0) + data
+
+
+def text_frame(frame_id, text):
+    if not isinstance(text, unicode):
+        text = unicode(text)
+    try:
+        return frame(frame_id, '\x00' + text.encode('latin-1'))
+    except UnicodeEncodeError:
+        # UTF-16 with a byte order mark
+        return frame(frame_id, '\x01' + text.encode('utf-16'))
+
+
+def id3v2(track, cover=None, size=None):
+    """Build an ID3v2.3 header for a track, with the album cover (JPEG
+    data) if given. With size, the tag is padded to that many bytes.
+
+    >>> track = Track.from_dict({'id': '1', 'title': u'Song', 'artist': u'Band'})
+    >>> tag = id3v2(track)
+    >>> tag[:3], len(tag)
+    ('ID3', 40)
+    >>> len(id3v2(track, size=100))
+    100
+    """
+    frames = [text_frame('TIT2', track.title),
+              text_frame('TPE1', track.artist)]
+    if track.album:
+        frames.append(text_frame('TALB', track.album))
+    if track.track_number:
+        frames.append(text_frame('TRCK', track.track_number))
+    if track.year:
+        frames.append(text_frame('TYER', track.year))
+    if track.genre:
+        frames.append(text_frame('TCON', track.genre))
+    if cover:
+        # Front cover picture
+        frames.append(frame('APIC', '\x00image/jpeg\x00\x03\x00' + cover))
+    frames = ''.join(frames)
+    if size is not None:
+        # Padding (zero bytes after the frames) is allowed by the format
+        frames += '\x00' * (size - 10 - len(frames))
+    return 'ID3\x03\x00\x00' + syncsafe(len(frames)) + frames
+
+
+class Tagger(object):
+    """Build the ID3v2 headers prepended to tracks.
+
+    With a block cache and with_cover, album covers that are entirely in
+    the cache are included in the tag. The size of each header is fixed
+    the first time it is asked for, since it is part of the file size:
+    headers built later are padded, or built without the cover, to match.
+    Headers are padded to a multiple of HEADER_ALIGN bytes."""
+    def __init__(self, cache=None, with_cover=False):
+        self.cache = cache if with_cover else None
+        self.lock = threading.Lock()
+        self.__sizes = {} # track id -> header size
+
+    def cover(self, url):
+        'Get the cover at url if it is entirely cached, or None'
+        if self.cache is None or not url:
+            return None
+        length = self.cache.get_length(url)
+        if length is None:
+            return None
+        blocks = []
+        for block in range((length + self.cache.block_size - 1) //
+                           self.cache.block_size):
+            data = self.cache.get(url, block)
+            if data is None:
+                return None
+            blocks.append(data)
+        return ''.join(blocks)
+
+    def size(self, track, cover_url=None):
+        'Get the size of the header of a track'
+        with self.lock:
+            size = self.__sizes.get(track.id)
+        if size is None:
+            size = len(id3v2(track, self.cover(cover_url)))
+            size += -size % HEADER_ALIGN
+            with self.lock:
+                size = self.__sizes.setdefault(track.id, size)
+        return size
+
+    def forget(self, track_id):
+        'Drop the header size of a track, when the track has changed'
+        with self.lock:
+            self.__sizes.pop(track_id, None)
+
+    def header(self, track, cover_url=None):
+        'Build the header of a track'
+        size = self.size(track, cover_url)
+        cover = self.cover(cover_url)
+        if cover is not None and len(id3v2(track, cover)) > size:
+            cover = None
+        return id3v2(track, cover, size)
@@ -0,0 +1,194 @@
+# Operation metrics for gmusicfs.
+#
+# Counters and latency histograms of the filesystem operations and of the
+# upstream calls, rendered in the Prometheus text format. They are read
+# from the /.gmusicfs/stats file of the mount, and can also be written to
+# a textfile for the node_exporter textfile collector.
+
+import bisect
+import logging
+import threading
+
+from cache import atomic_write
+
+log = logging.getLogger('gmusicfs.metrics')
+
+# Latency buckets, in seconds:
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TEXTFILE_INTERVAL = 15
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s %s' % (self.name, self.type)]
+
+
+class Counter(Metric):
+    'A count that only goes up, per tuple of label values'
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.__values = {} # label values -> count
+
+    def inc(self, labels=(), n=1):
+        with self.lock:
+            self.__values[labels] = self.__values.get(labels, 0) + n
+
+    def get(self, labels=()):
+        return self.__values.get(labels, 0)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.__values.items())
+        return self.header() + [
+            '%s%s %s' % (self.name, format_labels(self.labels, l),
+                         format_value(v)) for l, v in values]
+
+
+class Gauge(Metric):
+    """A value read from a function when the metrics are rendered. With
+    labels, the function returns a dict of label values -> value."""
+    type = 'gauge'
+
+    def __init__(self, name, help, get, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.get = get
+
+    def render(self):
+        if not self.labels:
+            return self.header() + ['%s %s' % (self.name, format_value(self.get()))]
+        return self.header() + [
+            '%s%s %s' % (self.name, format_labels(self.labels, l),
+                         format_value(v)) for l, v in sorted(self.get().items())]
+
+
+class Histogram(Metric):
+    'Counts of observed values (latencies) in buckets, per label values'
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = buckets
+        self.__values = {} # label values -> [count per bucket..., sum]
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.__values.get(labels)
+            if counts is None:
+                counts = self.__values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def render(self):
+        with self.lock:
+            values = sorted((l, list(c)) for l, c in self.__values.items())
+        lines = self.header()
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(
+                    self.labels, labels, 'le="%s"' % bound), total))
+            lines.append('%s_sum%s %r' % (
+                self.name, format_labels(self.labels, labels), counts[-1]))
+            lines.append('%s_count%s %d' % (
+                self.name, format_labels(self.labels, labels), total))
+        return lines
+
+
+class Registry(object):
+    """The metrics of the process.
+
+    >>> r = Registry()
+    >>> reads = r.counter('reads_total', 'Reads', ('op',))
+    >>> reads.inc(('read',))
+    >>> latency = r.histogram('read_seconds', 'Read time', buckets=(0.1, 1))
+    >>> latency.observe(0.5)
+    >>> print r.render(),
+    # HELP reads_total Reads
+    # TYPE reads_total counter
+    reads_total{op="read"} 1
+    # HELP read_seconds Read time
+    # TYPE read_seconds histogram
+    read_seconds_bucket{le="0.1"} 0
+    read_seconds_bucket{le="1"} 1
+    read_seconds_bucket{le="+Inf"} 1
+    read_seconds_sum 0.5
+    read_seconds_count 1
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.__metrics = []
+
+    def add(self, metric):
+        with self.lock:
+            self.__metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, get, labels=()):
+        return self.add(Gauge(name, help, get, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        'Get all the metrics in the Prometheus text format'
+        with self.lock:
+            metrics = list(self.__metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return u'\n'.join(lines).encode('utf-8') + '\n'
+
+    def write_textfile(self, path):
+        atomic_write(path, self.render())
+
+    def start_textfile(self, path, interval=TEXTFILE_INTERVAL, stop=None):
+        """Write the metrics to path every interval seconds, in the
+        background, until the stop Event is set"""
+        stop = stop or threading.Event()
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.write_textfile(path)
+                except (IOError, OSError) as e:
+                    log.warning('Could not write the metrics to %s: %s' % (path, e))
+        t = threading.Thread(target=loop, name='metrics-textfile')
+        t.daemon = True
+        t.start()
+        return stop
+
+
+# The metrics of all the modules
+registry = Registry()
@@ -0,0 +1,189 @@
+# Offline pinning for gmusicfs.
+#
+# Artist and album directories can be pinned by setting an extended
+# attribute on them. Pinner downloads all the tracks and covers of the
+# pinned directories into the block cache from a background thread,
+# under a bandwidth limit. The cache keeps pinned blocks out of eviction,
+# so that pinned music plays without a network connection.
+
+import os
+import time
+import logging
+import threading
+import cPickle as pickle
+
+import scheduler
+from cache import atomic_write
+from metrics import registry
+
+log = logging.getLogger('gmusicfs.pins')
+
+PIN_XATTR = 'user.gmusicfs.pinned'
+PROGRESS_XATTR = 'user.gmusicfs.pinprogress'
+# Default download rate, in bytes per second:
+BANDWIDTH = 1024 * 1024
+# Look for new tracks in pinned directories this often, in seconds:
+RESCAN_INTERVAL = 300
+
+DOWNLOADED = registry.counter(
+    'gmusicfs_pin_bytes_total', 'Bytes downloaded for pinned directories')
+
+
+class Pinner(object):
+    """Download pinned artists and albums into a BlockCache.
+
+    Pins are ('artist', name) or ('album', album key) tuples, saved to
+    path. open_file(key, get_url) opens a stream file on the cache, as
+    GMusicFS.open() does; reading a stream file through stores it in the
+    cache. bandwidth is in bytes per second, 0 for no limit. Downloads
+    run on a thread started by start()."""
+    def __init__(self, library, cache, open_file, path=None,
+                 bandwidth=BANDWIDTH):
+        self.library = library
+        self.cache = cache
+        self.open_file = open_file
+        self.path = path
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.__pins = set()
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+        if path:
+            self.__load()
+
+    def start(self):
+        t = threading.Thread(target=self.__run, name='pinner')
+        t.daemon = True
+        t.start()
+
+    def __load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.__pins = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = pickle.dumps(self.__pins, pickle.HIGHEST_PROTOCOL)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        atomic_write(self.path, data)
+
+    def pin(self, pin):
+        with self.lock:
+            self.__pins.add(pin)
+        self.save()
+        self.__wake.set()
+
+    def unpin(self, pin):
+        'Remove a pin, returns False if there was no such pin'
+        with self.lock:
+            if pin not in self.__pins:
+                return False
+            self.__pins.discard(pin)
+        self.save()
+        self.__wake.set()
+        return True
+
+    def is_pinned(self, album):
+        'Is the album pinned, by itself or with its artist?'
+        pins = self.__pins
+        return ('album', album.key) in pins or ('artist', album.artist) in pins
+
+    def has_pin(self, pin):
+        return pin in self.__pins
+
+    def files(self, albums):
+        """Get the files of albums as (key, get_url, estimated size,
+        on_size) tuples. on_size(size) is called with the true size of
+        the file once it has been downloaded."""
+        files = []
+        for album in albums:
+            for track in album.get_tracks():
+                files.append((track.id,
+                              lambda refresh=False, t=track, a=album:
+                                  a.get_track_stream(t, refresh),
+                              track.estimated_size,
+                              lambda size, t=track:
+                                  self.library.set_track_size(t, size)))
+            url = album.get_cover_url()
+            if url:
+                files.append((url, lambda refresh=False, url=url: url, 0,
+                              lambda size, a=album:
+                                  self.library.set_cover_size(a, size)))
+        return files
+
+    def progress(self, files):
+        'Get (bytes done, bytes, files done, files) for a list of files()'
+        done = total = files_done = 0
+        for key, get_url, estimate, on_size in files:
+            length = self.cache.get_length(key)
+            cached = self.cache.cached_bytes(key)
+            total += estimate if length is None else length
+            done += cached
+            if length is not None and cached == length:
+                files_done += 1
+        return done, total, files_done, len(files)
+
+    def stop(self):
+        self.__stop.set()
+        self.__wake.set()
+
+    def __run(self):
+        scheduler.set_priority(scheduler.BACKGROUND)
+        while not self.__stop.is_set():
+            self.__wake.clear()
+            try:
+                self.__sync()
+            except Exception:
+                log.exception('Could not download the pinned files')
+            self.__wake.wait(RESCAN_INTERVAL)
+
+    def __sync(self):
+        'Pin the files of pinned albums in the cache, and download them'
+        albums = [a for a in self.library.get_albums() if self.is_pinned(a)]
+        files = self.files(albums)
+        wanted = set(f[0] for f in files)
+        for key in self.cache.pinned_keys():
+            if key not in wanted:
+                self.cache.unpin(key)
+        for key in wanted:
+            self.cache.pin(key)
+        for key, get_url, estimate, on_size in files:
+            if self.__wake.is_set():
+                # The pins changed, start over
+                break
+            try:
+                length = self.__download(key, get_url)
+            except Exception as e:
+                log.warning('Could not download %s: %s' % (key, e))
+                continue
+            if length is not None:
+                self.library.sizes.set(key, length)
+                on_size(length)
+        self.cache.sync()
+        self.library.sizes.save()
+
+    def __download(self, key, get_url):
+        'Download the blocks of key missing from the cache, returns its length'
+        f = self.open_file(key, get_url)
+        try:
+            length = f.get_length()
+            block_size = self.cache.block_size
+            for block in xrange((length + block_size - 1) // block_size):
+                if self.__wake.is_set():
+                    return None
+                if self.cache.has(key, block):
+                    continue
+                start = time.time()
+                data = f.read(block_size, block * block_size)
+                DOWNLOADED.inc(n=len(data))
+                if self.bandwidth:
+                    self.__wake.wait(len(data) / float(self.bandwidth) -
+                                     (time.time() - start))
+            return length
+        finally:
+            f.close()
@@ -0,0 +1,273 @@
+# Trace replay for gmusicfs.
+#
+# gmusicfs-replay runs a trace recorded with --trace against a GMusicFS
+# serving a fake library (backend.FakeBackend) from a local HTTP server
+# (fakeserver.StreamServer), at the speed of the trace or as fast as it
+# goes, and prints the latency of each kind of operation next to the
+# latency recorded in the trace.
+
+import os
+import math
+import time
+import Queue
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import collections
+
+from backend import FakeBackend
+from fakeserver import StreamServer
+from traces import read_trace
+from gmusicfs import GMusicFS
+
+log = logging.getLogger('gmusicfs.replay')
+
+THREADS = 8
+TRACKS = 1000
+# Latency of the fake server, in ms:
+LATENCY = 20
+
+
+def percentile(values, p):
+    """Get the p-th percentile of sorted values, 0 if there are none.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 100)
+    4
+    >>> percentile([], 99)
+    0
+    """
+    if not values:
+        return 0
+    return values[max(int(math.ceil(len(values) * p / 100.0)) - 1, 0)]
+
+
+class FileInfo(object):
+    'Stands for the fuse_file_info of open files (the mount uses raw_fi)'
+    def __init__(self, flags=os.O_RDONLY):
+        self.flags = flags
+        self.fh = 0
+        self.direct_io = self.keep_cache = 0
+
+
+class PathMapper(object):
+    """Map the paths of a trace onto the paths of a library.
+
+    A file or directory of the trace gets the entry of the same name in
+    the directory its parent maps to, if there is one that is not taken,
+    or else the first entry with the same extension that is not taken.
+    The shape of the traced workload is kept: how many artists, albums
+    and tracks were used, and which ones were used again."""
+    def __init__(self, library):
+        self.library = library
+        self.lock = threading.Lock()
+        self.__paths = {u'/': u'/'} # trace path -> library path
+        self.__taken = {} # library directory -> names given out
+
+    def map(self, path):
+        if path is None:
+            return None
+        with self.lock:
+            return self.__map(path)
+
+    def __map(self, path):
+        mapped = self.__paths.get(path)
+        if mapped is not None:
+            return mapped
+        parent, name = path.rsplit(u'/', 1)
+        parent = self.__map(parent or u'/')
+        node = self.library.lookup(parent)
+        entries = []
+        if node is not None and node.is_dir():
+            entries = [e for e in node.entries if e not in (u'.', u'..')]
+        taken = self.__taken.setdefault(parent, set())
+        if name not in entries or name in taken:
+            ext = os.path.splitext(name)[1]
+            for e in entries:
+                if e not in taken and os.path.splitext(e)[1] == ext:
+                    name = e
+                    break
+        taken.add(name)
+        mapped = self.__paths[path] = parent.rstrip(u'/') + u'/' + name
+        return mapped
+
+
+class Replay(object):
+    """Run trace records against the GMusicFS fs, from threads worker
+    threads as with a multithreaded mount. The operations on a file
+    handle, and on a path, run in the order of the trace."""
+    def __init__(self, fs, threads=THREADS):
+        self.fs = fs
+        self.mapper = PathMapper(fs.library)
+        self.lock = threading.Lock()
+        self.handles = {} # file handle of the trace -> FileInfo
+        self.latencies = collections.defaultdict(list) # op -> [seconds]
+        self.recorded = collections.defaultdict(list) # op -> [seconds]
+        self.errors = collections.Counter()
+        self.recorded_errors = collections.Counter()
+        self.skipped = collections.Counter()
+        self.__queues = [Queue.Queue() for _ in range(threads)]
+
+    def run(self, records, speed=1):
+        """Replay records at speed times the speed of the trace, or as fast
+        as possible with a speed of 0. Returns (seconds replayed, seconds
+        of the trace)."""
+        workers = [threading.Thread(target=self.__work, args=(q,),
+                                    name='replay-%d' % i)
+                   for i, q in enumerate(self.__queues)]
+        for t in workers:
+            t.start()
+        start = time.time()
+        first = last = None
+        try:
+            for r in records:
+                if first is None:
+                    first = r.time
+                last = r.time
+                if speed:
+                    wait = (r.time - first) / speed - (time.time() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+                key = r.fh or r.path
+                self.__queues[hash(key) % len(self.__queues)].put(r)
+        finally:
+            for q in self.__queues:
+                q.put(None)
+            for t in workers:
+                t.join()
+        return time.time() - start, (last or 0) - (first or 0)
+
+    def __work(self, queue):
+        while True:
+            r = queue.get()
+            if r is None:
+                return
+            try:
+                self.__replay(r)
+            except Exception:
+                log.exception('Could not replay %r' % (r,))
+
+    def __call(self, r):
+        # Get the arguments of the GMusicFS call for a record, or None
+        path = self.mapper.map(r.path)
+        if r.op in ('getattr', 'readdir'):
+            return (r.op, path, None)
+        if r.op == 'open':
+            return ('open', path, FileInfo())
+        if r.op in ('read', 'release'):
+            with self.lock:
+                if r.op == 'read':
+                    fi = self.handles.get(r.fh)
+                else:
+                    fi = self.handles.pop(r.fh, None)
+            if fi is None:
+                return None
+            if r.op == 'read':
+                return ('read', path, r.size, r.offset, fi)
+            return ('release', path, fi)
+        if r.op == 'getxattr':
+            return ('getxattr', path, r.name)
+        if r.op == 'listxattr':
+            return ('listxattr', path)
+        # Operations that change something, or that GMusicFS does not have
+        return None
+
+    def __replay(self, r):
+        with self.lock:
+            self.recorded[r.op].append(r.latency)
+            if r.result < 0:
+                self.recorded_errors[r.op] += 1
+        call = self.__call(r)
+        if call is None:
+            with self.lock:
+                self.skipped[r.op] += 1
+            return
+        failed = False
+        start = time.time()
+        try:
+            self.fs(*call)
+        except OSError:
+            failed = True
+        except Exception as e:
+            log.debug('%s %s failed: %r' % (r.op, call[1], e))
+            failed = True
+        latency = time.time() - start
+        with self.lock:
+            self.latencies[r.op].append(latency)
+            if failed:
+                self.errors[r.op] += 1
+            elif r.op == 'open' and r.fh:
+                self.handles[r.fh] = call[2]
+
+    def report(self):
+        'Get a table of the latency of each operation, in ms'
+        lines = ['%-10s %7s %7s %11s %8s %8s %10s %10s' % (
+            'op', 'count', 'errors', 'traced errs', 'p50', 'p99',
+            'traced p50', 'traced p99')]
+        for op in sorted(self.recorded):
+            recorded = sorted(self.recorded[op])
+            replayed = sorted(self.latencies[op])
+            lines.append('%-10s %7d %7d %11d %8.2f %8.2f %10.2f %10.2f' % (
+                op, len(recorded), self.errors[op], self.recorded_errors[op],
+                percentile(replayed, 50) * 1000, percentile(replayed, 99) * 1000,
+                percentile(recorded, 50) * 1000, percentile(recorded, 99) * 1000))
+        skipped = sum(self.skipped.values())
+        if skipped:
+            lines.append('Skipped %d operations: %s' % (skipped, ', '.join(
+                '%s %d' % item for item in sorted(self.skipped.items()))))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a trace of gmusicfs operations recorded with --trace'
+        ' against a fake library, and compare the latency of each operation'
+        ' with the trace')
+    parser.add_argument('trace', help='The trace file')
+    parser.add_argument('--speed', help='Speed of the replay, relative to the'
+                        ' trace, 0 to run it as fast as possible (default: 1)',
+                        type=float, default=1)
+    parser.add_argument('--threads', help='Threads running the operations'
+                        ' (default: %d)' % THREADS, type=int, default=THREADS)
+    parser.add_argument('--tracks', help='Tracks in the fake library'
+                        ' (default: %d)' % TRACKS, type=int, default=TRACKS)
+    parser.add_argument('--latency', help='Latency of each request to the'
+                        ' fake server, in ms (default: %d)' % LATENCY,
+                        type=float, default=LATENCY)
+    parser.add_argument('--bandwidth', help='Bandwidth of each connection to'
+                        ' the fake server in KB/s, 0 for no limit (default: 0)',
+                        type=int, default=0)
+    parser.add_argument('--cachesize', help='Size of the block cache in MB, in'
+                        ' a temporary directory, 0 disables it (default: 0)',
+                        type=int, dest='cache_size', default=0)
+    parser.add_argument('-v', '--verbose', help='Be verbose',
+                        action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    backend = FakeBackend(args.tracks)
+    server = StreamServer(backend, args.latency / 1000.0,
+                          args.bandwidth * 1024).start()
+    cache_dir = None
+    if args.cache_size:
+        cache_dir = tempfile.mkdtemp(prefix='gmusicfs-replay-')
+    try:
+        fs = GMusicFS('/replay', api=backend, cache_dir=cache_dir,
+                      cache_size=args.cache_size * 1024**2)
+        replay = Replay(fs, args.threads)
+        with open(args.trace, 'rb') as f:
+            elapsed, duration = replay.run(read_trace(f), args.speed)
+        fs.cleanup()
+    finally:
+        server.stop()
+        if cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    print 'Replayed %.1fs of trace in %.1fs' % (duration, elapsed)
+    print replay.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Upstream request scheduler for gmusicfs.
+#
+# Every request to Google (stream opens, HEAD probes, cover fetches and
+# API calls) goes through one Scheduler. It limits the rate of requests
+# with a token bucket and the number of requests waiting for a response,
+# and lets requests go in order of priority: the reads and opens of a
+# player before size probes, and those before background downloads.
+# Requests answered with 429 or a 5xx status are tried again later.
+
+import time
+import random
+import urllib2
+import logging
+import itertools
+import threading
+import contextlib
+import collections
+
+from metrics import registry
+
+log = logging.getLogger('gmusicfs.scheduler')
+
+# Priority classes, most urgent first:
+INTERACTIVE = 0 # Opens and reads of the filesystem
+PROBE = 1 # True size lookups
+BACKGROUND = 2 # Pinning, prefetch and library refreshes
+CLASS_NAMES = ('interactive', 'probe', 'background')
+
+# Requests per second, and how many can be sent at once after a pause:
+RATE = 20
+BURST = 40
+# Requests waiting for their response at the same time:
+CONCURRENCY = 8
+RETRIES = 4
+# First wait before a retry, doubled on each retry, in seconds:
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+RETRY_WAITS = registry.counter(
+    'gmusicfs_scheduler_retries_total',
+    'Upstream requests tried again, by status code', ('class', 'code'))
+WAIT_SECONDS = registry.histogram(
+    'gmusicfs_scheduler_wait_seconds',
+    'Time upstream requests waited for their turn', ('class',))
+
+_local = threading.local()
+
+
+def set_priority(priority):
+    'Set the priority class of the requests sent by the current thread'
+    _local.priority = priority
+
+
+def get_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+def should_retry(e):
+    # Errors of the music service API are raised as HTTPError too, see
+    # backend.GoogleMusicBackend
+    return isinstance(e, urllib2.HTTPError) and \
+        (e.code == 429 or 500 <= e.code < 600)
+
+
+def retry_after(e):
+    'Get the wait asked for by the Retry-After header of an HTTPError, or None'
+    try:
+        return max(float(e.hdrs['Retry-After']), 0)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class Scheduler(object):
+    """Rate limit, concurrency cap and priority queues for the upstream
+    requests.
+
+    call(fn) waits for the turn of the calling thread's priority class,
+    calls fn and tries it again with a growing backoff if it fails with
+    a status of 429 or 5xx. A call holds its place in the concurrency cap
+    until fn returns, for a request that is until the response headers
+    have arrived. rate is in requests per second, 0 for no limit.
+
+    >>> s = Scheduler(rate=0)
+    >>> s.call(lambda: 42)
+    42
+    >>> sorted(s.queued().items())
+    [('background', 0), ('interactive', 0), ('probe', 0)]
+    """
+    def __init__(self, rate=RATE, burst=BURST, concurrency=CONCURRENCY,
+                 retries=RETRIES):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.retries = retries
+        self.active = 0
+        self.__cond = threading.Condition()
+        self.__tokens = burst
+        self.__refilled = time.time()
+        self.__tickets = itertools.count()
+        self.__queues = [collections.deque() for _ in CLASS_NAMES]
+
+    def configure(self, rate=None, burst=None, concurrency=None):
+        with self.__cond:
+            if rate is not None:
+                self.rate = rate
+            if burst is not None:
+                self.burst = self.__tokens = burst
+            if concurrency is not None:
+                self.concurrency = concurrency
+            self.__cond.notify_all()
+
+    def queued(self):
+        'Get the number of requests waiting in each priority class'
+        with self.__cond:
+            return dict((name, len(queue))
+                        for name, queue in zip(CLASS_NAMES, self.__queues))
+
+    def call(self, fn, *args, **kwargs):
+        priority = get_priority()
+        backoff = BACKOFF
+        for attempt in itertools.count():
+            self.acquire(priority)
+            try:
+                return fn(*args, **kwargs)
+            except urllib2.HTTPError as e:
+                if not should_retry(e) or attempt >= self.retries:
+                    raise
+                RETRY_WAITS.inc((CLASS_NAMES[priority], str(e.code)))
+                wait = retry_after(e)
+                if wait is None:
+                    wait = backoff * random.uniform(0.5, 1)
+                    backoff = min(backoff * 2, MAX_BACKOFF)
+                log.debug('Upstream request failed with %d, trying again in '
+                          '%.1fs' % (e.code, wait))
+            finally:
+                self.release()
+            time.sleep(min(wait, MAX_BACKOFF))
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a turn of the calling thread's priority class, for calls
+        that cannot be tried again"""
+        self.acquire(get_priority())
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, priority=INTERACTIVE):
+        'Wait for the turn of a request of the given priority class'
+        start = time.time()
+        with self.__cond:
+            ticket = next(self.__tickets)
+            queue = self.__queues[priority]
+            queue.append(ticket)
+            try:
+                while True:
+                    if self.__is_next(priority, ticket) and \
+                       self.active < self.concurrency:
+                        wait = self.__take_token()
+                        if not wait:
+                            break
+                        self.__cond.wait(wait)
+                    else:
+                        self.__cond.wait()
+            finally:
+                queue.remove(ticket)
+                # The next request in line may go now:
+                self.__cond.notify_all()
+            self.active += 1
+        WAIT_SECONDS.observe(time.time() - start, (CLASS_NAMES[priority],))
+
+    def release(self):
+        with self.__cond:
+            self.active -= 1
+            self.__cond.notify_all()
+
+    def __is_next(self, priority, ticket):
+        # Called with the lock held
+        for queue in self.__queues[:priority]:
+            if queue:
+                return False
+        return self.__queues[priority][0] == ticket
+
+    def __take_token(self):
+        """Take a token from the bucket, returns 0 if there was one or the
+        time until there is one. Called with the lock held."""
+        if not self.rate:
+            return 0
+        now = time.time()
+        self.__tokens = min(self.burst, self.__tokens +
+                            (now - self.__refilled) * self.rate)
+        self.__refilled = now
+        if self.__tokens >= 1:
+            self.__tokens -= 1
+            return 0
+        return (1 - self.__tokens) / float(self.rate)
+
+
+# The scheduler of all upstream requests
+scheduler = Scheduler()
+
+QUEUED = registry.gauge(
+    'gmusicfs_scheduler_queued', 'Upstream requests waiting for their turn',
+    lambda: dict(((name,), n) for name, n in scheduler.queued().items()),
+    ('class',))
+ACTIVE = registry.gauge(
+    'gmusicfs_scheduler_active', 'Upstream requests waiting for a response',
+    lambda: scheduler.active)
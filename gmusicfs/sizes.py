@@ -0,0 +1,151 @@
+# True size lookups for gmusicfs.
+#
+# The true size of a track or a cover is only known after a HEAD request
+# on its URL. SizeProber sends these requests from a pool of worker
+# threads, remembers the answers and saves them so that they survive a
+# remount.
+
+import os
+import Queue
+import logging
+import threading
+import cPickle as pickle
+
+import urls
+import scheduler
+from cache import atomic_write
+
+log = logging.getLogger('gmusicfs.sizes')
+
+PROBE_WORKERS = 8
+# Save the sizes to disk after this many new ones, even without a save():
+SAVE_EVERY = 100
+
+
+def head_size(get_url):
+    'Get the Content-Length of the URL from get_url() with a HEAD request'
+    u = urls.urlopen(get_url, method='HEAD')
+    try:
+        return int(u.headers['Content-Length'])
+    finally:
+        u.close()
+
+
+class SizeProber(object):
+    """Find out and remember the size of tracks and covers.
+
+    Sizes are keyed by track id or cover URL. probe() queues a HEAD
+    request for a worker thread and returns straight away, get() only
+    returns what is already known, and wait() blocks until the size is
+    known."""
+    def __init__(self, path=None, workers=PROBE_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.__sizes = {} # key -> size
+        self.__pending = {} # key -> [callback, ...]
+        self.__done = threading.Condition(self.lock)
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        self.__unsaved = 0
+        if path:
+            self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.__sizes = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+    def save(self):
+        'Save the known sizes, if there are new ones'
+        with self.lock:
+            if not self.path or not self.__unsaved:
+                return
+            data = pickle.dumps(self.__sizes, pickle.HIGHEST_PROTOCOL)
+            self.__unsaved = 0
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        atomic_write(self.path, data)
+
+    def get(self, key):
+        'Get the size for key, or None if it is not known yet'
+        return self.__sizes.get(key)
+
+    def set(self, key, size):
+        'Remember a size found out some other way'
+        with self.lock:
+            if self.__sizes.get(key) != size:
+                self.__sizes[key] = size
+                self.__unsaved += 1
+
+    def forget(self, key):
+        'Drop the size for key, when its content has changed'
+        with self.lock:
+            if self.__sizes.pop(key, None) is not None:
+                self.__unsaved += 1
+
+    def probe(self, key, get_url, callback=None):
+        """Look up the size for key in the background, unless it is known
+        already. get_url is called from a worker thread to get the URL to
+        send the HEAD request to, see urls.urlopen(). callback is called
+        with the size once it is known (straight away if it is known
+        already)."""
+        with self.lock:
+            size = self.__sizes.get(key)
+            if size is None:
+                callbacks = self.__pending.get(key)
+                if callbacks is None:
+                    callbacks = self.__pending[key] = []
+                    self.__queue.put((key, get_url))
+                    self.__start_workers()
+                if callback:
+                    callbacks.append(callback)
+                return
+        if callback:
+            callback(size)
+
+    def wait(self, key, get_url, timeout=None):
+        'Get the size for key, probing for it and waiting if needed'
+        self.probe(key, get_url)
+        with self.lock:
+            while key not in self.__sizes and key in self.__pending:
+                self.__done.wait(timeout)
+                if timeout is not None:
+                    break
+            return self.__sizes.get(key)
+
+    def __start_workers(self):
+        # Called with the lock held
+        while len(self.__threads) < self.workers:
+            t = threading.Thread(target=self.__work,
+                                 name='size-probe-%d' % len(self.__threads))
+            t.daemon = True
+            t.start()
+            self.__threads.append(t)
+
+    def __work(self):
+        scheduler.set_priority(scheduler.PROBE)
+        while True:
+            key, get_url = self.__queue.get()
+            try:
+                size = head_size(get_url)
+            except Exception as e:
+                log.warning('Could not get the size of %s: %s' % (key, e))
+                size = None
+            with self.lock:
+                if size is not None:
+                    self.__sizes[key] = size
+                    self.__unsaved += 1
+                callbacks = self.__pending.pop(key, [])
+                self.__done.notify_all()
+                save = self.__unsaved >= SAVE_EVERY
+            if size is not None:
+                for callback in callbacks:
+                    try:
+                        callback(size)
+                    except Exception:
+                        log.exception('Size callback failed for %s' % key)
+            if save:
+                self.save()
@@ -0,0 +1,79 @@
+# Library snapshots for gmusicfs.
+#
+# The track list of the library is saved to a local file after each scan
+# so that the next mount can serve the filesystem straight away, before
+# the library has been fetched from Google Music again.
+
+import gc
+import os
+import zlib
+import logging
+import contextlib
+import cPickle as pickle
+
+from cache import atomic_write
+from tracks import Track
+
+log = logging.getLogger('gmusicfs.snapshot')
+
+# Tracks are saved a column per field, which pickles faster and smaller
+# than a tuple per track:
+SNAPSHOT_VERSION = 3
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector, which would otherwise go over
+    all the objects again and again while a large library is made."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def save(path, owner, tracks):
+    """Save a list of Track records to path. owner identifies the account
+    the library belongs to.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> t = Track.from_dict({'id': 'abc', 'title': u'T', 'artist': u'A',
+    ...                      'album': u'B', 'trackNumber': 1})
+    >>> save(os.path.join(d, 'library'), 'me', [t, t])
+    >>> [u.filename for u in load(os.path.join(d, 'library'), 'me')]
+    [u'001 - t.mp3', u'001 - t.mp3']
+    >>> load(os.path.join(d, 'library'), 'someone else') is None
+    True
+    >>> shutil.rmtree(d)
+    """
+    columns = Track.to_columns(tracks)
+    data = pickle.dumps((SNAPSHOT_VERSION, owner, Track.FIELDS, columns),
+                        pickle.HIGHEST_PROTOCOL)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    atomic_write(path, zlib.compress(data, 1))
+    log.debug('Saved %d tracks to %s' % (len(tracks), path))
+
+
+def load(path, owner):
+    """Load the Track records saved in path. Returns None if there is no
+    usable snapshot for owner."""
+    try:
+        with open(path, 'rb') as f:
+            data = zlib.decompress(f.read())
+    except (IOError, zlib.error):
+        return None
+    with gc_paused():
+        try:
+            version, saved_owner, keys, columns = pickle.loads(data)
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if version != SNAPSHOT_VERSION or saved_owner != owner or \
+           keys != Track.FIELDS:
+            return None
+        tracks = Track.from_columns(columns)
+    log.debug('Loaded %d tracks from %s' % (len(tracks), path))
+    return tracks
@@ -0,0 +1,118 @@
+# Operation traces for gmusicfs.
+#
+# With --trace, every filesystem operation is written to a binary trace
+# file: its name, path, offset, size, file handle, start time, latency
+# and result. gmusicfs-replay runs a trace again against a fake library,
+# so that a change can be measured on the workload of real clients.
+#
+# A trace starts with a header, followed by records. Strings (operation
+# names, paths and attribute names) are written once, in a STRING record
+# giving them a number, so that an operation record has a fixed size.
+
+import time
+import struct
+import threading
+import collections
+
+MAGIC = 'GMFSTRACE'
+VERSION = 1
+HEADER = struct.Struct('<9sBd') # magic, version, start time
+# Kinds of records:
+STRING, OP = 0, 1
+STRING_RECORD = struct.Struct('<BII') # kind, number, length of the string
+# kind, op, path, name (0 if none), start time from the header's, latency,
+# offset, size, file handle, result (bytes read or -errno):
+OP_RECORD = struct.Struct('<BIIIdfqIqi')
+# Write buffered records out at least this often, in seconds:
+FLUSH_INTERVAL = 1
+
+Record = collections.namedtuple(
+    'Record', 'op path name time latency offset size fh result')
+
+
+class TraceError(Exception):
+    pass
+
+
+class TraceWriter(object):
+    """Write operation records to the binary file f.
+
+    >>> from cStringIO import StringIO
+    >>> f = StringIO()
+    >>> w = TraceWriter(f, start=100)
+    >>> w.write('read', '/artists/A/B/01 - C.mp3', 100.5, 0.002, offset=65536,
+    ...         size=4096, fh=3, result=4096)
+    >>> w.write('getattr', '/artists/A', 101, 0.001, result=-2)
+    >>> w.flush()
+    >>> read, getattr = read_trace(StringIO(f.getvalue()))
+    >>> read.op, read.path, read.time, read.offset, read.size, read.fh
+    (u'read', u'/artists/A/B/01 - C.mp3', 0.5, 65536, 4096, 3)
+    >>> getattr.op, getattr.path, getattr.name, getattr.result
+    (u'getattr', u'/artists/A', None, -2)
+    """
+    def __init__(self, f, start=None):
+        self.f = f
+        self.start = time.time() if start is None else start
+        self.lock = threading.Lock()
+        self.__strings = {} # string -> number
+        self.__flushed = time.time()
+        f.write(HEADER.pack(MAGIC, VERSION, self.start))
+
+    def __string(self, s):
+        # Called with the lock held
+        if not s:
+            return 0
+        n = self.__strings.get(s)
+        if n is None:
+            n = self.__strings[s] = len(self.__strings) + 1
+            data = s.encode('utf-8') if isinstance(s, unicode) else s
+            self.f.write(STRING_RECORD.pack(STRING, n, len(data)) + data)
+        return n
+
+    def write(self, op, path, start, latency, name=None, offset=0, size=0,
+              fh=0, result=0):
+        with self.lock:
+            self.f.write(OP_RECORD.pack(
+                OP, self.__string(op), self.__string(path),
+                self.__string(name), start - self.start, latency, offset,
+                size, fh or 0, result))
+            if start - self.__flushed > FLUSH_INTERVAL:
+                self.f.flush()
+                self.__flushed = start
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def read_trace(f):
+    'Read the Records of the trace file f'
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+        raise TraceError('Not a gmusicfs trace')
+    if HEADER.unpack(header)[1] != VERSION:
+        raise TraceError('Unknown trace version %d' % HEADER.unpack(header)[1])
+    strings = {0: None}
+    while True:
+        kind = f.read(1)
+        if not kind:
+            return
+        if kind == chr(STRING):
+            data = f.read(STRING_RECORD.size - 1)
+            if len(data) < STRING_RECORD.size - 1:
+                return
+            _, n, length = STRING_RECORD.unpack(kind + data)
+            strings[n] = f.read(length).decode('utf-8')
+            continue
+        data = f.read(OP_RECORD.size - 1)
+        if len(data) < OP_RECORD.size - 1:
+            # Cut short, the filesystem did not exit cleanly
+            return
+        (_, op, path, name, start, latency, offset, size, fh,
+         result) = OP_RECORD.unpack(kind + data)
+        yield Record(strings[op], strings[path], strings[name], start,
+                     latency, offset, size, fh, result)
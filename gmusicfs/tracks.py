@@ -0,0 +1,126 @@
+# Track records for gmusicfs.
+#
+# get_all_songs() returns a dict per track with dozens of keys, most of
+# which the filesystem never looks at. Tracks are kept as Track records
+# instead: only the fields that are used, in __slots__, with the names
+# shared by many tracks interned and the file name computed once.
+
+import re
+
+# Normalized artist and album names -> the same string, so that tracks
+# of the same album share one copy:
+_strings = {}
+
+
+def intern_string(s):
+    return _strings.setdefault(s, s)
+
+
+def formatNames(string_from):
+    return re.sub('/', '-', string_from)
+
+
+def album_key(track):
+    'Get the \'artist|||album\' key of the album of a track dict'
+    # Prefer the album artist over the track artist if there is one:
+    artist = formatNames(track.get('albumArtist', u'').lower())
+    if artist.strip() == '':
+        artist = formatNames(track.get('artist', u'').lower())
+    return '%s|||%s' % (artist, formatNames(track.get('album', u'').lower()))
+
+
+def to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class Track(object):
+    """The fields of a track that the filesystem uses.
+
+    Timestamps are in seconds, except modified which is only compared.
+    size is the true size of the stream, None until it is known.
+
+    >>> t = Track.from_dict({'id': 'abc', 'title': u'A/B', 'artist': u'X',
+    ...                      'album': u'Y', 'trackNumber': 2,
+    ...                      'estimatedSize': '1000'})
+    >>> t.filename, t.album_key, t.estimated_size
+    (u'002 - a-b.mp3', u'x|||y', 1000)
+    >>> Track.from_row(t.to_row()).filename
+    u'002 - a-b.mp3'
+    >>> columns = Track.to_columns([t])
+    >>> [u.to_row() for u in Track.from_columns(columns)] == [t.to_row()]
+    True
+    """
+    __slots__ = ('id', 'title', 'artist', 'album', 'album_key', 'filename',
+                 'track_number', 'year', 'genre', 'comment', 'estimated_size',
+                 'created', 'recent', 'modified', 'cover_url', 'size')
+
+    # The fields saved by to_row(), in order:
+    FIELDS = __slots__[:-1]
+    # The fields whose values are shared by many tracks:
+    SHARED = ('artist', 'album', 'album_key', 'genre', 'cover_url')
+
+    @classmethod
+    def from_dict(cls, d):
+        'Make a Track from a track dict returned by get_all_songs()'
+        t = cls()
+        t.id = intern(str(d['id']))
+        t.title = d.get('title', u'')
+        t.artist = intern_string(d.get('artist', u''))
+        t.album = intern_string(d.get('album', u''))
+        t.album_key = intern_string(album_key(d))
+        t.track_number = to_int(d.get('trackNumber'))
+        t.filename = u'%03d - %s.mp3' % (t.track_number,
+                                         formatNames(t.title.lower()))
+        t.year = to_int(d.get('year'))
+        t.genre = intern_string(d.get('genre', u''))
+        t.comment = d.get('comment') or u''
+        t.estimated_size = to_int(d.get('estimatedSize'))
+        t.created = to_int(d.get('creationTimestamp')) // 1000000
+        t.recent = to_int(d.get('recentTimestamp')) // 1000000
+        t.modified = to_int(d.get('lastModifiedTimestamp'))
+        art = d.get('albumArtRef')
+        # Only the first cover URL is used:
+        t.cover_url = intern_string(art[0]['url']) if art else None
+        t.size = None
+        return t
+
+    @classmethod
+    def from_row(cls, row):
+        'Make a Track from a tuple returned by to_row()'
+        t = cls()
+        # In the order of FIELDS:
+        (t.id, t.title, t.artist, t.album, t.album_key, t.filename,
+         t.track_number, t.year, t.genre, t.comment, t.estimated_size,
+         t.created, t.recent, t.modified, t.cover_url) = row
+        t.size = None
+        return t
+
+    def to_row(self):
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Make Tracks from the lists returned by to_columns(). The values
+        of the SHARED fields are expected to be shared between the tracks
+        already (as they are after a pickle round trip), only the distinct
+        ones are interned."""
+        if not columns:
+            return []
+        columns = list(columns)
+        columns[0] = map(intern, columns[0])
+        for i, name in enumerate(cls.FIELDS):
+            if name in cls.SHARED:
+                for value in set(columns[i]):
+                    intern_string(value)
+        return map(cls.from_row, zip(*columns))
+
+    @classmethod
+    def to_columns(cls, tracks):
+        'Get the fields of tracks as a list of values per field'
+        return zip(*[t.to_row() for t in tracks])
+
+    def __repr__(self):
+        return '<Track %s %r>' % (self.id, self.filename)
@@ -0,0 +1,99 @@
+# Stream URL handling for gmusicfs.
+#
+# Stream URLs come from an API call and are signed, they stop working
+# once the time in their 'expire' parameter has passed. StreamUrlCache
+# keeps them around until shortly before that, so that opening the same
+# track again does not cost another API call.
+
+import time
+import urllib2
+import urlparse
+import logging
+import threading
+
+import httppool
+from metrics import registry
+from scheduler import scheduler
+
+log = logging.getLogger('gmusicfs.urls')
+
+# Lifetime assumed for URLs without an expire parameter, in seconds:
+DEFAULT_TTL = 60
+# Refresh URLs once this fraction of their lifetime has passed:
+REFRESH_AT = 0.8
+# Status codes that mean a signed URL is not valid anymore:
+EXPIRED_CODES = (403, 410)
+
+LOOKUPS = registry.counter(
+    'gmusicfs_stream_url_lookups_total',
+    'Stream URLs found in (hit) or missing from (miss) the cache', ('result',))
+
+
+def url_expiry(url, now, default_ttl=DEFAULT_TTL):
+    """Get the time at which a signed URL expires.
+
+    >>> url_expiry('http://host/path?id=1&expire=1400000000', 0)
+    1400000000
+    >>> url_expiry('http://host/path?id=1', 1000)
+    1060
+    """
+    query = urlparse.parse_qs(urlparse.urlparse(url).query)
+    try:
+        return int(query['expire'][0])
+    except (KeyError, ValueError):
+        return now + default_ttl
+
+
+class StreamUrlCache(object):
+    """Cache of stream URLs by track id.
+
+    fetch(track_id) gets a new URL from the API. URLs are fetched again
+    once REFRESH_AT of their lifetime has passed, or when asked to with
+    get(track_id, refresh=True) after the server rejected one."""
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.__urls = {} # track id -> (url, refresh time)
+
+    def get(self, track_id, refresh=False):
+        now = time.time()
+        with self.lock:
+            url, refresh_time = self.__urls.get(track_id, (None, 0))
+            if url is not None and not refresh and now < refresh_time:
+                self.hits += 1
+                LOOKUPS.inc(('hit',))
+                return url
+            self.misses += 1
+        LOOKUPS.inc(('miss',))
+        url = self.fetch(track_id)
+        expiry = url_expiry(url, now)
+        with self.lock:
+            self.__urls[track_id] = (url, now + (expiry - now) * REFRESH_AT)
+        return url
+
+    def invalidate(self, track_id):
+        'Drop the URL of a track, when the track has changed'
+        with self.lock:
+            self.__urls.pop(track_id, None)
+
+
+def urlopen(get_url, headers=None, method='GET',
+            buffer_size=httppool.BUFFER_SIZE):
+    """Open the URL returned by get_url(), with the given request headers
+    and method, on a pooled connection, when the scheduler lets it go. The
+    body is read ahead into a buffer of buffer_size bytes. If the server
+    rejects the URL as expired, get a fresh one with get_url(refresh=True)
+    and try once more."""
+    url = get_url()
+    try:
+        return scheduler.call(httppool.pool.request, method, url, headers,
+                              buffer_size=buffer_size)
+    except urllib2.HTTPError as e:
+        if e.code not in EXPIRED_CODES:
+            raise
+        log.debug('Stream URL rejected with %d, fetching a new one' % e.code)
+    url = get_url(refresh=True)
+    return scheduler.call(httppool.pool.request, method, url, headers,
+                          buffer_size=buffer_size)
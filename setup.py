@@ -21,5 +21,6 @@ setup(
     zip_safe=False,
     packages = ['gmusicfs'],
     entry_points = {
-        'console_scripts': ['gmusicfs = gmusicfs.gmusicfs:main']},
+        'console_scripts': ['gmusicfs = gmusicfs.gmusicfs:main',
+                            'gmusicfs-replay = gmusicfs.replay:main']},
 )